@@ -24,6 +24,38 @@ def as_geojson_stream(dicts, geometry_field="geometry", srid=4326):
     bit ridiculous.
     """
     to_geojson = GeoJSONConvertor(srid)
+    features = (
+        as_geojson_feature(dictionary, to_geojson, geometry_field)
+        for dictionary in dicts
+    )
+    return as_geojson_feature_stream(features, srid)
+
+
+def as_geojson_feature(dictionary, to_geojson, geometry_field="geometry"):
+    """
+    Return the GeoJSON representation of a single dictionary as a Feature,
+    using the supplied GeoJSONConvertor for its geometry
+    """
+    geometry = dictionary.pop(geometry_field, None)
+    feature = {"type": "Feature", "properties": dictionary}
+    # Output feature omitting closing brace and newline, then the geometry
+    # field, which is already a JSON string, then close the feature
+    return "".join(
+        [
+            json.dumps(feature, indent=2)[:-2],
+            ',\n  "geometry": ',
+            to_geojson(geometry),
+            "\n}",
+        ]
+    )
+
+
+def as_geojson_feature_stream(features, srid=4326):
+    """
+    Convert an iterable of Features, already serialized by
+    `as_geojson_feature`, into an iterable of strings giving the GeoJSON
+    representation of the FeatureCollection
+    """
     header = {
         "type": "FeatureCollection",
         "crs": {"type": "name", "properties": {"name": "EPSG:{}".format(srid)}},
@@ -32,18 +64,10 @@ def as_geojson_stream(dicts, geometry_field="geometry", srid=4326):
     yield json.dumps(header)[:-1]
     # Open "features" array
     yield ', "features": ['
-    for n, dictionary in enumerate(dicts):
+    for n, feature in enumerate(features):
         # Output separator
         yield ",\n" if n > 0 else "\n"
-        geometry = dictionary.pop(geometry_field, None)
-        feature = {"type": "Feature", "properties": dictionary}
-        # Output feature omitting closing brace and newline
-        yield json.dumps(feature, indent=2)[:-2]
-        # Output geometry field, which is already a JSON string
-        yield ',\n  "geometry": '
-        yield to_geojson(geometry)
-        # Close feature
-        yield "\n}"
+        yield feature
     # Close features array and header object
     yield "\n]}"
 
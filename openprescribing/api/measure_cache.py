@@ -0,0 +1,150 @@
+"""
+Cache of pre-serialized JSON responses for the measure API.
+
+The data behind the `measure_by_<org_type>` endpoints only changes when
+`import_measures` runs, but building each response involves pulling thousands
+of MeasureValues out of Postgres and rolling them up in Python.  So for the
+most common shapes of request we store the rendered JSON and serve it
+directly.  These shapes are:
+
+    * all measures for one org
+    * one measure for all the children of a parent org (e.g. all practices in a
+      CCG)
+    * one measure for all orgs of a type
+
+Cache keys include the ImportLog entry which `import_measures` creates each
+time it completes, so a new import automatically invalidates everything
+cached for the previous one.  As with `frontend.views.views.cached`, they also
+include the commit sha of the code, so responses cached by one deployment are
+never served by another, which may have changed the response format.  Stale
+entries are eventually removed by the `diskcache_garbage_collect` command.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from frontend.models import ImportLog, Measure, MeasureValue
+
+IMPORT_LOG_CATEGORY = "measures"
+
+# Bump this if the structure of the measure API response changes
+CACHE_VERSION = 1
+
+ORG_TYPES = ["practice", "pcn", "ccg", "stp", "regional_team"]
+
+# Pairs of (org_type, parent_org_type) used by the "measure for all X in Y"
+# pages
+CHILD_AND_PARENT_ORG_TYPES = [
+    ("practice", "ccg"),
+    ("practice", "pcn"),
+    ("ccg", "stp"),
+    ("ccg", "regional_team"),
+]
+
+
+def get_cache_key(org_type, parent_org_type, org_ids, measure_ids, tags, aggregate):
+    """
+    Return the cache key for a request with the supplied (normalised)
+    parameters, or None if the request isn't one of the shapes we cache or
+    caching is disabled
+    """
+    if not settings.ENABLE_CACHING:
+        return
+    if tags or aggregate:
+        return
+    if parent_org_type == "pct":
+        parent_org_type = "ccg"
+    if len(org_ids) == 1 and not measure_ids and parent_org_type == org_type:
+        # All measures for one org
+        org_id, measure_id = org_ids[0], None
+    elif len(org_ids) == 1 and len(measure_ids) == 1 and parent_org_type != org_type:
+        # One measure for all children of a parent org
+        org_id, measure_id = org_ids[0], measure_ids[0]
+    elif not org_ids and len(measure_ids) == 1:
+        # One measure for all orgs of a type
+        org_id, measure_id = None, measure_ids[0]
+    else:
+        return
+    import_log = _get_latest_import_log()
+    if import_log is None:
+        return
+    return ":".join(
+        [
+            settings.SOURCE_COMMIT_ID,
+            __name__,
+            str(CACHE_VERSION),
+            str(import_log.pk),
+            import_log.imported_at.isoformat(),
+            org_type,
+            parent_org_type,
+            org_id or "",
+            measure_id or "",
+        ]
+    )
+
+
+def get_content(cache_key):
+    return cache.get(cache_key)
+
+
+def set_content(cache_key, content):
+    cache.set(cache_key, content, timeout=None)
+
+
+def record_import(current_at):
+    """
+    Record that `import_measures` has completed, which invalidates all
+    previously cached responses
+    """
+    ImportLog.objects.create(
+        category=IMPORT_LOG_CATEGORY, current_at=current_at, filename=""
+    )
+
+
+def iter_common_requests(include_single_practices=False):
+    """
+    Yield tuples of (org_type, parent_org_type, org_ids, measure_ids) for every
+    request of a cacheable shape for which there is data
+
+    Responses for single practices are numerous and large in aggregate, and
+    each is only likely to be requested a handful of times each month, so by
+    default we leave them to be cached on first request.
+    """
+    measure_ids = list(Measure.objects.order_by("id").values_list("id", flat=True))
+
+    for org_type in ORG_TYPES:
+        if org_type == "practice" and not include_single_practices:
+            continue
+        for org_id in _org_ids_with_values(org_type, org_type):
+            yield org_type, org_type, [org_id], []
+
+    for org_type, parent_org_type in CHILD_AND_PARENT_ORG_TYPES:
+        for org_id in _org_ids_with_values(org_type, parent_org_type):
+            for measure_id in measure_ids:
+                yield org_type, parent_org_type, [org_id], [measure_id]
+
+    for org_type in ORG_TYPES:
+        # Requests for all practices must be aggregated
+        if org_type == "practice":
+            continue
+        for measure_id in measure_ids:
+            yield org_type, org_type, [], [measure_id]
+
+
+def _org_ids_with_values(org_type, parent_org_type):
+    field = "pct_id" if parent_org_type == "ccg" else parent_org_type + "_id"
+    return (
+        MeasureValue.objects.filter_by_org_type(org_type)
+        .filter(**{field + "__isnull": False})
+        .order_by(field)
+        .values_list(field, flat=True)
+        .distinct()
+    )
+
+
+def _get_latest_import_log():
+    # We can't use `ImportLog.objects.latest_in_category` here as there may be
+    # several imports with the same `current_at` date and we need the most
+    # recent of them
+    return (
+        ImportLog.objects.filter(category=IMPORT_LOG_CATEGORY).order_by("-pk").first()
+    )
@@ -0,0 +1,168 @@
+"""
+Precomputed, pre-serialized boundaries for the `org_location` API.
+
+The boundaries of PCNs, STPs and regional teams are the unions of the
+boundaries of their practices or CCGs, and computing these in PostGIS on every
+request is slow.  Full-resolution boundaries are also far larger than needed
+to draw a map of the whole country.
+
+Boundaries only change when `import_ccg_boundaries` or
+`infer_practice_boundaries` run, so these commands call `update_org_boundaries`
+which computes the boundary of every organisation once, simplifies it at each
+of `TOLERANCES`, and stores the serialized GeoJSON Features as
+OrgBoundaryFeatures.  The API then picks a tolerance suitable for the
+requested zoom level and serves the response by concatenating Features.  The
+unsimplified boundaries are also stored as geometries, for generating vector
+tiles.
+
+If no boundaries have been precomputed for an org type the API falls back to
+computing them on each request.
+
+Updating the boundaries also invalidates the vector tiles cached by
+`api.org_tiles`.
+"""
+
+import math
+
+from api.geojson_serializer import GeoJSONConvertor, as_geojson_feature
+from django.contrib.gis.db.models.aggregates import Union
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, Subquery
+from frontend.models import PCN, PCT, STP, OrgBoundaryFeature, RegionalTeam
+
+ORG_TYPES = ["ccg", "pcn", "stp", "regional_team"]
+
+# Tolerances, in degrees, at which boundaries are simplified.  At the latitude
+# of England a degree of longitude is about 70km, so the coarsest of these
+# removes detail smaller than about 700m.
+TOLERANCES = [0.0, 0.0005, 0.002, 0.01]
+
+SRID = 4326
+
+# Width in pixels of a web map tile
+TILE_SIZE = 256
+
+
+def get_orgs(org_type, org_codes):
+    """
+    Return all active organisations of the given type, restricted to the given
+    codes (or, for PCNs, to PCNs in the given CCGs) if any are given
+    """
+    if org_type == "ccg":
+        results = PCT.objects.filter(close_date__isnull=True, org_type="CCG")
+    elif org_type == "pcn":
+        results = PCN.objects.active()
+        if org_codes:
+            return results.filter(
+                Q(code__in=org_codes) | Q(practice__ccg_id__in=org_codes)
+            )
+    elif org_type == "stp":
+        results = STP.objects.all()
+    elif org_type == "regional_team":
+        results = RegionalTeam.objects.active()
+    else:
+        raise ValueError("Unknown org_type: {}".format(org_type))
+    if org_codes:
+        results = results.filter(code__in=org_codes)
+    return results
+
+
+def get_boundaries(org_type, org_codes):
+    """
+    Return dicts of properties and (unsimplified) boundary geometry for the
+    organisations returned by `get_orgs`
+    """
+    results = get_orgs(org_type, org_codes)
+    if org_type == "ccg":
+        return results.values(
+            "name", "code", "ons_code", "org_type", geometry=F("boundary")
+        )
+    elif org_type == "pcn":
+        return results.values("name", "code", geometry=Union("practice__boundary"))
+    else:
+        return results.values("name", "code", geometry=Union("pct__boundary"))
+
+
+def get_precomputed_boundaries(org_type):
+    """
+    Return dicts of properties and unsimplified boundary geometry for all the
+    organisations of the given type, in the same form as `get_boundaries` but
+    from OrgBoundaryFeatures, or None if none have been precomputed
+    """
+    features = OrgBoundaryFeature.objects.filter(
+        org_type=org_type, tolerance=0.0, geometry__isnull=False
+    )
+    if not features.exists():
+        return None
+    orgs = get_orgs(org_type, [])
+    names = orgs.filter(code=OuterRef("code")).values("name")
+    return features.filter(code__in=orgs.values("code")).values(
+        "code", "geometry", name=Subquery(names)
+    )
+
+
+def get_features(org_type, org_codes, tolerance):
+    """
+    Return an iterator of precomputed GeoJSON Features for the organisations
+    returned by `get_orgs`, simplified with the largest available
+    tolerance not greater than `tolerance`, or None if none have been
+    precomputed
+    """
+    features = OrgBoundaryFeature.objects.filter(org_type=org_type)
+    if not features.exists():
+        return None
+    if org_codes:
+        codes = get_orgs(org_type, org_codes).values("code")
+        features = features.filter(code__in=codes)
+    tolerance = max(t for t in TOLERANCES if t <= max(tolerance, 0.0))
+    return (
+        features.filter(tolerance=tolerance)
+        .order_by("code")
+        .values_list("feature", flat=True)
+        .iterator()
+    )
+
+
+def tolerance_for_zoom(zoom):
+    """
+    Return the size, in degrees of longitude, of a pixel at the given web map
+    zoom level, which is the most detail it's worth drawing at that level
+    """
+    return 360.0 / (TILE_SIZE * math.pow(2, zoom))
+
+
+def update_org_boundaries():
+    """
+    Compute, simplify and serialize the boundaries of all organisations and
+    replace any previously stored OrgBoundaryFeatures
+    """
+    # Import here to avoid a circular import
+    from api import org_tiles
+
+    to_geojson = GeoJSONConvertor(SRID)
+    with transaction.atomic():
+        # Cached vector tiles are generated from the same boundaries
+        transaction.on_commit(org_tiles.invalidate_cache)
+        OrgBoundaryFeature.objects.all().delete()
+        for org_type in ORG_TYPES:
+            features = []
+            for boundary in get_boundaries(org_type, []):
+                geometry = boundary.pop("geometry")
+                for tolerance in TOLERANCES:
+                    if geometry is not None and tolerance > 0:
+                        simplified = geometry.simplify(
+                            tolerance, preserve_topology=True
+                        )
+                    else:
+                        simplified = geometry
+                    properties = dict(boundary, geometry=simplified)
+                    features.append(
+                        OrgBoundaryFeature(
+                            org_type=org_type,
+                            code=boundary["code"],
+                            tolerance=tolerance,
+                            feature=as_geojson_feature(properties, to_geojson),
+                            geometry=geometry if tolerance == 0 else None,
+                        )
+                    )
+            OrgBoundaryFeature.objects.bulk_create(features, batch_size=1000)
@@ -0,0 +1,136 @@
+"""
+Mapbox Vector Tiles of practice and organisation boundaries.
+
+Tiles are generated by PostGIS with `ST_AsMVT`, from the same geometries that
+the `org_location` API serves as GeoJSON, so that maps need only fetch the
+boundaries that are in view.
+
+The boundaries of PCNs, STPs and regional teams are the unions of many
+boundaries, so tiles for these are generated from the unions precomputed by
+`api.org_boundaries.update_org_boundaries` (falling back to computing them if
+there are none).  Each tile is also cached as a file under
+`settings.TILE_CACHE_DIR`.  Boundaries only change when `update_org_boundaries`
+runs, which calls `invalidate_cache` once its transaction has committed.
+"""
+
+import os
+import shutil
+import tempfile
+import uuid
+
+from api import org_boundaries
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from frontend.models import Practice
+
+ORG_TYPES = ["practice"] + org_boundaries.ORG_TYPES
+
+MAX_ZOOM = 16
+
+# Size of a tile, and of the buffer around it into which geometries extend, in
+# tile coordinates
+EXTENT = 4096
+BUFFER = 64
+
+CONTENT_TYPE = "application/vnd.mapbox-vector-tile"
+
+TILE_SQL = """
+SELECT ST_AsMVT(tile, %s, {extent}, 'geom')
+FROM (
+    SELECT
+        {columns},
+        ST_AsMVTGeom(
+            ST_Transform(orgs.geometry, 3857),
+            ST_TileEnvelope(%s, %s, %s),
+            {extent},
+            {buffer},
+            true
+        ) AS geom
+    FROM ({orgs_sql}) AS orgs
+    WHERE orgs.geometry && ST_Transform(ST_TileEnvelope(%s, %s, %s), 4326)
+) AS tile
+"""
+
+
+def is_valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2**z and 0 <= y < 2**z
+
+
+def get_tile(org_type, z, x, y):
+    """
+    Return the tile with the given coordinates as bytes, generating and caching
+    it if necessary
+    """
+    path = _get_tile_path(org_type, z, x, y)
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    content = generate_tile(org_type, z, x, y)
+    _write_file(path, content)
+    return content
+
+
+def generate_tile(org_type, z, x, y):
+    orgs = _get_orgs_with_geometry(org_type)
+    orgs_sql, orgs_params = orgs.query.sql_with_params()
+    # Properties are sorted so that tiles don't depend on how the query for
+    # them was built
+    names = sorted({*orgs.query.values_select, *orgs.query.annotation_select})
+    columns = ", ".join("orgs.{}".format(name) for name in names if name != "geometry")
+    sql = TILE_SQL.format(
+        extent=EXTENT, buffer=BUFFER, columns=columns, orgs_sql=orgs_sql
+    )
+    params = [org_type, z, x, y, *orgs_params, z, x, y]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return bytes(cursor.fetchone()[0])
+
+
+def invalidate_cache():
+    """
+    Delete all cached tiles
+
+    We move the cache out of the way before deleting it so that no request can
+    read a tile from a partially deleted cache.
+    """
+    path = _get_tiles_dir()
+    if not os.path.exists(path):
+        return
+    stale_path = "{}-stale-{}".format(path, uuid.uuid4().hex)
+    os.rename(path, stale_path)
+    shutil.rmtree(stale_path)
+
+
+def _get_orgs_with_geometry(org_type):
+    if org_type == "practice":
+        orgs = Practice.objects.filter(boundary__isnull=False).values(
+            "name", "code", "setting", geometry=F("boundary")
+        )
+    elif org_type == "ccg":
+        orgs = org_boundaries.get_boundaries(org_type, [])
+    else:
+        orgs = org_boundaries.get_precomputed_boundaries(org_type)
+        if orgs is None:
+            orgs = org_boundaries.get_boundaries(org_type, [])
+    return orgs.order_by("code")
+
+
+def _get_tiles_dir():
+    return os.path.join(settings.TILE_CACHE_DIR, "tiles")
+
+
+def _get_tile_path(org_type, z, x, y):
+    return os.path.join(_get_tiles_dir(), org_type, str(z), str(x), "{}.mvt".format(y))
+
+
+def _write_file(path, content):
+    # Write to a temporary file and then rename it, so that a concurrent
+    # request never reads a partially written tile
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
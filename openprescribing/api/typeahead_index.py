@@ -0,0 +1,523 @@
+"""
+Search index used to answer the `org_code` and `bnf_code` typeahead APIs
+without querying the database.
+
+These APIs are hit on every keystroke in the analyse form, and each request
+runs a handful of `istartswith`/`icontains` queries, none of which can use an
+index.  But the underlying tables only change when we import new data, so
+after each import we build an index of everything these APIs can return (see
+the `build_typeahead_index` command) and search that instead.
+
+The index is a directory of numpy arrays which we memory-map, so the OS shares
+a single copy between all the application's worker processes.  For each table
+(practices, CCGs, BNF sections, etc.) it contains:
+
+    * the JSON-encoded API response for each row, with rows in the order in
+      which the API returns them
+    * sorted arrays of codes (and names), for prefix and exact matching
+    * trigram posting lists, for substring matching on names
+    * boolean flags used for filtering
+
+Queries are answered by finding the IDs of matching rows using these
+structures, and returning the corresponding responses in ID order, which
+gives the same results in the same order as the database queries.
+
+The "live" symlink in `settings.TYPEAHEAD_INDEX_DIR` points at the current
+version of the index.  If there is no index the API views fall back to
+querying the database.
+"""
+
+import datetime
+import json
+import os
+import shutil
+
+import numpy as np
+from django.conf import settings
+from frontend.models import (
+    PCN,
+    PCT,
+    STP,
+    Chemical,
+    Practice,
+    Presentation,
+    Product,
+    RegionalTeam,
+    Section,
+)
+
+# Bump this if the structure of the index changes
+INDEX_VERSION = 1
+
+LIVE_LINK_NAME = "live"
+
+# Upper bound for the characters which can follow a prefix
+MAX_CHAR = "\U0010ffff"
+
+# Substring queries shorter than this are answered by scanning all names
+NGRAM_SIZE = 3
+
+
+class TypeaheadIndex(object):
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+        self.tables = {
+            name: IndexTable(os.path.join(path, name), table_manifest)
+            for name, table_manifest in manifest["tables"].items()
+        }
+
+    def search_orgs(self, q, is_exact, org_type):
+        """
+        Return the results of `api.views_org_codes._get_org_from_code` for
+        the given (normalised) `org_type`
+        """
+        if is_exact:
+            if org_type == "practice":
+                return [
+                    {
+                        "name": practice["name"],
+                        "code": practice["code"],
+                        "ccg": practice["ccg"],
+                        "id": practice["id"],
+                        "type": practice["type"],
+                    }
+                    for practice in self._search_exact("practice", q)
+                ]
+            elif org_type == "ccg":
+                return self._search_exact("ccg", q, flag="is_ccg")
+            elif org_type in ["pcn", "stp", "regional_team"]:
+                return self._search_exact(org_type, q)
+        else:
+            if org_type == "practice":
+                return self._search_practices(q)
+            elif org_type == "ccg":
+                return self._search_ccgs(q)
+            elif org_type == "practice_or_ccg":
+                return self._search_ccgs(q) + self._search_practices(q)
+            elif org_type in ["pcn", "stp", "regional_team"]:
+                return self._search_inexact(org_type, q)
+        raise ValueError("Unknown org_type: {}".format(org_type))
+
+    def search_bnf_codes(self, codes, is_exact):
+        """
+        Return the results of `api.views_bnf_codes.bnf_codes` for the given
+        (upper-cased) codes
+        """
+        results = []
+        for code in codes:
+            if is_exact:
+                results += self._search_exact("section", code)
+                results += self._search_exact("chemical", code)
+                results += self._search_exact("product", code)
+                results += self._search_exact("presentation", code)
+            else:
+                results += self._search_inexact("section", code)
+                results += self._search_inexact("chemical", code)
+                results += self._search_inexact("product", code)
+                results += self._search_inexact("presentation", code)
+        return results
+
+    def _search_practices(self, q):
+        table = self.tables["practice"]
+        if not q:
+            return table.responses(table.all_ids())
+        ids = table.search_inexact(q)
+        return table.responses(table.filter(ids, "is_active_gp_practice"))
+
+    def _search_ccgs(self, q):
+        table = self.tables["ccg"]
+        if not q:
+            return table.responses(table.filter(table.all_ids(), "is_open"))
+        ids = table.filter(table.search_inexact(q), "is_open")
+        return table.responses(table.filter(ids, "is_ccg"))
+
+    def _search_inexact(self, table_name, q):
+        table = self.tables[table_name]
+        if not q:
+            return table.responses(table.all_ids())
+        return table.responses(table.search_inexact(q))
+
+    def _search_exact(self, table_name, q, flag=None):
+        table = self.tables[table_name]
+        ids = table.search_exact(q)
+        if flag:
+            ids = table.filter(ids, flag)
+        return table.responses(ids)
+
+
+class IndexTable(object):
+    """
+    The part of the index covering one table
+
+    `manifest` describes how each field is searched:
+
+        * "prefix" fields are searched by (case-insensitive) prefix
+        * "prefix_case_sensitive" fields are searched by case-sensitive prefix
+        * "equal" fields must equal the query exactly
+        * "substring" fields are searched by (case-insensitive) substring
+
+    and "exact" fields are those searched when an exact match is requested.
+    """
+
+    def __init__(self, path, manifest):
+        self.path = path
+        self.manifest = manifest
+        self.num_rows = manifest["num_rows"]
+        self.arrays = {}
+
+    def _load(self, name):
+        if name not in self.arrays:
+            self.arrays[name] = np.load(
+                os.path.join(self.path, name + ".npy"), mmap_mode="r"
+            )
+        return self.arrays[name]
+
+    def all_ids(self):
+        return np.arange(self.num_rows)
+
+    def filter(self, ids, flag):
+        return ids[self._load("flag." + flag)[ids]]
+
+    def search_inexact(self, q):
+        matches = []
+        for field in self.manifest["prefix"]:
+            matches.append(self._prefix_match(field, q.upper(), upper=True))
+        for field in self.manifest["prefix_case_sensitive"]:
+            matches.append(self._prefix_match(field, q, upper=False))
+        for field in self.manifest["equal"]:
+            matches.append(self._exact_match(field, q))
+        for field in self.manifest["substring"]:
+            matches.append(self._substring_match(field, q.upper()))
+        return np.unique(np.concatenate(matches))
+
+    def search_exact(self, q):
+        matches = [self._exact_match(field, q) for field in self.manifest["exact"]]
+        return np.unique(np.concatenate(matches))
+
+    def responses(self, ids):
+        data = self._load("responses")
+        offsets = self._load("response_offsets")
+        return [json.loads(bytes(data[offsets[i] : offsets[i + 1]])) for i in ids]
+
+    def _sorted_range(self, field, upper, lower_bound, upper_bound):
+        suffix = "upper" if upper else "raw"
+        keys = self._load("sorted.{}.{}.keys".format(field, suffix))
+        ids = self._load("sorted.{}.{}.ids".format(field, suffix))
+        start = np.searchsorted(keys, lower_bound, side="left")
+        end = np.searchsorted(keys, upper_bound, side="right")
+        return np.array(ids[start:end])
+
+    def _prefix_match(self, field, q, upper):
+        return self._sorted_range(field, upper, q, q + MAX_CHAR)
+
+    def _exact_match(self, field, q):
+        return self._sorted_range(field, False, q, q)
+
+    def _substring_match(self, field, q):
+        values = self._load("upper." + field)
+        if len(q) < NGRAM_SIZE:
+            return np.flatnonzero(np.char.find(values, q) >= 0)
+        keys = self._load("ngram.{}.keys".format(field))
+        offsets = self._load("ngram.{}.offsets".format(field))
+        ids = self._load("ngram.{}.ids".format(field))
+        postings = []
+        for ngram in set(ngrams(q)):
+            n = np.searchsorted(keys, ngram)
+            if n == len(keys) or keys[n] != ngram:
+                return np.array([], dtype=np.int64)
+            postings.append(ids[offsets[n] : offsets[n + 1]])
+        # Intersect the shortest lists first
+        postings.sort(key=len)
+        candidates = np.array(postings[0])
+        for posting in postings[1:]:
+            candidates = np.intersect1d(candidates, posting, assume_unique=True)
+        # Having every ngram in the query doesn't mean the whole query matches
+        return candidates[np.char.find(values[candidates], q) >= 0]
+
+
+def ngrams(s):
+    return [s[i : i + NGRAM_SIZE] for i in range(len(s) - NGRAM_SIZE + 1)]
+
+
+_live_index = None
+
+
+def get_index():
+    """
+    Return the live index, or None if there isn't one
+
+    Each process keeps the index open, but reloads it when the live symlink is
+    updated.
+    """
+    global _live_index
+    path = os.path.realpath(os.path.join(settings.TYPEAHEAD_INDEX_DIR, LIVE_LINK_NAME))
+    if not os.path.exists(os.path.join(path, "manifest.json")):
+        return None
+    if _live_index is None or _live_index.path != path:
+        _live_index = TypeaheadIndex(path)
+    return _live_index
+
+
+def build_index():
+    """
+    Build a new version of the index, and make it live
+    """
+    # Import here to avoid a circular import
+    from api.views_bnf_codes import _convert_querysets
+
+    index_dir = settings.TYPEAHEAD_INDEX_DIR
+    name = "v{}-{}".format(
+        INDEX_VERSION, datetime.datetime.now().strftime("%Y%m%d%H%M%S%f")
+    )
+    path = os.path.join(index_dir, name)
+    os.makedirs(path)
+
+    tables = {}
+
+    practices = list(
+        Practice.objects.only(
+            "code", "name", "postcode", "setting", "status_code", "ccg"
+        ).order_by("name")
+    )
+    tables["practice"] = write_table(
+        path,
+        "practice",
+        responses=[_practice_response(practice) for practice in practices],
+        fields={
+            "code": [practice.code for practice in practices],
+            "name": [practice.name for practice in practices],
+            "postcode": [practice.postcode for practice in practices],
+        },
+        flags={
+            "is_active_gp_practice": [
+                practice.setting == 4 and practice.status_code == "A"
+                for practice in practices
+            ]
+        },
+        prefix=["code", "postcode"],
+        substring=["name"],
+        exact=["code", "name"],
+    )
+
+    ccgs = list(PCT.objects.only("code", "name", "org_type", "close_date"))
+    tables["ccg"] = write_table(
+        path,
+        "ccg",
+        responses=[_org_response(ccg, "CCG") for ccg in ccgs],
+        fields={"code": [ccg.code for ccg in ccgs], "name": [ccg.name for ccg in ccgs]},
+        flags={
+            "is_open": [ccg.close_date is None for ccg in ccgs],
+            "is_ccg": [ccg.org_type == "CCG" for ccg in ccgs],
+        },
+        prefix=["code"],
+        substring=["name"],
+        exact=["code", "name"],
+    )
+
+    for org_type, orgs in [
+        ("pcn", list(PCN.objects.active())),
+        ("stp", list(STP.objects.all())),
+        ("regional_team", list(RegionalTeam.objects.active().only("code", "name"))),
+    ]:
+        tables[org_type] = write_table(
+            path,
+            org_type,
+            responses=[_org_response(org, org_type) for org in orgs],
+            fields={
+                "code": [org.code for org in orgs],
+                "name": [org.name for org in orgs],
+            },
+            prefix=["code"],
+            substring=["name"],
+            exact=["code", "name"],
+        )
+
+    # We evaluate each queryset once, and pass the results to
+    # `_convert_querysets`, to be sure that responses and fields are in the
+    # same order
+    sections = list(
+        Section.objects.filter(is_current=True)
+        .extra(select={"type": 0})
+        .order_by("number_str")
+    )
+    tables["section"] = write_table(
+        path,
+        "section",
+        responses=_convert_querysets([sections]),
+        fields={
+            "bnf_id": [section.bnf_id for section in sections],
+            "number_str": [section.number_str for section in sections],
+            "name": [section.name for section in sections],
+        },
+        prefix_case_sensitive=["number_str"],
+        equal=["bnf_id"],
+        substring=["name"],
+        exact=["bnf_id", "number_str", "name"],
+    )
+
+    for table_name, type_id, queryset, name_field in [
+        (
+            "chemical",
+            1,
+            Chemical.objects.filter(is_current=True).order_by("chem_name"),
+            "chem_name",
+        ),
+        (
+            "product",
+            2,
+            Product.objects.filter(is_current=True).order_by("name"),
+            "name",
+        ),
+        (
+            "presentation",
+            3,
+            Presentation.objects.current().filter(is_current=True).order_by("name"),
+            "name",
+        ),
+    ]:
+        objs = list(queryset.extra(select={"type": type_id}))
+        tables[table_name] = write_table(
+            path,
+            table_name,
+            responses=_convert_querysets([objs]),
+            fields={
+                "bnf_code": [obj.bnf_code for obj in objs],
+                name_field: [getattr(obj, name_field) for obj in objs],
+            },
+            prefix_case_sensitive=["bnf_code"],
+            substring=[name_field],
+            exact=["bnf_code", name_field],
+        )
+
+    with open(os.path.join(path, "manifest.json"), "w") as f:
+        json.dump({"version": INDEX_VERSION, "tables": tables}, f, indent=2)
+
+    _set_live(index_dir, name)
+    return path
+
+
+def write_table(
+    path,
+    table_name,
+    responses,
+    fields,
+    flags=None,
+    prefix=(),
+    prefix_case_sensitive=(),
+    equal=(),
+    substring=(),
+    exact=(),
+):
+    """
+    Write the arrays for a table, and return its manifest
+
+    Rows must be supplied in the order in which the API returns them, and IDs
+    are positions in this order.
+    """
+    table_path = os.path.join(path, table_name)
+    os.makedirs(table_path)
+
+    def save(name, array):
+        np.save(os.path.join(table_path, name + ".npy"), array)
+
+    encoded = [json.dumps(response).encode("utf8") for response in responses]
+    save("responses", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+    save("response_offsets", np.cumsum([0] + [len(e) for e in encoded]))
+
+    for name, values in (flags or {}).items():
+        save("flag." + name, np.array(values, dtype=bool))
+
+    for field in set(exact) | set(equal) | set(prefix_case_sensitive):
+        keys, ids = _sorted_index(fields[field], upper=False)
+        save("sorted.{}.raw.keys".format(field), keys)
+        save("sorted.{}.raw.ids".format(field), ids)
+
+    for field in prefix:
+        keys, ids = _sorted_index(fields[field], upper=True)
+        save("sorted.{}.upper.keys".format(field), keys)
+        save("sorted.{}.upper.ids".format(field), ids)
+
+    for field in substring:
+        upper_values = [(value or "").upper() for value in fields[field]]
+        save("upper." + field, _string_array(upper_values))
+        keys, offsets, ids = _ngram_index(upper_values)
+        save("ngram.{}.keys".format(field), keys)
+        save("ngram.{}.offsets".format(field), offsets)
+        save("ngram.{}.ids".format(field), ids)
+
+    return {
+        "num_rows": len(responses),
+        "prefix": list(prefix),
+        "prefix_case_sensitive": list(prefix_case_sensitive),
+        "equal": list(equal),
+        "substring": list(substring),
+        "exact": list(exact),
+    }
+
+
+def _sorted_index(values, upper):
+    # NULLs never match anything
+    pairs = sorted(
+        (value.upper() if upper else value, n)
+        for n, value in enumerate(values)
+        if value is not None
+    )
+    keys = _string_array([key for key, _ in pairs])
+    ids = np.array([n for _, n in pairs], dtype=np.int64)
+    return keys, ids
+
+
+def _ngram_index(values):
+    pairs = sorted(
+        {(ngram, n) for n, value in enumerate(values) for ngram in ngrams(value)}
+    )
+    all_keys = [ngram for ngram, _ in pairs]
+    keys = sorted(set(all_keys))
+    # Each key's postings run from its first occurrence in the sorted pairs to
+    # the next key's
+    offsets = np.searchsorted(_string_array(all_keys), _string_array(keys))
+    offsets = np.append(offsets, len(pairs))
+    ids = np.array([n for _, n in pairs], dtype=np.int64)
+    return _string_array(keys), offsets, ids
+
+
+def _string_array(values):
+    return np.array([value or "" for value in values], dtype=str)
+
+
+def _practice_response(practice):
+    # This matches the output of `_get_practices_like_code`
+    return {
+        "id": practice.code,
+        "code": practice.code,
+        "name": practice.name,
+        "postcode": practice.postcode,
+        "setting": practice.setting,
+        "setting_name": practice.get_setting_display(),
+        "type": "practice",
+        "ccg": practice.ccg_id,
+    }
+
+
+def _org_response(org, org_type):
+    return {"name": org.name, "code": org.code, "id": org.code, "type": org_type}
+
+
+def _set_live(index_dir, name):
+    """
+    Atomically point the live symlink at the named version of the index, and
+    remove all other versions except the previous one (which processes may
+    still have open)
+    """
+    live_link = os.path.join(index_dir, LIVE_LINK_NAME)
+    previous = os.readlink(live_link) if os.path.islink(live_link) else None
+    tmp_link = live_link + ".tmp"
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(name, tmp_link)
+    os.replace(tmp_link, live_link)
+    for entry in os.listdir(index_dir):
+        if entry.startswith("v") and entry not in [name, previous]:
+            shutil.rmtree(os.path.join(index_dir, entry))
@@ -55,3 +55,11 @@ urlpatterns = [
 ]
 
 urlpatterns = format_suffix_patterns(urlpatterns, allowed=["json", "csv"])
+
+urlpatterns += [
+    path(
+        r"org_location/tiles/<str:org_type>/<int:z>/<int:x>/<int:y>.mvt",
+        views_org_location.org_location_tile,
+        name="org_location_tile",
+    ),
+]
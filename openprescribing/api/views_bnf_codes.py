@@ -3,6 +3,7 @@ from frontend.models import Chemical, Presentation, Product, Section
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 
+from . import typeahead_index
 from . import view_utils as utils
 
 
@@ -13,8 +14,12 @@ def bnf_codes(request, format=None):
     is_exact = request.GET.get("exact", None)
     is_exact = is_exact == "true"
 
-    querysets = _get_matching_products(codes, is_exact)
-    data = _convert_querysets(querysets)
+    index = typeahead_index.get_index()
+    if index is not None:
+        data = index.search_bnf_codes(codes, is_exact)
+    else:
+        querysets = _get_matching_products(codes, is_exact)
+        data = _convert_querysets(querysets)
     return Response(data)
 
 
@@ -1,16 +1,69 @@
+import csv
+import itertools
+import operator
 import re
 
+from django.http import HttpResponse, StreamingHttpResponse
+from frontend.managers import CENTILES
 from frontend.measure_tags import MEASURE_TAGS
-from frontend.models import Measure, MeasureGlobal, MeasureValue, Presentation
+from frontend.models import (
+    Measure,
+    MeasureAggregate,
+    MeasureGlobal,
+    MeasureValue,
+    Presentation,
+)
 from matrixstore.db import get_db, get_row_grouper
 from rest_framework.decorators import api_view, renderer_classes
 from rest_framework.exceptions import APIException
 from rest_framework.renderers import BrowsableAPIRenderer, JSONRenderer
 from rest_framework.response import Response
+from rest_framework_csv.misc import Echo
 from rest_framework_csv.renderers import CSVRenderer
 
+from . import measure_cache
 from . import view_utils as utils
 
+# Fields fetched for each row by the streaming serializers (followed by the ID
+# and name of the row's org)
+MEASURE_VALUE_FIELDS = [
+    "measure_id",
+    "month",
+    "numerator",
+    "denominator",
+    "calc_value",
+    "percentile",
+    "cost_savings",
+]
+
+# Fields of Measure which appear in the API response
+MEASURE_FIELDS = [
+    "name",
+    "title",
+    "description",
+    "why_it_matters",
+    "numerator_short",
+    "denominator_short",
+    "url",
+    "is_cost_based",
+    "is_percentage",
+    "low_is_good",
+    "radar_exclude",
+    "tags",
+]
+
+# Fields of MeasureValue which relate each row to its org
+ORG_FIELDS = {
+    "practice": "practice",
+    "pcn": "pcn",
+    "ccg": "pct",
+    "stp": "stp",
+    "regional_team": "regional_team",
+}
+
+# Number of rows to fetch from the database, and to serialize, at a time
+STREAMING_CHUNK_SIZE = 2000
+
 
 class MissingParameter(APIException):
     status_code = 400
@@ -276,6 +329,48 @@ def _measure_by_org(request, org_type):
         else:
             parent_org_type = org_type
 
+    renderer_format = request.accepted_renderer.format
+
+    # Aggregates over all orgs of a type are precomputed by `import_measures`
+    # but aggregates over the children of a particular org are not
+    if renderer_format in ["json", "csv"] and not (aggregate and org_ids):
+        if renderer_format == "json" and not aggregate:
+            cache_key = measure_cache.get_cache_key(
+                org_type, parent_org_type, org_ids, measure_ids, tags, aggregate
+            )
+            if cache_key is not None:
+                content = measure_cache.get_content(cache_key)
+                if content is None:
+                    content = _render_measure_values_json(
+                        org_type, parent_org_type, org_ids, measure_ids
+                    )
+                    measure_cache.set_content(cache_key, content)
+                return HttpResponse(content, content_type="application/json")
+
+        if aggregate:
+            rows = _get_measure_aggregate_rows(org_type, measure_ids, tags)
+        else:
+            rows = _get_measure_value_rows(
+                org_type,
+                parent_org_type,
+                org_ids,
+                measure_ids,
+                tags,
+                by_measure=(renderer_format == "json"),
+            )
+
+        if renderer_format == "json":
+            measures = _get_measures(measure_ids, tags)
+            stream = _stream_measure_values_json(rows, measures, org_type)
+            return StreamingHttpResponse(stream, content_type="application/json")
+        else:
+            stream = _stream_measure_values_csv(rows, org_type)
+            response = StreamingHttpResponse(
+                stream, content_type="text/csv; charset=utf-8"
+            )
+            response["content-disposition"] = "attachment; filename=measures.csv"
+            return response
+
     measure_values = MeasureValue.objects.by_org(
         org_type, parent_org_type, org_ids, measure_ids, tags
     )
@@ -289,7 +384,7 @@ def _measure_by_org(request, org_type):
     if aggregate:
         measure_values = measure_values.aggregate_by_measure_and_month()
 
-    if request.accepted_renderer.format == "csv":
+    if renderer_format == "csv":
         data = [_measure_value_data(mv, org_type) for mv in measure_values]
         response = Response(data)
         response["content-disposition"] = "attachment; filename=measures.csv"
@@ -300,6 +395,149 @@ def _measure_by_org(request, org_type):
         return Response(rsp_data)
 
 
+def _render_measure_values_json(org_type, parent_org_type, org_ids, measure_ids):
+    """
+    Return the JSON-encoded response for an unaggregated request without tags
+    """
+    rows = _get_measure_value_rows(
+        org_type, parent_org_type, org_ids, measure_ids, [], by_measure=True
+    )
+    measures = _get_measures(measure_ids, [])
+    return b"".join(_stream_measure_values_json(rows, measures, org_type))
+
+
+def _stream_measure_values_json(rows, measures, org_type):
+    """
+    Yield the JSON-encoded response as a series of bytestrings
+
+    `rows` are tuples of MEASURE_VALUE_FIELDS followed by the org ID and name,
+    ordered by measure.  `measures` maps measure IDs to Measures.
+
+    The output is identical to rendering the result of
+    `_roll_up_measure_values` (except that measures are always ordered by ID)
+    but we avoid building model instances, and only hold a chunk of rows in
+    memory at a time.
+    """
+    renderer = JSONRenderer()
+    # Output opening of "measures" array
+    yield b'{"measures":['
+    grouped = itertools.groupby(rows, key=operator.itemgetter(0))
+    for n, (measure_id, measure_rows) in enumerate(grouped):
+        measure_data = _measure_data(measures[measure_id])
+        measure_data["data"] = []
+        # Output separator and measure, omitting the closing bracket and brace
+        # of the empty "data" array
+        yield (b"," if n > 0 else b"") + renderer.render(measure_data)[:-2]
+        chunks = itertools.batched(measure_rows, STREAMING_CHUNK_SIZE)
+        for m, chunk in enumerate(chunks):
+            data = [_measure_value_row_data(row, org_type) for row in chunk]
+            # Output separator and chunk of rows, omitting the enclosing
+            # brackets
+            yield (b"," if m > 0 else b"") + renderer.render(data)[1:-1]
+        # Close "data" array and measure object
+        yield b"]}"
+    # Close "measures" array and response object
+    yield b"]}"
+
+
+def _stream_measure_values_csv(rows, org_type):
+    """
+    Yield the CSV-encoded response as a series of bytestrings
+
+    The output is identical to rendering a list of `_measure_value_data` dicts
+    with MeasureValueCSVRenderer.
+    """
+    header = MeasureValueCSVRenderer.header
+    writer = csv.writer(Echo())
+    yield writer.writerow(header).encode("utf8")
+    for chunk in itertools.batched(rows, STREAMING_CHUNK_SIZE):
+        lines = []
+        for row in chunk:
+            data = _measure_value_row_data(row, org_type)
+            lines.append(writer.writerow([data.get(key) for key in header]))
+        yield "".join(lines).encode("utf8")
+
+
+def _get_measure_value_rows(
+    org_type, parent_org_type, org_ids, measure_ids, tags, by_measure
+):
+    measure_values = MeasureValue.objects.by_org(
+        org_type, parent_org_type, org_ids, measure_ids, tags
+    )
+    if by_measure:
+        measure_values = measure_values.order_by("measure_id", "month")
+    # Each org's name is fetched with its rows, rather than looking up the
+    # names of all orgs of the type
+    org_field = ORG_FIELDS[org_type]
+    return (
+        measure_values.prefetch_related(None)
+        .values_list(*MEASURE_VALUE_FIELDS, org_field + "_id", org_field + "__name")
+        .iterator(chunk_size=STREAMING_CHUNK_SIZE)
+    )
+
+
+def _get_measure_aggregate_rows(org_type, measure_ids, tags):
+    """
+    Yield rows in the same format as `_get_measure_value_rows` but with values
+    summed over all orgs of the given type, as `aggregate_by_measure_and_month`
+    would produce them
+    """
+    aggregates = MeasureAggregate.objects.filter(org_type=org_type)
+    if measure_ids:
+        aggregates = aggregates.filter(measure_id__in=measure_ids)
+    if tags:
+        aggregates = aggregates.filter(measure__tags__contains=tags)
+    aggregates = aggregates.order_by("measure_id", "month").values_list(
+        "measure_id",
+        "month",
+        "numerator",
+        "denominator",
+        "calc_value",
+        *MeasureAggregate.COST_SAVINGS_FIELDS,
+    )
+    for row in aggregates.iterator(chunk_size=STREAMING_CHUNK_SIZE):
+        measure_id, month, numerator, denominator, calc_value = row[:5]
+        cost_savings = dict(zip(CENTILES, row[5:]))
+        yield (
+            measure_id,
+            month,
+            numerator,
+            denominator,
+            calc_value,
+            None,
+            cost_savings,
+            None,
+            None,
+        )
+
+
+def _get_measures(measure_ids, tags):
+    measures = Measure.objects.only(*MEASURE_FIELDS)
+    if measure_ids:
+        measures = measures.filter(id__in=measure_ids)
+    if tags:
+        measures = measures.filter(tags__contains=tags)
+    return measures.in_bulk()
+
+
+def populate_measure_cache(include_single_practices=False):
+    """
+    Render and cache responses for all the common shapes of request (see
+    `measure_cache` for details).  This is run at the end of `import_measures`.
+    """
+    requests = measure_cache.iter_common_requests(include_single_practices)
+    for org_type, parent_org_type, org_ids, measure_ids in requests:
+        cache_key = measure_cache.get_cache_key(
+            org_type, parent_org_type, org_ids, measure_ids, [], False
+        )
+        if cache_key is None:
+            return
+        content = _render_measure_values_json(
+            org_type, parent_org_type, org_ids, measure_ids
+        )
+        measure_cache.set_content(cache_key, content)
+
+
 def _roll_up_measure_values(measure_values, org_type):
     rolled = {}
 
@@ -310,27 +548,30 @@ def _roll_up_measure_values(measure_values, org_type):
         if measure_id in rolled:
             rolled[measure_id]["data"].append(measure_value_data)
         else:
-            measure = measure_value.measure
-            rolled[measure_id] = {
-                "id": measure_id,
-                "name": measure.name,
-                "title": measure.title,
-                "description": measure.description,
-                "why_it_matters": measure.why_it_matters,
-                "numerator_short": measure.numerator_short,
-                "denominator_short": measure.denominator_short,
-                "url": measure.url,
-                "is_cost_based": measure.is_cost_based,
-                "is_percentage": measure.is_percentage,
-                "low_is_good": measure.low_is_good,
-                "radar_include": not measure.radar_exclude,
-                "tags": _hydrate_tags(measure.tags),
-                "data": [measure_value_data],
-            }
+            rolled[measure_id] = _measure_data(measure_value.measure)
+            rolled[measure_id]["data"] = [measure_value_data]
 
     return list(rolled.values())
 
 
+def _measure_data(measure):
+    return {
+        "id": measure.id,
+        "name": measure.name,
+        "title": measure.title,
+        "description": measure.description,
+        "why_it_matters": measure.why_it_matters,
+        "numerator_short": measure.numerator_short,
+        "denominator_short": measure.denominator_short,
+        "url": measure.url,
+        "is_cost_based": measure.is_cost_based,
+        "is_percentage": measure.is_percentage,
+        "low_is_good": measure.low_is_good,
+        "radar_include": not measure.radar_exclude,
+        "tags": _hydrate_tags(measure.tags),
+    }
+
+
 def _measure_value_data(measure_value, org_type):
     measure_value_data = {
         "measure": measure_value.measure_id,
@@ -393,5 +634,37 @@ def _measure_value_data(measure_value, org_type):
     return measure_value_data
 
 
+def _measure_value_row_data(row, org_type):
+    """
+    Equivalent of `_measure_value_data` for a tuple of MEASURE_VALUE_FIELDS
+    followed by the org ID and name
+    """
+    (
+        measure_id,
+        month,
+        numerator,
+        denominator,
+        calc_value,
+        percentile,
+        cost_savings,
+        org_id,
+        org_name,
+    ) = row
+    measure_value_data = {
+        "measure": measure_id,
+        "date": month,
+        "numerator": numerator,
+        "denominator": denominator,
+        "calc_value": calc_value,
+        "percentile": percentile,
+        "cost_savings": cost_savings,
+    }
+    if org_id:
+        measure_value_data.update(
+            {"org_type": org_type, "org_id": org_id, "org_name": org_name}
+        )
+    return measure_value_data
+
+
 def _hydrate_tags(tag_ids):
     return [{"id": tag_id, "name": MEASURE_TAGS[tag_id]["name"]} for tag_id in tag_ids]
@@ -3,6 +3,7 @@ from frontend.models import PCN, PCT, STP, Practice, RegionalTeam
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 
+from . import typeahead_index
 from . import view_utils as utils
 
 
@@ -24,6 +25,9 @@ def org_codes(request, format=None):
 
 def _get_org_from_code(q, is_exact, org_type):
     org_type = _normalise_org_type(q, is_exact, org_type)
+    index = typeahead_index.get_index()
+    if index is not None:
+        return index.search_orgs(q, is_exact, org_type)
     if is_exact:
         return _get_org_from_code_exact(q, org_type)
     else:
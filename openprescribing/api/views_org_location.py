@@ -1,10 +1,11 @@
 import api.view_utils as utils
-from api.geojson_serializer import as_geojson_stream
-from django.contrib.gis.db.models.aggregates import Union
-from django.db.models import F, Q
-from django.http import HttpResponse
-from frontend.models import PCN, PCT, STP, Practice, RegionalTeam
+from api import org_boundaries, org_tiles
+from api.geojson_serializer import as_geojson_feature_stream, as_geojson_stream
+from django.db.models import F
+from django.http import Http404, HttpResponse
+from frontend.models import Practice
 from rest_framework.decorators import api_view
+from rest_framework.exceptions import ValidationError
 
 
 @api_view(["GET"])
@@ -17,56 +18,58 @@ def org_location(request, format=None):
     org_codes = utils.param_to_list(request.GET.get("q", ""))
     if org_type == "practice":
         results = _get_practices(org_codes, centroids)
-    elif org_type == "ccg":
-        results = _get_ccgs(org_codes, centroids)
-    elif org_type == "pcn":
-        results = _get_pcns(org_codes, centroids)
-    elif org_type == "stp":
-        results = _get_stps(org_codes, centroids)
-    elif org_type == "regional_team":
-        results = _get_regional_teams(org_codes, centroids)
+    elif org_type == "ccg" and centroids:
+        results = _get_ccg_centroids(org_codes)
+    elif org_type in org_boundaries.ORG_TYPES:
+        features = org_boundaries.get_features(
+            org_type, org_codes, _get_tolerance(request)
+        )
+        if features is not None:
+            return HttpResponse(
+                as_geojson_feature_stream(features), content_type="application/json"
+            )
+        results = org_boundaries.get_boundaries(org_type, org_codes)
     else:
         raise ValueError("Unknown org_type: {}".format(org_type))
     return HttpResponse(as_geojson_stream(results), content_type="application/json")
 
 
+def org_location_tile(request, org_type, z, x, y):
+    """
+    Return a Mapbox Vector Tile of the boundaries of all organisations of the
+    given type
+    """
+    org_type = utils.translate_org_type(org_type)
+    if org_type not in org_tiles.ORG_TYPES or not org_tiles.is_valid_tile(z, x, y):
+        raise Http404
+    content = org_tiles.get_tile(org_type, z, x, y)
+    return HttpResponse(content, content_type=org_tiles.CONTENT_TYPE)
+
+
+def _get_tolerance(request):
+    """
+    Return the tolerance, in degrees, to which boundaries may be simplified,
+    given either directly or as the zoom level of the map they will be drawn
+    on.  By default boundaries are not simplified.
+    """
+    try:
+        if "tolerance" in request.GET:
+            return float(request.GET["tolerance"])
+        if "zoom" in request.GET:
+            return org_boundaries.tolerance_for_zoom(float(request.GET["zoom"]))
+    except ValueError:
+        raise ValidationError("tolerance and zoom must be numbers")
+    return 0.0
+
+
 def _get_practices(org_codes, centroids):
     org_codes = utils.get_practice_ids_from_org(org_codes)
     results = Practice.objects.filter(code__in=org_codes)
     return results.values("name", "code", "setting", geometry=F("location"))
 
 
-def _get_ccgs(org_codes, centroids):
-    results = PCT.objects.filter(close_date__isnull=True, org_type="CCG")
-    if org_codes:
-        results = results.filter(code__in=org_codes)
+def _get_ccg_centroids(org_codes):
+    results = org_boundaries.get_orgs("ccg", org_codes)
     return results.values(
-        "name",
-        "code",
-        "ons_code",
-        "org_type",
-        geometry=F("centroid" if centroids else "boundary"),
+        "name", "code", "ons_code", "org_type", geometry=F("centroid")
     )
-
-
-def _get_pcns(org_codes, centroids):
-    results = PCN.objects.active()
-    if org_codes:
-        results = results.filter(
-            Q(code__in=org_codes) | Q(practice__ccg_id__in=org_codes)
-        )
-    return results.values("name", "code", geometry=Union("practice__boundary"))
-
-
-def _get_stps(org_codes, centroids):
-    results = STP.objects.all()
-    if org_codes:
-        results = results.filter(code__in=org_codes)
-    return results.values("name", "code", geometry=Union("pct__boundary"))
-
-
-def _get_regional_teams(org_codes, centroids):
-    results = RegionalTeam.objects.active()
-    if org_codes:
-        results = results.filter(code__in=org_codes)
-    return results.values("name", "code", geometry=Union("pct__boundary"))
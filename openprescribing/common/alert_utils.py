@@ -1,5 +1,10 @@
 import logging
+import os
+import pickle
+import shutil
 import sys
+import tempfile
+import threading
 import traceback
 
 logger = logging.getLogger(__name__)
@@ -34,15 +39,18 @@ class EmailErrorDeferrer(object):
     def __init__(self, max_errors=3):
         self.exceptions = []
         self.max_errors = max_errors
+        # `try_email` may be called from several threads at once
+        self.lock = threading.Lock()
 
     def try_email(self, callback, *args):
         try:
             callback(*args)
         except Exception as e:
-            self.exceptions.append(sys.exc_info())
             logger.exception(e)
-            if len(self.exceptions) > self.max_errors:
-                raise BatchedEmailErrors(self.exceptions)
+            with self.lock:
+                self.exceptions.append(sys.exc_info())
+                if len(self.exceptions) > self.max_errors:
+                    raise BatchedEmailErrors(list(self.exceptions))
 
     def __enter__(self):
         return self
@@ -51,3 +59,65 @@ class EmailErrorDeferrer(object):
         if self.exceptions:
             exception = BatchedEmailErrors(self.exceptions)
             raise exception
+
+
+class AlertRunCache(object):
+    """Stores values computed while sending a batch of alerts, so that each is
+    computed only once however many alerts use it, and so that a batch which
+    is interrupted can be resumed without recomputing them.
+
+    Values are pickled to a file per key in a directory for the batch (e.g.
+    the month being alerted on).  If `cache_dir` is None values are only held
+    in memory.
+    """
+
+    def __init__(self, batch, cache_dir):
+        self.batch = batch
+        self.cache_dir = cache_dir
+        self.values = {}
+        self.lock = threading.Lock()
+
+    @property
+    def path(self):
+        return os.path.join(self.cache_dir, self.batch)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.values:
+                return self.values[key]
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._get_file_path(key), "rb") as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            self.values[key] = value
+        return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = value
+            if self.cache_dir is None:
+                return
+            # Serialise the value while holding the lock, so that we write a
+            # consistent snapshot of it
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        # Write to a temporary file and then rename it so that an interrupted
+        # write never leaves a truncated value behind
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._get_file_path(key))
+
+    def clear(self):
+        """Delete the values for this batch, leaving any other batches alone"""
+        with self.lock:
+            self.values = {}
+        if self.cache_dir is not None and os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+    def _get_file_path(self, key):
+        return os.path.join(self.path, "{}.pickle".format(key))
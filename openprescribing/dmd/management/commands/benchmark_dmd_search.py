@@ -0,0 +1,74 @@
+"""
+Reports p50 and p95 latencies for dm+d searches for common drug names.
+
+Each query is run with the default search options used by the dm+d search
+form: all object types, excluding invalid and unavailable objects and objects
+without a BNF code.
+"""
+
+import statistics
+import time
+
+from django.core.management import BaseCommand
+from dmd.search import search
+
+DEFAULT_QUERIES = [
+    "paracetamol",
+    "amoxicillin",
+    "atorvastatin",
+    "omeprazole",
+    "metformin",
+    "amlodipine",
+    "salbutamol",
+    "sertraline",
+    "ramipril",
+    "levothyroxine",
+    "lansoprazole",
+    "ibuprofen",
+    "co-codamol",
+    "100mg tablets",
+    "insulin",
+    "0212000B0",
+]
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "queries", nargs="*", help="Queries to run (default: common drug names)"
+        )
+        parser.add_argument(
+            "--repeats", type=int, default=10, help="Times to run each query"
+        )
+
+    def handle(self, *args, **kwargs):
+        queries = kwargs["queries"] or DEFAULT_QUERIES
+        repeats = kwargs["repeats"]
+        all_timings = []
+
+        for q in queries:
+            timings = [self.time_search(q) for _ in range(repeats)]
+            all_timings.extend(timings)
+            self.report(q, timings)
+
+        self.report("all queries", all_timings)
+
+    def time_search(self, q):
+        start = time.perf_counter()
+        search(q=q, obj_types=[], include=[])
+        return (time.perf_counter() - start) * 1000
+
+    def report(self, label, timings):
+        self.stdout.write(
+            "{:<20} p50: {:8.1f}ms  p95: {:8.1f}ms".format(
+                label, percentile(timings, 50), percentile(timings, 95)
+            )
+        )
+
+
+def percentile(values, p):
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
@@ -1,6 +1,12 @@
 import csv
 import glob
+import itertools
+import multiprocessing
 import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 
 from django.apps import apps
@@ -21,6 +27,25 @@ from openpyxl import load_workbook
 from openprescribing.slack import notify_slack
 from openprescribing.utils import mkdir_p
 
+# Depth of object elements in files that contain a single list of objects (eg
+# <INGREDIENT_SUBSTANCES><ING>...</ING></INGREDIENT_SUBSTANCES>) and in files
+# that contain several lists (eg <VIRTUAL_MED_PRODUCTS><VMPS><VMP>...</VMP>...)
+OBJ_DEPTH = 2
+OBJ_DEPTH_IN_LISTS = 3
+
+# Fragments of the names of the dm+d XML files, in the order that they must be
+# imported
+FILENAME_FRAGMENTS = [
+    "lookup",
+    "ingredient",
+    "vtm",
+    "vmp",
+    "vmpp",
+    "amp",
+    "ampp",
+    "gtin",
+]
+
 
 class Command(BaseCommand):
     def handle(self, *args, **kwargs):
@@ -42,18 +67,59 @@ class Command(BaseCommand):
         ]
         self.logs = {key: list() for key in self.log_keys}
 
+        self.parse_workers = kwargs["parse_workers"]
+        self.timings = []
+
         with transaction.atomic():
             self.import_dmd()
-            self.import_bnf_code_mapping()
-            self.set_vmp_bnf_codes()
-            self.set_dmd_names()
+            with self.timed("import_bnf_code_mapping"):
+                self.import_bnf_code_mapping()
+            with self.timed("set_vmp_bnf_codes"):
+                self.set_vmp_bnf_codes()
+            with self.timed("set_dmd_names"):
+                self.set_dmd_names()
             self.create_import_log()
 
-        self.upload_to_bq()
-        self.log_other_oddities()
-        self.write_logs()
+        # Uploading to BigQuery only reads from the database, so it can happen
+        # while we check the data for oddities and write the logs.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            upload = executor.submit(self.upload_to_bq_in_thread)
+            with self.timed("log_other_oddities"):
+                self.log_other_oddities()
+            with self.timed("write_logs"):
+                self.write_logs()
+            upload.result()
+
+        self.report_timings()
         self.notify_slack()
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--parse-workers",
+            type=int,
+            default=None,
+            help="Number of processes for parsing XML files (default: number of CPUs)",
+        )
+
+    @contextmanager
+    def timed(self, stage):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timings.append((stage, time.monotonic() - start))
+
+    def report_timings(self):
+        for stage, duration in self.timings:
+            self.stdout.write("{:<40} {:8.2f}s".format(stage, duration))
+
+    def upload_to_bq_in_thread(self):
+        try:
+            with self.timed("upload_to_bq"):
+                self.upload_to_bq()
+        finally:
+            connection.close()
+
     def import_dmd(self):
         # dm+d data is provided in several XML files:
         #
@@ -117,226 +183,65 @@ class Command(BaseCommand):
         # before it can be imported.  See code below.
         #
         # Since the data model contains foreign key constraints, the order we
-        # import the files is significant.
+        # import the files is significant.  (The constraints are deferred until
+        # the end of the transaction, but we delete existing instances as we
+        # go, and deleting an instance deletes any instances that refer to it.)
         #
         # When importing the data, we first delete all existing instances,
         # because the IDs of some SNOMED objects can change.
+        #
+        # The files are large, so rather than parsing each file into a tree we
+        # stream through it, converting each object's element to a row and
+        # discarding it as soon as it has been read.  Each file is converted to
+        # one CSV file per model in a separate process, and the CSV files are
+        # loaded into the database in the order given by FILENAME_FRAGMENTS as
+        # soon as they are ready.
 
-        # lookup
-        for elements in self.load_elements("lookup"):
-            model_name = self.make_model_name(elements.tag)
-            model = getattr(models, model_name)
-            self.import_model(model, elements)
-
-        # ingredient
-        elements = self.load_elements("ingredient")
-        self.import_model(models.Ing, elements)
-
-        # vtm
-        elements = self.load_elements("vtm")
-        self.import_model(models.VTM, elements)
-
-        # vmp
-        for elements in self.load_elements("vmp"):
-            model_name = self.make_model_name(elements[0].tag)
-            model = getattr(models, model_name)
-            self.import_model(model, elements)
-
-        # vmpp
-        for elements in self.load_elements("vmpp"):
-            if elements[0].tag == "CCONTENT":
-                # We don't yet handle the CCONTENT tag, which indicates that a
-                # VMPP is part of a combination pack, where two VMPPs are
-                # always prescribed together.
-                continue
-
-            model_name = self.make_model_name(elements[0].tag)
-            model = getattr(models, model_name)
-            self.import_model(model, elements)
-
-        # amp
-        for elements in self.load_elements("amp"):
-            if len(elements) == 0:
-                # For test data, some lists of elements are empty (eg
-                # AP_INFORMATION), and so we can't look at the first element of
-                # the list to get the name of the corresponding model.
-                continue
-
-            model_name = self.make_model_name(elements[0].tag)
-            model = getattr(models, model_name)
-            self.import_model(model, elements)
-
-        # ampp
-        for elements in self.load_elements("ampp"):
-            if len(elements) == 0:
-                # For test data, some lists of elements are empty (eg
-                # APPLIANCE_PACK_INFO), and so we can't look at the first
-                # element of the list to get the name of the corresponding
-                # model.
-                continue
-
-            if elements[0].tag == "CCONTENT":
-                # We don't yet handle the CCONTENT tag, which indicates that a
-                # AMPP is part of a combination pack, where two AMPPs are
-                # always prescribed together.
-                continue
-
-            model_name = self.make_model_name(elements[0].tag)
-            model = getattr(models, model_name)
-            self.import_model(model, elements)
+        with connection.cursor() as cursor:
+            cursor.execute("SET CONSTRAINTS ALL DEFERRED")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with ProcessPoolExecutor(
+                max_workers=self.parse_workers,
+                mp_context=multiprocessing.get_context("fork"),
+            ) as executor:
+                futures = {
+                    filename_fragment: executor.submit(
+                        convert_xml_file,
+                        self.get_xml_path(filename_fragment),
+                        filename_fragment,
+                        tmp_dir,
+                    )
+                    for filename_fragment in FILENAME_FRAGMENTS
+                }
 
-        # gtin
-        for elements in self.load_gtin_elements():
-            self.import_model(models.GTIN, elements)
+                for filename_fragment in FILENAME_FRAGMENTS:
+                    csv_paths, duration = futures[filename_fragment].result()
+                    self.timings.append(("parse " + filename_fragment, duration))
 
-    def load_elements(self, filename_fragment):
-        """Return list of non-comment top-level elements in given file."""
+                    for model_name, csv_path in csv_paths:
+                        model = getattr(models, model_name)
+                        with self.timed("load " + model_name):
+                            self.import_model(model, csv_path)
 
+    def get_xml_path(self, filename_fragment):
         paths = glob.glob(
             os.path.join(self.dmd_data_path, "f_{}2_*.xml".format(filename_fragment))
         )
         assert len(paths) == 1
+        return paths[0]
 
-        with open(paths[0]) as f:
-            doc = etree.parse(f)
-
-        root = doc.getroot()
-        elements = list(root)
-        assert isinstance(elements[0], etree._Comment)
-        return elements[1:]
-
-    def load_gtin_elements(self):
-        # We have to handle GTINs differently.  The XSLT transforms something like:
-        #
-        # <GTIN_DETAILS>
-        #   <AMPPS>
-        #     <AMPP>
-        #       <AMPPID>1714711000001106</AMPPID>
-        #       <GTINDATA>
-        #         <GTIN>8712400158572</GTIN>
-        #         <STARTDT>2010-02-01</STARTDT>
-        #         <ENDDT>2013-07-21</ENDDT>
-        #       </GTINDATA>
-        #       <GTINDATA>
-        #         <GTIN>8712400360258</GTIN>
-        #         <STARTDT>2013-07-22</STARTDT>
-        #       </GTINDATA>
-        #     </AMPP>
-        #     ...
-        #   </AMPPS>
-        # </GTIN_DETAILS>
-        #
-        # to:
-        #
-        # <GTINS_DETAILS>
-        #   <GTINS>
-        #     <GTIN>
-        #       <GTIN>8712400158572</GTIN>
-        #       <APPID>1714711000001106</APPID>
-        #       <STARTDT>2010-02-01</STARTDT>
-        #       <ENDDT>2013-07-21</ENDDT>
-        #     </GTIN>
-        #     <GTIN>
-        #       <GTIN>8712400360258</GTIN>
-        #       <APPID>1714711000001106</APPID>
-        #       <STARTDT>2013-07-22</STARTDT>
-        #       <ENDDT/>
-        #     </GTIN>
-        #     ...
-        #   </GTINS>
-        # </GTINS_DETAILS>
-        #
-        # This matches the structure of all the other XML files.
-
-        paths = glob.glob(os.path.join(self.dmd_data_path, "f_gtin2_*.xml"))
-        assert len(paths) == 1
-
-        with open(paths[0]) as f:
-            doc = etree.parse(f)
-
-        xslt = etree.fromstring(
-            """
-            <xsl:stylesheet xmlns:xsl="http://www.w3.org/1999/XSL/Transform" version="1.0">
-                <xsl:output method="xml" indent="yes"/>
-
-                <xsl:template match="/GTIN_DETAILS">
-                    <GTINS_DETAILS>
-                        <GTINS>
-                            <xsl:apply-templates select="AMPPS/AMPP/GTINDATA"/>
-                        </GTINS>
-                    </GTINS_DETAILS>
-                </xsl:template>
-
-                <xsl:template match="GTINDATA">
-                    <GTIN>
-                        <GTIN><xsl:value-of select="GTIN" /></GTIN>
-                        <APPID><xsl:value-of select="../AMPPID" /></APPID>
-                        <STARTDT><xsl:value-of select="STARTDT" /></STARTDT>
-                        <ENDDT><xsl:value-of select="ENDDT" /></ENDDT>
-                    </GTIN>
-                </xsl:template>
-            </xsl:stylesheet>
-        """
-        )
-        transform = etree.XSLT(xslt)
-
-        return list(transform(doc).getroot())
-
-    def import_model(self, model, elements):
-        """Import model instances from list of XML elements."""
+    def import_model(self, model, csv_path):
+        """Import model instances from CSV file written by convert_xml_file()."""
 
         model.objects.all().delete()
 
-        boolean_field_names = [
-            f.name
-            for f in model._meta.fields
-            if isinstance(f, django_fields.BooleanField)
-        ]
-
-        table_name = model._meta.db_table
-        column_names = [
-            f.db_column or f.name
-            for f in model._meta.fields
-            if not isinstance(f, django_fields.AutoField)
-        ]
-        sql = "INSERT INTO {} ({}) VALUES ({})".format(
-            table_name, ", ".join(column_names), ", ".join(["%s"] * len(column_names))
+        sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(
+            model._meta.db_table, ", ".join(get_column_names(model))
         )
 
-        values = []
-
-        for element in elements:
-            row = {}
-
-            for field_element in element:
-                name = field_element.tag.lower()
-                if name == "desc":
-                    # "desc" is a really unhelpful field name if you're writing
-                    # SQL!
-                    name = "descr"
-                elif name == "dnd":
-                    # For consistency with the rest of the data, we rename
-                    # "dnd" to "dndcd", as it is a foreign key field.
-                    name = "dndcd"
-
-                value = field_element.text
-                row[name] = value
-
-            for name in boolean_field_names:
-                row[name] = name in row
-
-            values.append([row.get(name) for name in column_names])
-
-        with connection.cursor() as cursor:
-            cursor.executemany(sql, values)
-
-    def make_model_name(self, tag_name):
-        """Construct name of Django model from XML tag name."""
-
-        if tag_name in ["VTM", "VPI", "VMP", "VMPP", "AMP", "AMPP", "GTIN"]:
-            return tag_name
-        else:
-            return "".join(tok.title() for tok in tag_name.split("_"))
+        with open(csv_path) as f, connection.cursor() as cursor:
+            cursor.copy_expert(sql, f)
 
     def import_bnf_code_mapping(self):
         type_to_model = {"VMP": VMP, "AMP": AMP, "VMPP": VMPP, "AMPP": AMPP}
@@ -750,6 +655,199 @@ class Command(BaseCommand):
         notify_slack(msg)
 
 
+def convert_xml_file(path, filename_fragment, output_dir):
+    """Convert objects in dm+d XML file to CSV files suitable for loading with
+    COPY, one per model.
+
+    This runs in a worker process, and so must not touch the database.
+
+    Returns a tuple of (list of (model name, CSV path), duration in seconds).
+    """
+
+    start = time.monotonic()
+
+    if filename_fragment == "gtin":
+        groups = [("GTIN", load_gtin_rows(path))]
+    else:
+        groups = iter_model_rows(path, filename_fragment)
+
+    csv_paths = []
+
+    for model_name, rows in groups:
+        model = getattr(models, model_name)
+        convert = make_row_converter(model)
+        csv_path = os.path.join(output_dir, model_name + ".csv")
+
+        with open(csv_path, "w") as f:
+            # In CSV format, COPY reads unquoted empty fields as NULL
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerows(map(convert, rows))
+
+        csv_paths.append((model_name, csv_path))
+
+    return csv_paths, time.monotonic() - start
+
+
+def iter_model_rows(path, filename_fragment):
+    """Yield (model name, rows) for each list of elements in given file."""
+
+    if filename_fragment in ["ingredient", "vtm"]:
+        obj_depth = OBJ_DEPTH
+    else:
+        obj_depth = OBJ_DEPTH_IN_LISTS
+
+    rows = load_rows(path, obj_depth)
+
+    for (list_tag, tag), group in itertools.groupby(rows, key=lambda r: r[:2]):
+        if tag == "CCONTENT":
+            # We don't yet handle the CCONTENT tag, which indicates that a VMPP
+            # or AMPP is part of a combination pack, where two VMPPs or AMPPs
+            # are always prescribed together.
+            continue
+
+        if filename_fragment == "lookup":
+            # The lookup file contains lists of <INFO> elements, and the model
+            # for each list is given by the list's tag.
+            model_name = make_model_name(list_tag)
+        else:
+            model_name = make_model_name(tag)
+
+        yield model_name, (row for _, _, row in group)
+
+
+def load_rows(path, obj_depth):
+    """Yield (list tag, tag, row) for each object in given file, where row is a
+    dict mapping the tags of the object's fields to their values.
+
+    obj_depth is the depth in the document at which objects are found (the root
+    element has depth 1).  Lists of elements that are empty (which happens in
+    test data) yield nothing.
+    """
+
+    for element in iter_elements_at_depth(path, obj_depth):
+        row = {
+            field_element.tag: field_element.text
+            for field_element in element
+            if isinstance(field_element.tag, str)
+        }
+        yield element.getparent().tag, element.tag, row
+
+
+def load_gtin_rows(path):
+    # We have to handle GTINs differently.  We transform something like:
+    #
+    # <GTIN_DETAILS>
+    #   <AMPPS>
+    #     <AMPP>
+    #       <AMPPID>1714711000001106</AMPPID>
+    #       <GTINDATA>
+    #         <GTIN>8712400158572</GTIN>
+    #         <STARTDT>2010-02-01</STARTDT>
+    #         <ENDDT>2013-07-21</ENDDT>
+    #       </GTINDATA>
+    #       <GTINDATA>
+    #         <GTIN>8712400360258</GTIN>
+    #         <STARTDT>2013-07-22</STARTDT>
+    #       </GTINDATA>
+    #     </AMPP>
+    #     ...
+    #   </AMPPS>
+    # </GTIN_DETAILS>
+    #
+    # to rows like:
+    #
+    # {"GTIN": "8712400158572", "APPID": "1714711000001106",
+    #  "STARTDT": "2010-02-01", "ENDDT": "2013-07-21"}
+    # {"GTIN": "8712400360258", "APPID": "1714711000001106",
+    #  "STARTDT": "2013-07-22", "ENDDT": None}
+    #
+    # This matches the rows yielded by load_rows() for other files.
+
+    for element in iter_elements_at_depth(path, OBJ_DEPTH_IN_LISTS):
+        appid = element.findtext("AMPPID")
+        for gtindata in element.iterfind("GTINDATA"):
+            yield {
+                "GTIN": gtindata.findtext("GTIN"),
+                "APPID": appid,
+                "STARTDT": gtindata.findtext("STARTDT"),
+                "ENDDT": gtindata.findtext("ENDDT"),
+            }
+
+
+def iter_elements_at_depth(path, depth):
+    """Yield each element at given depth in XML document at path.
+
+    Each element is cleared (along with any preceding siblings) once the caller
+    has finished with it, so that memory use doesn't grow with the size of the
+    document.
+    """
+
+    current_depth = 0
+
+    for event, element in etree.iterparse(path, events=("start", "end")):
+        if event == "start":
+            current_depth += 1
+            continue
+
+        if current_depth == depth:
+            yield element
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+        current_depth -= 1
+
+
+def make_model_name(tag_name):
+    """Construct name of Django model from XML tag name."""
+
+    if tag_name in ["VTM", "VPI", "VMP", "VMPP", "AMP", "AMPP", "GTIN"]:
+        return tag_name
+    else:
+        return "".join(tok.title() for tok in tag_name.split("_"))
+
+
+def get_column_names(model):
+    return [
+        f.db_column or f.name
+        for f in model._meta.fields
+        if not isinstance(f, django_fields.AutoField)
+    ]
+
+
+def make_row_converter(model):
+    """Return function that converts a dict mapping XML tags to values into a
+    list of values for the model's columns."""
+
+    boolean_field_names = [
+        f.name for f in model._meta.fields if isinstance(f, django_fields.BooleanField)
+    ]
+    column_names = get_column_names(model)
+
+    def convert(xml_row):
+        row = {}
+
+        for tag, value in xml_row.items():
+            name = tag.lower()
+            if name == "desc":
+                # "desc" is a really unhelpful field name if you're writing
+                # SQL!
+                name = "descr"
+            elif name == "dnd":
+                # For consistency with the rest of the data, we rename "dnd" to
+                # "dndcd", as it is a foreign key field.
+                name = "dndcd"
+
+            row[name] = value
+
+        for name in boolean_field_names:
+            row[name] = name in row
+
+        return [row.get(name) for name in column_names]
+
+    return convert
+
+
 def get_common_name(names):
     """Find left substring common to all names, by splitting names on spaces,
     and possibly ignoring certain common words.
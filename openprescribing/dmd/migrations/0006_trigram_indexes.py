@@ -0,0 +1,96 @@
+import django.contrib.postgres.indexes
+import django.db.models.functions.text
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("dmd", "0005_auto_20220930_1025"),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddIndex(
+            model_name="vtm",
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.indexes.OpClass(
+                    django.db.models.functions.text.Upper("nm"), name="gin_trgm_ops"
+                ),
+                name="dmd_vtm_nm_trgm",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="vmp",
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.indexes.OpClass(
+                    django.db.models.functions.text.Upper("nm"), name="gin_trgm_ops"
+                ),
+                name="dmd_vmp_nm_trgm",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="vmp",
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.indexes.OpClass(
+                    models.F("bnf_code"), name="gin_trgm_ops"
+                ),
+                name="dmd_vmp_bnf_code_trgm",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="vmpp",
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.indexes.OpClass(
+                    django.db.models.functions.text.Upper("nm"), name="gin_trgm_ops"
+                ),
+                name="dmd_vmpp_nm_trgm",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="vmpp",
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.indexes.OpClass(
+                    models.F("bnf_code"), name="gin_trgm_ops"
+                ),
+                name="dmd_vmpp_bnf_code_trgm",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="amp",
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.indexes.OpClass(
+                    django.db.models.functions.text.Upper("descr"), name="gin_trgm_ops"
+                ),
+                name="dmd_amp_descr_trgm",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="amp",
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.indexes.OpClass(
+                    models.F("bnf_code"), name="gin_trgm_ops"
+                ),
+                name="dmd_amp_bnf_code_trgm",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="ampp",
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.indexes.OpClass(
+                    django.db.models.functions.text.Upper("nm"), name="gin_trgm_ops"
+                ),
+                name="dmd_ampp_nm_trgm",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="ampp",
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.indexes.OpClass(
+                    models.F("bnf_code"), name="gin_trgm_ops"
+                ),
+                name="dmd_ampp_bnf_code_trgm",
+            ),
+        ),
+    ]
@@ -1,13 +1,32 @@
+from django.contrib.postgres.indexes import GinIndex, OpClass
 from django.db import models
+from django.db.models import F
+from django.db.models.functions import Upper
 
 from . import managers
 
 
+def trigram_index(model_name, field_name, ignore_case=True):
+    """Return an index supporting the substring and prefix matches made by
+    DMDObjectQuerySet.search().
+
+    Name fields are matched with icontains, so we index the uppercased field.
+    BNF codes are stored in uppercase and matched with startswith.
+    """
+
+    expression = Upper(field_name) if ignore_case else F(field_name)
+    return GinIndex(
+        OpClass(expression, name="gin_trgm_ops"),
+        name="dmd_{}_{}_trgm".format(model_name, field_name),
+    )
+
+
 class VTM(models.Model):
     class Meta:
         verbose_name = "Virtual Therapeutic Moiety"
         verbose_name_plural = "Virtual Therapeutic Moieties"
         ordering = ["nm"]
+        indexes = [trigram_index("vtm", "nm")]
 
     objects = managers.VTMManager()
 
@@ -40,6 +59,10 @@ class VMP(models.Model):
     class Meta:
         verbose_name = "Virtual Medicinal Product"
         ordering = ["nm"]
+        indexes = [
+            trigram_index("vmp", "nm"),
+            trigram_index("vmp", "bnf_code", ignore_case=False),
+        ]
 
     objects = managers.VMPManager()
 
@@ -272,6 +295,10 @@ class AMP(models.Model):
     class Meta:
         verbose_name = "Actual Medicinal Product"
         ordering = ["descr"]
+        indexes = [
+            trigram_index("amp", "descr"),
+            trigram_index("amp", "bnf_code", ignore_case=False),
+        ]
 
     objects = managers.AMPManager()
 
@@ -428,6 +455,10 @@ class VMPP(models.Model):
     class Meta:
         verbose_name = "Virtual Medicinal Product Pack"
         ordering = ["nm"]
+        indexes = [
+            trigram_index("vmpp", "nm"),
+            trigram_index("vmpp", "bnf_code", ignore_case=False),
+        ]
 
     objects = managers.VMPPManager()
 
@@ -501,6 +532,10 @@ class AMPP(models.Model):
     class Meta:
         verbose_name = "Actual Medicinal Product Pack"
         ordering = ["nm"]
+        indexes = [
+            trigram_index("ampp", "nm"),
+            trigram_index("ampp", "bnf_code", ignore_case=False),
+        ]
 
     objects = managers.AMPPManager()
 
@@ -1,5 +1,11 @@
+import itertools
+import operator
 from urllib.parse import urlencode
 
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import connection
+from django.db.models import Case, Q, Value, When
+from django.db.models.functions import Upper
 from django.urls import reverse
 from frontend.utils.bnf_hierarchy import simplify_bnf_codes
 
@@ -9,6 +15,16 @@ from .models import AMP, AMPP, VMP, VMPP, VTM
 
 NUM_RESULTS_PER_OBJ_TYPE = 10
 
+# Number of results on each page of advanced search results
+PAGE_SIZE = 1000
+
+# If the query planner estimates that an advanced search will return more than
+# this many results, we report its estimate rather than counting them exactly
+EXACT_COUNT_LIMIT = 10000
+
+# The order in which results for each type of object are presented
+SEARCH_CLASSES = [VTM, VMP, VMPP, AMP, AMPP]
+
 
 def search(q, obj_types, include):
     results = search_by_term(q, obj_types, include)
@@ -20,9 +36,17 @@ def search(q, obj_types, include):
 
 
 def search_by_term(q, obj_types, include):
-    results = []
+    """Return objects of each type whose name contains q, or whose BNF code
+    starts with q.
 
-    for cls in [VTM, VMP, VMPP, AMP, AMPP]:
+    All object types are searched in a single query, which is supported by the
+    trigram indexes created in migration 0006.  Within each type, objects whose
+    name starts with q come first, followed by the remaining objects in order of
+    decreasing similarity to q.
+    """
+    querysets = []
+
+    for ix, cls in enumerate(SEARCH_CLASSES):
         if obj_types and cls.obj_type not in obj_types:
             continue
 
@@ -35,11 +59,31 @@ def search_by_term(q, obj_types, include):
             qs = qs.with_bnf_code()
         qs = qs.search(q)
 
-        objs = list(qs)
-        if objs:
-            results.append({"cls": cls, "objs": objs})
+        name = Upper(cls.name_field)
+        qs = qs.annotate(
+            cls_ix=Value(ix),
+            is_prefix_match=Case(
+                When(**{cls.name_field + "__istartswith": q, "then": 1}),
+                default=0,
+            ),
+            similarity=TrigramSimilarity(name, q.upper()),
+            sort_name=name,
+        )
+        querysets.append(
+            qs.order_by().values_list(
+                "cls_ix", "id", "is_prefix_match", "similarity", "sort_name"
+            )
+        )
+
+    if not querysets:
+        return []
 
-    return results
+    rows = (
+        querysets[0]
+        .union(*querysets[1:], all=True)
+        .order_by("cls_ix", "-is_prefix_match", "-similarity", "sort_name")
+    )
+    return _load_results([(cls_ix, id) for cls_ix, id, *_ in rows])
 
 
 def search_by_snomed_code(q):
@@ -48,15 +92,27 @@ def search_by_snomed_code(q):
     except ValueError:
         return []
 
-    for cls in [VTM, VMP, VMPP, AMP, AMPP]:
-        try:
-            obj = cls.objects.get(pk=q)
-        except cls.DoesNotExist:
-            continue
+    querysets = [
+        cls.objects.filter(pk=q).annotate(cls_ix=Value(ix)).values_list("cls_ix", "id")
+        for ix, cls in enumerate(SEARCH_CLASSES)
+    ]
+    rows = querysets[0].union(*querysets[1:], all=True).order_by("cls_ix")[:1]
+    return _load_results(list(rows))
+
+
+def _load_results(rows):
+    """Given a list of (class index, id) pairs, ordered by class index, return a
+    list of dicts of {"cls": cls, "objs": objs}, with objs in the given order.
+    """
+    results = []
 
-        return [{"cls": cls, "objs": [obj]}]
+    for cls_ix, group in itertools.groupby(rows, key=operator.itemgetter(0)):
+        cls = SEARCH_CLASSES[cls_ix]
+        ids = [id for _, id in group]
+        objs_by_id = cls.objects.in_bulk(ids)
+        results.append({"cls": cls, "objs": [objs_by_id[id] for id in ids]})
 
-    return []
+    return results
 
 
 def search_by_gtin(q):
@@ -73,7 +129,9 @@ def search_by_gtin(q):
     return [{"cls": AMPP, "objs": [obj]}]
 
 
-def advanced_search(cls, search, include):
+def advanced_search(
+    cls, search, include, after=None, num_ids=None, page_size=PAGE_SIZE
+):
     """Perform a search against all dm+d objects of a particular type.
 
     Parameters:
@@ -83,16 +141,65 @@ def advanced_search(cls, search, include):
         search: a tree describing the search to be performed, submitted when user
                 performs the search (see TestAdvancedSearchHelpers for an example)
         include: a list of strings taken from: ["invalid", "unavailable", "no_bnf_code"]
+      after: ID of the last object on the previous page of results, if any
+      num_ids: value of `num_ids` returned with the first page of results, which
+               is passed through to later pages so that we don't have to find
+               the BNF codes of all results on every page
+      page_size: maximum number of objects to return
 
     Returns dict with the following keys:
 
-      objs: queryset of results
+      objs: list of up to page_size results, ordered by name and then ID
       rules: structure used to populate a QueryBuilder instance (see
              https://querybuilder.js.org/#method-setRules)
-      too_many_results: flag indicating whether more than 10,000 results were returned
+      num_results: total number of results
+      num_results_is_estimate: flag indicating whether num_results is the query
+                               planner's estimate rather than an exact count
+      next_page_after: value of `after` for the next page of results, or None if
+                       this is the last page
+      num_ids: comma-separated BNF codes/prefixes of all results, or None if
+               there are too many BNF codes to build an analyse URL
+      analyse_url: URL for analysing prescribing of all results, or None if
+                   there are too many BNF codes to build one
     """
 
     rules = build_rules(search)
+    qs = advanced_search_queryset(cls, search, include)
+
+    page_qs = qs.order_by(cls.name_field, "id")
+    if after is not None:
+        page_qs = _filter_after(page_qs, cls, after)
+    objs = list(page_qs[: page_size + 1])
+
+    if len(objs) > page_size:
+        objs = objs[:page_size]
+        next_page_after = objs[-1].id
+    else:
+        next_page_after = None
+
+    if after is None and next_page_after is None:
+        # All the results fit on one page, so we already know how many there are
+        num_results, num_results_is_estimate = len(objs), False
+    else:
+        num_results, num_results_is_estimate = _count_results(qs)
+
+    if after is None:
+        num_ids = _get_analyse_num_ids(qs)
+
+    return {
+        "objs": objs,
+        "rules": rules,
+        "num_results": num_results,
+        "num_results_is_estimate": num_results_is_estimate,
+        "next_page_after": next_page_after,
+        "num_ids": num_ids,
+        "analyse_url": _build_analyse_url(num_ids),
+    }
+
+
+def advanced_search_queryset(cls, search, include):
+    """Return unordered queryset of all objects matching an advanced search."""
+
     query_obj = build_query_obj(cls, search)
 
     qs = cls.objects
@@ -103,38 +210,79 @@ def advanced_search(cls, search, include):
     if "no_bnf_code" not in include:
         qs = qs.with_bnf_code()
 
-    # 10,000 is an arbitrary cut off.  We should do pagination properly.
-    objs = qs.filter(query_obj)[:10001]
+    return qs.filter(query_obj).order_by()
 
-    if len(objs) == 10001:
-        too_many_results = True
-        objs = objs[:10000]
-        analyse_url = None
-    else:
-        too_many_results = False
-        analyse_url = _build_analyse_url(objs)
 
-    return {
-        "objs": objs,
-        "rules": rules,
-        "too_many_results": too_many_results,
-        "analyse_url": analyse_url,
-    }
+def _filter_after(qs, cls, after):
+    """Filter ordered queryset to objects that come after the object with ID
+    `after`, using the (name, id) key that results are ordered by.
 
+    If there's no such object (eg because it was removed by a dm+d import since
+    the previous page was rendered) we start again from the first page.
+    """
 
-def _build_analyse_url(objs):
-    bnf_codes = [obj.bnf_code for obj in objs if obj.bnf_code]
-    params = {
-        "numIds": ",".join(simplify_bnf_codes(bnf_codes)),
-        "denom": "total_list_size",
-    }
+    name = cls.objects.filter(id=after).values_list(cls.name_field, flat=True).first()
+    if name is None:
+        return qs
 
-    querystring = urlencode(params)
-    url = "{}#{}".format(reverse("analyse"), querystring)
+    return qs.filter(
+        Q(**{cls.name_field + "__gt": name})
+        | Q(**{cls.name_field: name, "id__gt": after})
+    )
+
+
+def _count_results(qs):
+    """Return (count, is_estimate) for queryset.
+
+    Counting a large result set means visiting every matching row, so if the
+    planner estimates that there are more than EXACT_COUNT_LIMIT rows, we return
+    its estimate instead.
+    """
+
+    estimate = _estimate_count(qs)
+    if estimate > EXACT_COUNT_LIMIT:
+        return estimate, True
+    return qs.count(), False
+
+
+def _estimate_count(qs):
+    """Return the planner's estimate of the number of rows returned by queryset,
+    which is derived from the statistics Postgres keeps about each table."""
 
-    if len(url) > 5000:
+    sql, params = qs.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+    return plan[0]["Plan"]["Plan Rows"]
+
+
+def _get_analyse_num_ids(qs):
+    """Return comma-separated BNF codes/prefixes covering all objects matching
+    queryset, or None if there are too many to build an analyse URL.
+    """
+
+    # We let the database find the distinct BNF codes of all matching objects,
+    # so that we never need to load the objects themselves.
+    bnf_codes = (
+        qs.filter(bnf_code__isnull=False)
+        .order_by("bnf_code")
+        .values_list("bnf_code", flat=True)
+        .distinct()
+    )
+    num_ids = ",".join(simplify_bnf_codes(list(bnf_codes)))
+
+    if len(_build_analyse_url(num_ids)) > 5000:
         # Anything longer than 5000 characters takes too long to load.  This
         # matches the behaviour of import_measures.build_analyse_url().
         return
 
-    return url
+    return num_ids
+
+
+def _build_analyse_url(num_ids):
+    if num_ids is None:
+        return
+
+    params = {"numIds": num_ids, "denom": "total_list_size"}
+    querystring = urlencode(params)
+    return "{}#{}".format(reverse("analyse"), querystring)
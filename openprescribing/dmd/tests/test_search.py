@@ -2,14 +2,18 @@ from urllib.parse import parse_qs
 
 from django.db.models import Q
 from django.test import TestCase
+from dmd import search as search_module
 from dmd.build_rules import build_rules
 from dmd.build_search_query import build_query_obj
-from dmd.models import AMP, AMPP, VMP, VMPP
+from dmd.models import AMP, AMPP, VMP, VMPP, VTM
 from dmd.search import advanced_search, search
 from matrixstore.tests.contextmanagers import (
     patched_global_matrixstore_from_data_factory,
 )
 from matrixstore.tests.data_factory import DataFactory
+from mock import patch
+
+ALL_INCLUDE = ["invalid", "unavailable", "no_bnf_code"]
 
 
 class TestSearch(TestCase):
@@ -100,6 +104,28 @@ class TestSearch(TestCase):
             {},
         )
 
+    def test_results_ordered_by_obj_type(self):
+        results = search(q="acebutolol", obj_types=[], include=[])
+        self.assertEqual(
+            [result["cls"] for result in results], [VTM, VMP, VMPP, AMP, AMPP]
+        )
+
+    def test_prefix_matches_ranked_first(self):
+        results = search(q="a", obj_types=["amp"], include=ALL_INCLUDE)
+        objs = results[0]["objs"]
+        self.assertEqual(len(objs), 7)
+        # Every AMP apart from Sectral has a description starting with
+        # "Acebutolol"
+        self.assertEqual(objs[-1].pk, 632811000001105)
+
+    def test_similar_matches_ranked_first(self):
+        results = search(q="100mg capsules", obj_types=["amp"], include=ALL_INCLUDE)
+        objs = results[0]["objs"]
+        self.assertEqual(len(objs), 7)
+        # Sectral has the shortest description, and so is most similar to the
+        # query
+        self.assertEqual(objs[0].pk, 632811000001105)
+
     def assertSearchResults(self, search_params, exp_result_ids):
         kwargs = {"q": "", "obj_types": ["vmp", "vmpp", "amp", "ampp"], "include": []}
         kwargs.update(search_params)
@@ -129,7 +155,9 @@ class TestAdvancedSearch(TestCase):
         with patched_global_matrixstore_from_data_factory(factory):
             results = advanced_search(AMP, search, ["unavailable"])
 
-        self.assertFalse(results["too_many_results"])
+        self.assertEqual(results["num_results"], 2)
+        self.assertFalse(results["num_results_is_estimate"])
+        self.assertIsNone(results["next_page_after"])
         self.assertCountEqual(
             results["objs"],
             AMP.objects.filter(pk__in=[10347111000001100, 4814811000001108]),
@@ -140,6 +168,65 @@ class TestAdvancedSearch(TestCase):
             params, {"numIds": ["0204000C0AA"], "denom": ["total_list_size"]}
         )
 
+    def test_advanced_search_pagination(self):
+        search = ["nm", "contains", "acebutolol"]
+        expected_ids = list(
+            AMP.objects.filter(nm__icontains="acebutolol")
+            .order_by("descr", "id")
+            .values_list("id", flat=True)
+        )
+        self.assertEqual(len(expected_ids), 6)
+
+        factory = DataFactory()
+        ids = []
+        after = None
+        with patched_global_matrixstore_from_data_factory(factory):
+            while True:
+                results = advanced_search(
+                    AMP, search, ALL_INCLUDE, after=after, page_size=4
+                )
+                self.assertEqual(results["num_results"], 6)
+                ids.extend(obj.id for obj in results["objs"])
+                after = results["next_page_after"]
+                if after is None:
+                    break
+
+        self.assertEqual(ids, expected_ids)
+
+    def test_advanced_search_builds_analyse_url_on_first_page_only(self):
+        search = ["nm", "contains", "acebutolol"]
+
+        factory = DataFactory()
+        factory.create_prescribing_for_bnf_codes(["0204000C0AAAAAA"])
+        with patched_global_matrixstore_from_data_factory(factory):
+            with patch(
+                "dmd.search.simplify_bnf_codes", wraps=search_module.simplify_bnf_codes
+            ) as simplify_bnf_codes:
+                first_page = advanced_search(AMP, search, ALL_INCLUDE, page_size=4)
+                second_page = advanced_search(
+                    AMP,
+                    search,
+                    ALL_INCLUDE,
+                    after=first_page["next_page_after"],
+                    num_ids=first_page["num_ids"],
+                    page_size=4,
+                )
+
+        self.assertEqual(simplify_bnf_codes.call_count, 1)
+        self.assertIsNotNone(first_page["analyse_url"])
+        self.assertEqual(second_page["analyse_url"], first_page["analyse_url"])
+
+    def test_advanced_search_estimates_large_counts(self):
+        search = ["nm", "contains", "acebutolol"]
+
+        factory = DataFactory()
+        with patched_global_matrixstore_from_data_factory(factory):
+            with patch("dmd.search.EXACT_COUNT_LIMIT", 0):
+                results = advanced_search(AMP, search, ALL_INCLUDE, page_size=4)
+
+        self.assertTrue(results["num_results_is_estimate"])
+        self.assertGreater(results["num_results"], 0)
+
 
 class TestAdvancedSearchHelpers(TestCase):
     search = [
@@ -2,23 +2,25 @@
 
 import colorsys
 import csv
+import itertools
 import json
 from copy import copy
 from urllib.parse import urlencode
 
 from django.core.exceptions import ObjectDoesNotExist
 from django.db.models import ForeignKey, fields
-from django.http import Http404, HttpResponse, JsonResponse
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
 from frontend.models import ImportLog, Presentation, TariffPrice
 from matrixstore.db import get_db
+from rest_framework_csv.misc import Echo
 
 from .build_search_filters import build_search_filters
 from .forms import AdvancedSearchForm, SearchForm
 from .models import AMP, AMPP, VMP, VMPP
 from .obj_types import cls_to_obj_type, obj_type_to_cls
-from .search import advanced_search, search
+from .search import advanced_search, advanced_search_queryset, search
 from .view_schema import schema as view_schema
 
 
@@ -306,33 +308,33 @@ def _annotate_search_results(results, search_params, max_results_per_obj_type):
 def advanced_search_view(request, obj_type):
     cls = obj_type_to_cls[obj_type]
 
-    objs = None
+    results = None
     rules = None
-    too_many_results = False
-    analyse_url = None
 
     if "search" in request.GET:
         form = AdvancedSearchForm(request.GET)
         if form.is_valid():
             search = json.loads(form.cleaned_data["search"])
             include = form.cleaned_data["include"]
-            results = advanced_search(cls, search, include)
-            objs = results["objs"]
-            rules = results["rules"]
-            too_many_results = results["too_many_results"]
-            analyse_url = results["analyse_url"]
             if request.GET.get("format") == "csv":
-                response = HttpResponse(content_type="text/csv")
-                response["Content-Disposition"] = (
-                    'attachment; filename="openprescribing-dmd-search.csv"'
-                )
-                writer = csv.writer(response)
-                writer.writerow([f"{obj_type}_id", "name", "bnf_code", "invalid"])
-                writer.writerows(
-                    [obj.id, obj.title(), obj.bnf_code, 1 if obj.invalid else 0]
-                    for obj in objs
-                )
-                return response
+                return _advanced_search_csv_response(cls, search, include)
+            results = advanced_search(
+                cls,
+                search,
+                include,
+                after=_get_int_param(request, "after"),
+                num_ids=request.GET.get("numIds"),
+            )
+            rules = results["rules"]
+            if results["next_page_after"] is not None:
+                params = request.GET.copy()
+                params["after"] = results["next_page_after"]
+                # Later pages reuse the BNF codes found for the first page
+                if results["num_ids"] is None:
+                    params.pop("numIds", None)
+                else:
+                    params["numIds"] = results["num_ids"]
+                results["next_page_url"] = request.path + "?" + params.urlencode()
     else:
         form = AdvancedSearchForm()
 
@@ -340,16 +342,48 @@ def advanced_search_view(request, obj_type):
         "obj_type": obj_type,
         "obj_type_human_plural": cls._meta.verbose_name_plural,
         "form": form,
-        "objs": objs,
+        "results": results,
         "rules": rules,
-        "too_many_results": too_many_results,
-        "analyse_url": analyse_url,
         "obj_types": ["vmp", "amp", "vmpp", "ampp"],
     }
     ctx.update(_release_metadata())
     return render(request, "dmd/advanced-search.html", ctx)
 
 
+def _advanced_search_csv_response(cls, search, include):
+    """Return all results of an advanced search as CSV.
+
+    Rows are streamed from the database, so the number of results is not
+    limited by memory.
+    """
+
+    qs = advanced_search_queryset(cls, search, include).order_by(cls.name_field, "id")
+    rows = qs.values_list("id", cls.name_field, "bnf_code", "invalid").iterator()
+
+    writer = csv.writer(Echo())
+    header = [f"{cls.obj_type}_id", "name", "bnf_code", "invalid"]
+    lines = itertools.chain(
+        [writer.writerow(header)],
+        (
+            writer.writerow([id, name, bnf_code, 1 if invalid else 0])
+            for id, name, bnf_code, invalid in rows
+        ),
+    )
+
+    response = StreamingHttpResponse(lines, content_type="text/csv")
+    response["Content-Disposition"] = (
+        'attachment; filename="openprescribing-dmd-search.csv"'
+    )
+    return response
+
+
+def _get_int_param(request, name):
+    try:
+        return int(request.GET[name])
+    except (KeyError, ValueError):
+        return None
+
+
 def search_filters_view(request, obj_type):
     """Return filters to build a QueryBuilder form for given obj_type.
 
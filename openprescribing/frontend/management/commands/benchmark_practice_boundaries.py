@@ -0,0 +1,121 @@
+"""
+Compares the time taken to infer practice boundaries from scratch with the
+time taken to update them incrementally after a few practices have opened,
+closed or moved.
+
+Runs against a synthetic national dataset of practices placed at random
+within the national boundary.  Everything happens inside a transaction which
+is rolled back at the end, so no data is changed.
+"""
+
+import random
+import time
+
+from django.contrib.gis.geos import Point
+from django.core.management import BaseCommand
+from django.db import transaction
+from frontend.management.commands import infer_practice_boundaries as inference
+from frontend.models import Practice
+
+# Roughly the number of GP practices in England
+DEFAULT_NUM_PRACTICES = 6500
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--practices",
+            type=int,
+            default=DEFAULT_NUM_PRACTICES,
+            help="Number of synthetic practices",
+        )
+        parser.add_argument(
+            "--changes",
+            type=int,
+            default=10,
+            help="Number of practices to open, and to close, and to move",
+        )
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **kwargs):
+        self.random = random.Random(kwargs["seed"])
+        self.national_boundary = inference.get_national_boundary()
+        with transaction.atomic():
+            self.run_benchmark(kwargs["practices"], kwargs["changes"])
+            transaction.set_rollback(True)
+
+    def run_benchmark(self, num_practices, num_changes):
+        # Hide any real practices from `get_practices`
+        Practice.objects.update(setting=-1, boundary_location=None)
+        Practice.objects.bulk_create(
+            [self.make_practice(n) for n in range(num_practices)], batch_size=1000
+        )
+
+        self.time("full rebuild", inference.get_all_practice_boundaries)
+
+        codes = list(inference.get_practices().values_list("code", flat=True))
+        closed, moved = [self.random.sample(codes, num_changes) for _ in range(2)]
+        Practice.objects.filter(code__in=closed).update(
+            status_code=Practice.STATUS_CLOSED
+        )
+        for code in moved:
+            Practice.objects.filter(code=code).update(location=self.random_location())
+        Practice.objects.bulk_create(
+            [
+                self.make_practice(n)
+                for n in range(num_practices, num_practices + num_changes)
+            ]
+        )
+
+        boundaries = self.time(
+            "incremental update",
+            inference.get_changed_practice_boundaries,
+            change_limit=1.0,
+        )
+        self.stdout.write(
+            "{} of {} boundaries recomputed incrementally".format(
+                len(boundaries), num_practices
+            )
+        )
+
+        expected, _ = inference.get_all_practice_boundaries()
+        mismatched = [
+            code
+            for code, boundary in boundaries.items()
+            if boundary.sym_difference(expected[code]).area > 1e-9
+        ]
+        self.stdout.write(
+            "{} incrementally computed boundaries differ from full rebuild".format(
+                len(mismatched)
+            )
+        )
+
+    def time(self, label, fn, **kwargs):
+        start = time.perf_counter()
+        boundaries, removed_codes = fn(**kwargs)
+        inference.write_practice_boundaries(boundaries, removed_codes)
+        self.stdout.write("{:<20} {:8.2f}s".format(label, time.perf_counter() - start))
+        return boundaries
+
+    def make_practice(self, n):
+        return Practice(
+            code="Z{:05d}".format(n),
+            name="Synthetic practice {}".format(n),
+            setting=4,
+            status_code="A",
+            location=self.random_location(),
+        )
+
+    def random_location(self):
+        xmin, ymin, xmax, ymax = self.national_boundary.extent
+        prepared = self.national_boundary.prepared
+        while True:
+            point = Point(
+                self.random.uniform(xmin, xmax),
+                self.random.uniform(ymin, ymax),
+                srid=4326,
+            )
+            if prepared.contains(point):
+                return point
@@ -0,0 +1,18 @@
+import textwrap
+
+from api import typeahead_index
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = textwrap.dedent(
+        """
+        Builds a new version of the index used by the org_code and bnf_code
+        typeahead APIs, and makes it live. See `api.typeahead_index` for more
+        detail.
+        """
+    )
+
+    def handle(self, *args, **options):
+        path = typeahead_index.build_index()
+        self.stdout.write("Built typeahead index at {}".format(path))
@@ -6,6 +6,7 @@ into our data fetching pipeline.
 https://github.com/ebmdatalab/fetch-boundaries
 """
 
+from api.org_boundaries import update_org_boundaries
 from django.contrib.gis.db.models.functions import Centroid
 from django.contrib.gis.utils import LayerMapping
 from django.core.management.base import BaseCommand
@@ -37,3 +38,4 @@ class Command(BaseCommand):
                     boundary=fields["boundary"]
                 )
             set_centroids()
+            update_org_boundaries()
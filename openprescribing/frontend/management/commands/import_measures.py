@@ -20,13 +20,21 @@ from datetime import datetime
 from pathlib import Path
 from urllib.parse import urlencode
 
+from api import measure_cache
+from api.views_measures import populate_measure_cache
 from common import utils
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
 from django.core.management import BaseCommand
 from django.db import connection, transaction
 from django.urls import reverse
-from frontend.models import ImportLog, Measure, MeasureGlobal, MeasureValue
+from frontend.models import (
+    ImportLog,
+    Measure,
+    MeasureAggregate,
+    MeasureGlobal,
+    MeasureValue,
+)
 from frontend.utils.bnf_hierarchy import get_all_bnf_codes, simplify_bnf_codes
 from gcutils.bigquery import Client
 from google.api_core.exceptions import BadRequest
@@ -119,6 +127,22 @@ class Command(BaseCommand):
                     "Elapsed time for %s: %s seconds" % (measure_id, elapsed.seconds)
                 )
 
+        # This needs to happen after the indices on MeasureValue have been
+        # rebuilt
+        if not options["definitions_only"] and not options["bigquery_only"]:
+            logger.info("Writing measure aggregates")
+            write_measure_aggregates(
+                [measure_def["id"] for measure_def in measure_defs]
+            )
+
+        # Any change to measure definitions or values invalidates the cached
+        # API responses, but we only go to the trouble of repopulating them
+        # after a full import
+        measure_cache.record_import(end_date)
+        if drop_and_rebuild_indices:
+            logger.info("Populating measure API cache")
+            populate_measure_cache()
+
     def handle(self, *args, **options):
         start = datetime.now()
 
@@ -975,6 +999,24 @@ class MeasureCalculation(object):
         return val
 
 
+def write_measure_aggregates(measure_ids):
+    """Sum the MeasureValues for the given measures over each org type, by
+    month, so that aggregate API requests don't need to do this on the fly.
+    """
+    with transaction.atomic():
+        MeasureAggregate.objects.filter(measure_id__in=measure_ids).delete()
+        for org_type in ["practice", "pcn", "ccg", "stp", "regional_team"]:
+            measure_values = (
+                MeasureValue.objects.filter(measure_id__in=measure_ids)
+                .filter_by_org_type(org_type)
+                .aggregate_by_measure_and_month()
+            )
+            MeasureAggregate.objects.bulk_create(
+                MeasureAggregate.from_measure_value(org_type, mv)
+                for mv in measure_values
+            )
+
+
 @contextmanager
 def conditional_constraint_and_index_reconstructor(enabled):
     if not enabled:
@@ -8,30 +8,65 @@ practices.
 
 The boundaries are clipped at the national border to stop them extending into
 the sea -- or Wales -- and generally looking ridiculous.
+
+With --incremental, only the boundaries of practices which have opened, closed
+or moved since the last run, and of their neighbours, are recomputed.  A
+practice's Voronoi cell depends only on the practices adjacent to it in the
+Delaunay triangulation, so we find these neighbours both before and after the
+change and compute the partition of just these practices and their neighbours.
 """
 
 import os
 import random
 import string
 
+import numpy
+from api.org_boundaries import update_org_boundaries
 from django.conf import settings
 from django.contrib.gis.db.models import Collect, Union
-from django.contrib.gis.geos import GEOSException, GEOSGeometry, MultiPolygon, Polygon
+from django.contrib.gis.geos import (
+    GEOSException,
+    GEOSGeometry,
+    MultiPoint,
+    MultiPolygon,
+    Point,
+    Polygon,
+)
 from django.core.management.base import BaseCommand
 from django.db import connection, transaction
-from django.db.models import Func
 from frontend.models import PCT, Practice
+from scipy.spatial import Delaunay, QhullError
 
 NATIONAL_BOUNDARY_FILE = os.path.join(
     settings.REPO_ROOT, "openprescribing/media/geojson/england-boundary.geojson"
 )
 
+# If more than this proportion of practice locations have changed, an
+# incremental update does a full rebuild instead as it's unlikely to be faster
+INCREMENTAL_CHANGE_LIMIT = 0.05
+
+# Margin, in degrees, between the national boundary and the extent of the
+# Voronoi partition.  The partition must have the same extent however many
+# practices it's computed from, so that cells on its edge are the same in full
+# and incremental builds.
+EXTENT_MARGIN = 1.0
+
 
 class Command(BaseCommand):
     help = __doc__
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="Only recompute boundaries of practices which have changed",
+        )
+
     def handle(self, *args, **options):
-        infer_practice_boundaries()
+        if options["incremental"]:
+            infer_changed_practice_boundaries()
+        else:
+            infer_practice_boundaries()
 
 
 def get_practices():
@@ -45,16 +80,171 @@ def get_practices():
 
 
 def infer_practice_boundaries():
-    practices = get_practices()
-    partition = practices.aggregate(
-        voronoi=Func(Collect("location"), function="ST_VoronoiPolygons")
-    )["voronoi"]
+    with transaction.atomic():
+        write_practice_boundaries(*get_all_practice_boundaries())
+        update_org_boundaries()
+
+
+def infer_changed_practice_boundaries(change_limit=INCREMENTAL_CHANGE_LIMIT):
+    with transaction.atomic():
+        changes = get_changed_practice_boundaries(change_limit)
+        if write_practice_boundaries(*changes):
+            update_org_boundaries()
+
+
+def get_all_practice_boundaries():
+    """
+    Return a dict mapping the code of every practice to its boundary, and a
+    list of the codes of practices which previously had boundaries but no
+    longer should
+    """
     national_boundary = get_national_boundary()
+    sites = get_practices().aggregate(sites=Collect("location"))["sites"]
+    partition = get_voronoi_partition(sites, national_boundary)
     practice_regions = get_practice_code_to_region_map(partition, national_boundary)
-    with transaction.atomic():
-        for practice in practices:
-            practice.boundary = practice_regions[practice.code]
-            practice.save(update_fields=["boundary"])
+    codes = get_practices().values_list("code", flat=True)
+    boundaries = {code: practice_regions[code] for code in codes}
+    removed_codes = list(
+        Practice.objects.filter(boundary_location__isnull=False)
+        .exclude(code__in=codes)
+        .values_list("code", flat=True)
+    )
+    return boundaries, removed_codes
+
+
+def get_changed_practice_boundaries(change_limit):
+    """
+    As `get_all_practice_boundaries`, but only including practices whose
+    boundaries may have changed since they were last computed
+
+    Falls back to computing all boundaries if they have never been computed, or
+    if too many practices have changed for an incremental update to be
+    worthwhile.
+    """
+    current = dict(get_practices().values_list("code", "location"))
+    previous = dict(
+        Practice.objects.filter(boundary_location__isnull=False).values_list(
+            "code", "boundary_location"
+        )
+    )
+    if not previous:
+        return get_all_practice_boundaries()
+
+    current_coords = {code: location.coords for code, location in current.items()}
+    previous_coords = {code: location.coords for code, location in previous.items()}
+    added_coords = set()
+    removed_coords = set()
+    for code in current_coords.keys() | previous_coords.keys():
+        if current_coords.get(code) != previous_coords.get(code):
+            if code in current_coords:
+                added_coords.add(current_coords[code])
+            if code in previous_coords:
+                removed_coords.add(previous_coords[code])
+    removed_codes = previous_coords.keys() - current_coords.keys()
+    if not added_coords and not removed_coords:
+        return {}, list(removed_codes)
+
+    sites = sorted(set(current_coords.values()))
+    previous_sites = sorted(set(previous_coords.values()))
+    if len(added_coords | removed_coords) > change_limit * len(sites):
+        return get_all_practice_boundaries()
+    try:
+        neighbours = get_delaunay_neighbours(sites)
+        previous_neighbours = get_delaunay_neighbours(previous_sites)
+    except QhullError:
+        # This happens if there are too few practices to triangulate
+        return get_all_practice_boundaries()
+
+    # A practice's cell changes if a practice adjacent to it either before or
+    # after the change has opened, closed or moved
+    affected_coords = set(added_coords)
+    for coords in added_coords:
+        affected_coords.update(neighbours[coords])
+    for coords in removed_coords:
+        affected_coords.update(previous_neighbours[coords])
+    affected_coords.intersection_update(neighbours.keys())
+
+    # To compute the cells of the affected practices we need all of their
+    # neighbours, though we discard the (incorrect) cells of the neighbours
+    input_coords = set(affected_coords)
+    for coords in affected_coords:
+        input_coords.update(neighbours[coords])
+
+    national_boundary = get_national_boundary()
+    partition = get_voronoi_partition(
+        MultiPoint([Point(coords) for coords in sorted(input_coords)], srid=4326),
+        national_boundary,
+    )
+    affected_points = [Point(coords, srid=4326) for coords in affected_coords]
+    regions = [
+        region
+        for region in partition
+        if any(region.prepared.contains(point) for point in affected_points)
+    ]
+    practice_regions = get_practice_code_to_region_map(regions, national_boundary)
+    boundaries = {
+        code: practice_regions[code]
+        for code, coords in current_coords.items()
+        if coords in affected_coords
+    }
+    return boundaries, list(removed_codes)
+
+
+def get_delaunay_neighbours(sites):
+    """
+    Return a dict mapping each of `sites` (a list of unique coordinate pairs)
+    to the set of sites adjacent to it in their Delaunay triangulation
+    """
+    triangulation = Delaunay(numpy.array(sites))
+    indptr, indices = triangulation.vertex_neighbor_vertices
+    return {
+        site: {sites[j] for j in indices[indptr[i] : indptr[i + 1]]}
+        for i, site in enumerate(sites)
+    }
+
+
+def get_voronoi_partition(sites, national_boundary):
+    """
+    Return the Voronoi partition of the given MultiPoint, with cells on its
+    edge bounded by a fixed extent around the national boundary
+    """
+    extent = national_boundary.envelope.buffer(EXTENT_MARGIN).envelope
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT ST_VoronoiPolygons(ST_GeomFromEWKB(%s), 0.0, ST_GeomFromEWKB(%s))",
+            [bytes(sites.ewkb), bytes(extent.ewkb)],
+        )
+        return GEOSGeometry(cursor.fetchone()[0])
+
+
+def write_practice_boundaries(boundaries, removed_codes):
+    """
+    Save the given boundaries, along with the locations from which they were
+    computed, skipping any which are unchanged, and forget the locations of
+    removed practices
+
+    Returns the number of practices updated.
+    """
+    practices = Practice.objects.filter(code__in=boundaries.keys())
+    to_update = []
+    for practice in practices.only("code", "location", "boundary", "boundary_location"):
+        boundary = boundaries[practice.code]
+        if (
+            practice.boundary is None
+            or practice.boundary_location is None
+            or not practice.boundary.equals_exact(boundary)
+            or practice.boundary_location.coords != practice.location.coords
+        ):
+            practice.boundary = boundary
+            practice.boundary_location = practice.location
+            to_update.append(practice)
+    Practice.objects.bulk_update(
+        to_update, ["boundary", "boundary_location"], batch_size=1000
+    )
+    num_removed = Practice.objects.filter(code__in=removed_codes).update(
+        boundary_location=None
+    )
+    return len(to_update) + num_removed
 
 
 def get_practice_code_to_region_map(regions, clip_boundary):
@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
 import logging
 import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
-from common.alert_utils import EmailErrorDeferrer
+from common.alert_utils import AlertRunCache, EmailErrorDeferrer
+from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
 from django.db.models import Q
 from frontend.models import (
     PCN,
@@ -99,6 +105,23 @@ class Command(BaseCommand):
             help="Max number of permitted errors before aborting the batch",
             default=3,
         )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help=(
+                "Number of threads to use for rendering and sending emails. "
+                "Stats for each organisation are always computed once, up front"
+            ),
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help=(
+                "Compute stats and render every email, but don't record or "
+                "send anything, and report on throughput"
+            ),
+        )
 
     def get_org_bookmarks(self, now_month, **options):
         """Get all OrgBookmarks for active users who have not been sent a
@@ -187,24 +210,85 @@ class Command(BaseCommand):
                 "You must specify either a URL, or one of a ccg or a practice"
             )
 
-    def send_org_bookmark_email(self, org_bookmark, now_month, options):
+    def get_org(self, org_bookmark, options):
         if org_bookmark.practice or options["practice"]:
-            org = org_bookmark.practice or Practice.objects.get(pk=options["practice"])
+            return org_bookmark.practice or Practice.objects.get(pk=options["practice"])
         elif org_bookmark.pct or options["ccg"]:
-            org = org_bookmark.pct or PCT.objects.get(pk=options["ccg"])
+            return org_bookmark.pct or PCT.objects.get(pk=options["ccg"])
         elif org_bookmark.pcn or options["pcn"]:
-            org = org_bookmark.pcn or PCN.objects.get(pk=options["pcn"])
+            return org_bookmark.pcn or PCN.objects.get(pk=options["pcn"])
         elif org_bookmark.stp or options["stp"]:
-            org = org_bookmark.stp or STP.objects.get(pk=options["stp"])
+            return org_bookmark.stp or STP.objects.get(pk=options["stp"])
         else:
             assert False
-        if getattr(org, "close_date", None):
-            self.log_info("Skipping sending alert for closed org %s" % org.pk)
+
+    def get_context_keys_by_org(self, org_bookmarks, options, deferrer):
+        """Return a list of (org_bookmark, key) pairs for the bookmarks that
+        should be sent, where `key` identifies the org's email context in
+        `self.cache`, and the number of distinct orgs.
+
+        Many users subscribe to alerts about the same org, and the stats and
+        charts are the same for each of them, so we only compute them once per
+        org, before any emails are rendered.  They're cached on disk so that if
+        the command is interrupted it can be re-run without computing them
+        again.
+        """
+        bookmarks_and_keys = []
+        keys_by_org = {}
+        for org_bookmark in org_bookmarks:
+            org = self.get_org(org_bookmark, options)
+            if getattr(org, "close_date", None):
+                self.log_info("Skipping sending alert for closed org %s" % org.pk)
+                continue
+            if org not in keys_by_org:
+                keys_by_org[org] = "{}-{}".format(type(org).__name__.lower(), org.pk)
+                deferrer.try_email(self.compute_context, org, keys_by_org[org])
+            # If we failed to compute stats for the org the error has been
+            # recorded, and there's nothing to send
+            if self.cache.get(keys_by_org[org]) is not None:
+                bookmarks_and_keys.append((org_bookmark, keys_by_org[org]))
+        return bookmarks_and_keys, len(keys_by_org)
+
+    def compute_context(self, org, key):
+        if self.cache.get(key) is not None:
+            self.counts["cached_orgs"] += 1
             return
-        stats = bookmark_utils.InterestingMeasureFinder(org).context_for_org_email()
+        start = time.time()
+        finder = bookmark_utils.InterestingMeasureFinder(org)
+        stats = finder.context_for_org_email()
+        charts = bookmark_utils.render_org_email_charts(org, stats)
+        self.cache.set(key, {"stats": stats, "charts": charts})
+        self.timings["stats"] += time.time() - start
+
+    def send_org_bookmark_emails(self, org_bookmarks, now_month, options, deferrer):
+        bookmarks_and_keys, num_orgs = self.get_context_keys_by_org(
+            org_bookmarks, options, deferrer
+        )
+        self.counts["org_bookmarks"] += len(bookmarks_and_keys)
+        self.counts["orgs"] += num_orgs
+        self.run_in_pool(
+            [
+                (self.send_org_bookmark_email, org_bookmark, key)
+                for org_bookmark, key in bookmarks_and_keys
+            ],
+            now_month,
+            options,
+            deferrer,
+        )
 
+    def send_org_bookmark_email(self, org_bookmark, key, now_month, options):
         try:
-            msg = bookmark_utils.make_org_email(org_bookmark, stats, tag=now_month)
+            context = self.cache.get(key)
+            # The context is shared between threads, so we pass a copy of the
+            # charts, which have all been rendered already
+            msg = bookmark_utils.make_org_email(
+                org_bookmark,
+                context["stats"],
+                tag=now_month,
+                charts=dict(context["charts"]),
+            )
+            if options["dry_run"]:
+                return
             msg = EmailMessage.objects.create_from_message(msg)
             msg.send()
             self.log_info(
@@ -212,13 +296,29 @@ class Command(BaseCommand):
             )
         except bookmark_utils.BadAlertImageError as e:
             self.log_info(f"Failed to send {org_bookmark!r}")
-            self.error_count += 1
-            self.log_exception(e)
+            self.record_error(e)
 
-    def send_search_bookmark_email(self, search_bookmark, now_month):
+    def send_search_bookmark_emails(
+        self, search_bookmarks, now_month, options, deferrer
+    ):
+        search_bookmarks = list(search_bookmarks)
+        self.counts["search_bookmarks"] += len(search_bookmarks)
+        self.run_in_pool(
+            [
+                (self.send_search_bookmark_email, search_bookmark)
+                for search_bookmark in search_bookmarks
+            ],
+            now_month,
+            options,
+            deferrer,
+        )
+
+    def send_search_bookmark_email(self, search_bookmark, now_month, options):
         try:
             recipient_id = search_bookmark.user.id
             msg = bookmark_utils.make_search_email(search_bookmark, tag=now_month)
+            if options["dry_run"]:
+                return
             msg = EmailMessage.objects.create_from_message(msg)
             msg.send()
             self.log_info(
@@ -227,8 +327,60 @@ class Command(BaseCommand):
             )
         except bookmark_utils.BadAlertImageError as e:
             self.log_info(f"Failed to send {search_bookmark!r}")
-            self.error_count += 1
-            self.log_exception(e)
+            self.record_error(e)
+
+    def run_in_pool(self, tasks, now_month, options, deferrer):
+        """Call each of `tasks`, a list of (callback, *args) tuples, with
+        `now_month` and `options` as extra arguments, in a pool of
+        `options["workers"]` threads.
+
+        Rendering an email is dominated by database and MatrixStore queries,
+        so threads give us useful parallelism.
+        """
+        start = time.time()
+        if options["workers"] > 1:
+
+            def run(task):
+                try:
+                    deferrer.try_email(*task, now_month, options)
+                finally:
+                    # Each thread has its own connection, which would
+                    # otherwise be left open
+                    connection.close()
+
+            with ThreadPoolExecutor(max_workers=options["workers"]) as pool:
+                # Consume the results so that exceptions raised in the
+                # workers (e.g. by the deferrer) are re-raised here
+                for _ in pool.map(run, tasks):
+                    pass
+        else:
+            for task in tasks:
+                deferrer.try_email(*task, now_month, options)
+        self.timings["emails"] += time.time() - start
+
+    def report_throughput(self):
+        emails = self.counts["org_bookmarks"] + self.counts["search_bookmarks"]
+        self.log_info(
+            "Computed stats for %s orgs in %.1fs (%s more found in cache)"
+            % (
+                self.counts["orgs"] - self.counts["cached_orgs"],
+                self.timings["stats"],
+                self.counts["cached_orgs"],
+            )
+        )
+        self.log_info(
+            "Rendered %s emails (%s org, %s search) in %.1fs"
+            % (
+                emails,
+                self.counts["org_bookmarks"],
+                self.counts["search_bookmarks"],
+                self.timings["emails"],
+            )
+        )
+        if self.timings["emails"]:
+            self.log_info(
+                "Throughput: %.2f emails/s" % (emails / self.timings["emails"])
+            )
 
     def send_all_england_alerts(self, options):
         # The `send_all_england_alerts` command doesn't respect the same set of
@@ -245,6 +397,8 @@ class Command(BaseCommand):
             "force_color",
             "max_errors",
             "skip_checks",
+            "workers",
+            "dry_run",
         ]:
             set_options.pop(key, None)
         # We do understand this one, so keep a record of its value
@@ -267,20 +421,57 @@ class Command(BaseCommand):
             .lower()
         )
         self.error_count = 0
-        self.send_all_england_alerts(options)
+        # Guards `error_count`, which is updated by worker threads
+        self.lock = threading.Lock()
+        self.counts = defaultdict(int)
+        self.timings = defaultdict(float)
+        self.cache = AlertRunCache(now_month, settings.ALERT_CACHE_DIR)
+        if options["dry_run"]:
+            self.log_info("Dry run: not sending All England alerts")
+        else:
+            self.send_all_england_alerts(options)
         with EmailErrorDeferrer(int(options["max_errors"])) as error_deferrer:
-            for org_bookmark in self.get_org_bookmarks(now_month, **options):
-                error_deferrer.try_email(
-                    self.send_org_bookmark_email, org_bookmark, now_month, options
-                )
-
-            for search_bookmark in self.get_search_bookmarks(now_month, **options):
-                error_deferrer.try_email(
-                    self.send_search_bookmark_email, search_bookmark, now_month
-                )
+            self.send_org_bookmark_emails(
+                self.get_org_bookmarks(now_month, **options),
+                now_month,
+                options,
+                error_deferrer,
+            )
+            self.send_search_bookmark_emails(
+                self.get_search_bookmarks(now_month, **options),
+                now_month,
+                options,
+                error_deferrer,
+            )
+        if options["dry_run"]:
+            self.report_throughput()
         if self.error_count > 0:
             self.log_info(f"Failed to send {self.error_count} emails")
             sys.exit(1)
+        # Everything has been sent, so there's nothing to resume.  Dry runs and
+        # test sends only cover some alerts, so the cache is kept for the real
+        # run.
+        if not options["dry_run"] and not self.is_test_send(options):
+            self.cache.clear()
+
+    def is_test_send(self, options):
+        return any(
+            options[key]
+            for key in [
+                "recipient_email",
+                "recipient_email_file",
+                "ccg",
+                "practice",
+                "pcn",
+                "stp",
+                "url",
+            ]
+        )
+
+    def record_error(self, exc):
+        with self.lock:
+            self.error_count += 1
+        self.log_exception(exc)
 
     def log_info(self, msg):
         logger.info(msg)
@@ -0,0 +1,17 @@
+import textwrap
+
+from api import org_boundaries
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = textwrap.dedent(
+        """
+        Precomputes the simplified, serialized boundaries served by the
+        org_location API.  This happens automatically whenever boundaries are
+        imported or inferred. See `api.org_boundaries` for more detail.
+        """
+    )
+
+    def handle(self, *args, **options):
+        org_boundaries.update_org_boundaries()
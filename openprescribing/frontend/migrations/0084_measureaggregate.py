@@ -0,0 +1,105 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+CENTILES = ["10", "20", "30", "40", "50", "60", "70", "80", "90"]
+
+# Conditions matching MeasureValueQuerySet.filter_by_org_type
+ORG_TYPE_CONDITIONS = {
+    "practice": "mv.practice_id IS NOT NULL",
+    "pcn": ("mv.pcn_id IS NOT NULL AND mv.practice_id IS NULL AND mv.pct_id IS NULL"),
+    "ccg": (
+        "mv.practice_id IS NULL AND mv.pct_id IS NOT NULL"
+        " AND pct.org_type = 'CCG' AND pct.close_date IS NULL"
+    ),
+    "stp": "mv.stp_id IS NOT NULL AND mv.pct_id IS NULL AND mv.practice_id IS NULL",
+    "regional_team": (
+        "mv.regional_team_id IS NOT NULL AND mv.pct_id IS NULL"
+        " AND mv.practice_id IS NULL"
+    ),
+}
+
+
+def populate_sql(org_type):
+    """
+    Populate the new table from existing MeasureValues, so that aggregate
+    requests work before the next run of `import_measures`
+    """
+    cost_savings_columns = ", ".join("cost_savings_{}".format(c) for c in CENTILES)
+    cost_savings_sums = ", ".join(
+        "SUM(GREATEST((mv.cost_savings ->> '{}')::float, 0.0))".format(c)
+        for c in CENTILES
+    )
+    return """
+    INSERT INTO frontend_measureaggregate (
+        measure_id, org_type, month, numerator, denominator, calc_value,
+        {cost_savings_columns}
+    )
+    SELECT
+        mv.measure_id,
+        '{org_type}',
+        mv.month,
+        SUM(mv.numerator),
+        SUM(mv.denominator),
+        COALESCE(SUM(mv.numerator), 0.0) / NULLIF(SUM(mv.denominator), 0.0),
+        {cost_savings_sums}
+    FROM frontend_measurevalue mv
+    LEFT JOIN frontend_pct pct ON pct.code = mv.pct_id
+    WHERE {condition}
+    GROUP BY mv.measure_id, mv.month
+    """.format(
+        cost_savings_columns=cost_savings_columns,
+        org_type=org_type,
+        cost_savings_sums=cost_savings_sums,
+        condition=ORG_TYPE_CONDITIONS[org_type],
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("frontend", "0083_measure_radar_exclude"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MeasureAggregate",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("org_type", models.CharField(max_length=20)),
+                ("month", models.DateField()),
+                ("numerator", models.FloatField(blank=True, null=True)),
+                ("denominator", models.FloatField(blank=True, null=True)),
+                ("calc_value", models.FloatField(blank=True, null=True)),
+                ("cost_savings_10", models.FloatField(blank=True, null=True)),
+                ("cost_savings_20", models.FloatField(blank=True, null=True)),
+                ("cost_savings_30", models.FloatField(blank=True, null=True)),
+                ("cost_savings_40", models.FloatField(blank=True, null=True)),
+                ("cost_savings_50", models.FloatField(blank=True, null=True)),
+                ("cost_savings_60", models.FloatField(blank=True, null=True)),
+                ("cost_savings_70", models.FloatField(blank=True, null=True)),
+                ("cost_savings_80", models.FloatField(blank=True, null=True)),
+                ("cost_savings_90", models.FloatField(blank=True, null=True)),
+                (
+                    "measure",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="frontend.measure",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("measure", "org_type", "month")},
+            },
+        ),
+    ] + [
+        migrations.RunSQL(populate_sql(org_type), migrations.RunSQL.noop)
+        for org_type in ORG_TYPE_CONDITIONS
+    ]
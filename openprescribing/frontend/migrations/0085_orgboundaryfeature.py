@@ -0,0 +1,32 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("frontend", "0084_measureaggregate"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OrgBoundaryFeature",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("org_type", models.CharField(max_length=20)),
+                ("code", models.CharField(max_length=20)),
+                ("tolerance", models.FloatField()),
+                ("feature", models.TextField()),
+            ],
+            options={
+                "unique_together": {("org_type", "tolerance", "code")},
+            },
+        ),
+    ]
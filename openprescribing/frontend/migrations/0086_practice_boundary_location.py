@@ -0,0 +1,19 @@
+import django.contrib.gis.db.models.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("frontend", "0085_orgboundaryfeature"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="practice",
+            name="boundary_location",
+            field=django.contrib.gis.db.models.fields.PointField(
+                blank=True, null=True, srid=4326
+            ),
+        ),
+    ]
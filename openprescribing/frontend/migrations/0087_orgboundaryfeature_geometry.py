@@ -0,0 +1,19 @@
+import django.contrib.gis.db.models.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("frontend", "0086_practice_boundary_location"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="orgboundaryfeature",
+            name="geometry",
+            field=django.contrib.gis.db.models.fields.GeometryField(
+                null=True, srid=4326
+            ),
+        ),
+    ]
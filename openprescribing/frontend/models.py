@@ -20,7 +20,7 @@ from dmd.models import (
     VirtualProductPresStatus,
 )
 from frontend import model_prescribing_units
-from frontend.managers import MeasureValueQuerySet
+from frontend.managers import CENTILES, MeasureValueQuerySet
 from frontend.validators import isAlphaNumeric
 
 
@@ -259,6 +259,9 @@ class Practice(models.Model):
     postcode = models.CharField(max_length=9, null=True, blank=True)
     location = models.PointField(null=True, blank=True, srid=4326)
     boundary = models.GeometryField(null=True, blank=True, srid=4326)
+    # The location from which `boundary` was inferred, which lets
+    # `infer_practice_boundaries --incremental` find practices that have moved
+    boundary_location = models.PointField(null=True, blank=True, srid=4326)
     setting = models.IntegerField(choices=PRESCRIBING_SETTINGS, default=-1)
     open_date = models.DateField(null=True, blank=True)
     close_date = models.DateField(null=True, blank=True)
@@ -749,6 +752,89 @@ class MeasureGlobal(models.Model):
         unique_together = (("measure", "month"),)
 
 
+class MeasureAggregate(models.Model):
+    """
+    MeasureValues summed over all organisations of a particular type, for a
+    particular measure and month.
+
+    These are calculated by `import_measures` so that aggregate requests to
+    the measure API (e.g. those made by the All England dashboard) can be
+    served without summing over every practice's values.  Cost savings are
+    stored as one column per centile, rather than as JSON, and have had
+    negative values excluded (see `aggregate_by_measure_and_month`).
+    """
+
+    measure = models.ForeignKey(Measure, on_delete=models.CASCADE)
+    org_type = models.CharField(max_length=20)
+    month = models.DateField()
+
+    numerator = models.FloatField(null=True, blank=True)
+    denominator = models.FloatField(null=True, blank=True)
+    calc_value = models.FloatField(null=True, blank=True)
+
+    cost_savings_10 = models.FloatField(null=True, blank=True)
+    cost_savings_20 = models.FloatField(null=True, blank=True)
+    cost_savings_30 = models.FloatField(null=True, blank=True)
+    cost_savings_40 = models.FloatField(null=True, blank=True)
+    cost_savings_50 = models.FloatField(null=True, blank=True)
+    cost_savings_60 = models.FloatField(null=True, blank=True)
+    cost_savings_70 = models.FloatField(null=True, blank=True)
+    cost_savings_80 = models.FloatField(null=True, blank=True)
+    cost_savings_90 = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        unique_together = (("measure", "org_type", "month"),)
+
+    COST_SAVINGS_FIELDS = ["cost_savings_{}".format(c) for c in CENTILES]
+
+    @classmethod
+    def from_measure_value(cls, org_type, measure_value):
+        """
+        Build an instance from one of the unsaved MeasureValues returned by
+        `aggregate_by_measure_and_month`
+        """
+        cost_savings = measure_value.cost_savings
+        return cls(
+            measure_id=measure_value.measure_id,
+            org_type=org_type,
+            month=measure_value.month,
+            numerator=measure_value.numerator,
+            denominator=measure_value.denominator,
+            calc_value=measure_value.calc_value,
+            **{
+                field: cost_savings[centile]
+                for field, centile in zip(cls.COST_SAVINGS_FIELDS, CENTILES)
+            },
+        )
+
+
+class OrgBoundaryFeature(models.Model):
+    """
+    The boundary of an organisation, serialized as a GeoJSON Feature, and
+    possibly simplified.
+
+    Boundaries of PCNs, STPs and regional teams are the unions of the
+    boundaries of their practices or CCGs, which are expensive to compute, and
+    full-resolution boundaries are much larger than needed for small-scale
+    maps.  So these are calculated by `api.org_boundaries` whenever boundaries
+    are imported or inferred, at each of a number of tolerances, so that the
+    `org_location` API can serve them by concatenation.  A tolerance of zero
+    means the boundary has not been simplified.
+
+    Unsimplified boundaries are also stored as geometries, from which
+    `api.org_tiles` generates vector tiles.
+    """
+
+    org_type = models.CharField(max_length=20)
+    code = models.CharField(max_length=20)
+    tolerance = models.FloatField()
+    feature = models.TextField()
+    geometry = models.GeometryField(null=True, srid=4326)
+
+    class Meta:
+        unique_together = (("org_type", "tolerance", "code"),)
+
+
 class TruncatingCharField(models.CharField):
     def get_prep_value(self, value):
         value = super(TruncatingCharField, self).get_prep_value(value)
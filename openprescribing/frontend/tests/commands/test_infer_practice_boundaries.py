@@ -1,6 +1,9 @@
+from django.contrib.gis.geos import Point
 from django.core.management import call_command
 from django.test import TestCase
+from frontend.management.commands import infer_practice_boundaries
 from frontend.models import Practice
+from mock import patch
 
 
 class InferPracticeBoundariesTestCase(TestCase):
@@ -15,3 +18,36 @@ class InferPracticeBoundariesTestCase(TestCase):
         self.assertEqual(has_boundary.count(), 0)
         call_command("infer_practice_boundaries")
         self.assertEqual(has_boundary.count(), should_have_boundary.count())
+
+    def test_incremental_update_matches_full_rebuild(self):
+        call_command("infer_practice_boundaries", "--incremental")
+        practices = Practice.objects.filter(boundary__isnull=False)
+        self.assertEqual(practices.count(), 4)
+        self.assertEqual(practices.filter(boundary_location__isnull=True).count(), 0)
+
+        practice = practices.order_by("code").first()
+        practice.location = Point(
+            practice.location.x + 0.1, practice.location.y, srid=4326
+        )
+        practice.save()
+        with patch.object(infer_practice_boundaries, "update_org_boundaries") as update:
+            infer_practice_boundaries.infer_changed_practice_boundaries(
+                change_limit=1.0
+            )
+        update.assert_called_once()
+        incremental = dict(practices.values_list("code", "boundary"))
+
+        call_command("infer_practice_boundaries")
+        full = dict(practices.values_list("code", "boundary"))
+        self.assertEqual(incremental.keys(), full.keys())
+        for code, boundary in full.items():
+            self.assertAlmostEqual(
+                incremental[code].sym_difference(boundary).area, 0.0, places=9
+            )
+
+        # Nothing has changed, so nothing should be written
+        with patch.object(infer_practice_boundaries, "update_org_boundaries") as update:
+            infer_practice_boundaries.infer_changed_practice_boundaries(
+                change_limit=1.0
+            )
+        update.assert_not_called()
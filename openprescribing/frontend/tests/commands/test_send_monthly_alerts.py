@@ -1,14 +1,17 @@
 # -*- coding: utf-8 -*-
+import os
 import re
+import tempfile
 import unittest
+from io import StringIO
 
-from common.alert_utils import BatchedEmailErrors
+from common.alert_utils import AlertRunCache, BatchedEmailErrors
 from django.core import mail
 from django.core.management import call_command
 from django.core.management.base import CommandError
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from frontend.management.commands.send_monthly_alerts import Command
-from frontend.models import PCN, STP, EmailMessage, Measure
+from frontend.models import PCN, STP, EmailMessage, Measure, Practice
 from frontend.tests.data_factory import DataFactory
 from frontend.tests.test_api_spending import ApiTestBase
 from frontend.tests.test_bookmark_utils import _makeContext
@@ -369,6 +372,95 @@ class OrgEmailTestCase(TestCase):
         self.assertIn("it could save around <b>£9,000</b>", html)
 
 
+@patch("frontend.views.bookmark_utils.InterestingMeasureFinder")
+@patch("frontend.views.bookmark_utils.attach_image")
+class BatchedOrgEmailTestCase(TestCase):
+    fixtures = ["bookmark_alerts", "measures", "importlog"]
+
+    def setUp(self):
+        # Add a second subscriber to a practice which already has one
+        DataFactory().create_org_bookmark(Practice.objects.get(pk="P87629"))
+
+    def test_stats_computed_once_per_org(self, attach_image, finder):
+        call_mocked_command(_makeContext(), finder)
+        self.assertEqual(finder.call_count, 2)
+        self.assertEqual(len(mail.outbox), 4)
+
+    def test_dry_run(self, attach_image, finder):
+        self.assertEqual(EmailMessage.objects.count(), 1)
+        stdout = StringIO()
+        call_mocked_command(_makeContext(), finder, dry_run=True, stdout=stdout)
+        self.assertEqual(EmailMessage.objects.count(), 1)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertIn("Computed stats for 2 orgs", stdout.getvalue())
+        self.assertIn("Rendered 4 emails (3 org, 1 search)", stdout.getvalue())
+
+    @patch("frontend.views.alert_charts.analyse_chart")
+    @patch("frontend.views.alert_charts.measure_chart")
+    def test_charts_rendered_once_per_org(
+        self, measure_chart, analyse_chart, attach_image, finder
+    ):
+        measure_chart.return_value = b"PNG"
+
+        def render_and_attach(msg, render_chart, *args):
+            render_chart(*args)
+            return "cid"
+
+        attach_image.side_effect = render_and_attach
+        measure = Measure.objects.get(pk="cerazette")
+        call_mocked_command(_makeContext(worst=[measure]), finder, workers=2)
+        self.assertEqual(len(mail.outbox), 4)
+        # Charts are rendered for each org before any emails are sent, and
+        # reused for every email about that org
+        self.assertEqual(measure_chart.call_count, 2)
+
+    def test_resumes_from_cache(self, attach_image, finder):
+        cache_dir = self.enterContext(tempfile.TemporaryDirectory())
+        cache = AlertRunCache("2014-11-01", cache_dir)
+        cache.set("practice-P87629", {"stats": _makeContext(), "charts": {}})
+        other_cache = AlertRunCache("2014-10-01", cache_dir)
+        other_cache.set("practice-P87629", {"stats": _makeContext(), "charts": {}})
+        with override_settings(ALERT_CACHE_DIR=cache_dir):
+            call_mocked_command(_makeContext(), finder)
+        # Only stats for the CCG needed computing
+        self.assertEqual(finder.call_count, 1)
+        self.assertEqual(len(mail.outbox), 4)
+        # Everything was sent so the cache for this month has been cleared, but
+        # not the cache for any other month
+        self.assertFalse(os.path.exists(cache.path))
+        self.assertTrue(os.path.exists(other_cache.path))
+
+    def test_cache_kept_after_dry_run(self, attach_image, finder):
+        cache_dir = self.enterContext(tempfile.TemporaryDirectory())
+        with override_settings(ALERT_CACHE_DIR=cache_dir):
+            call_mocked_command(_makeContext(), finder, dry_run=True)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertTrue(os.path.exists(os.path.join(cache_dir, "2014-11-01")))
+
+    def test_cache_kept_after_test_send(self, attach_image, finder):
+        cache_dir = self.enterContext(tempfile.TemporaryDirectory())
+        with override_settings(ALERT_CACHE_DIR=cache_dir):
+            call_mocked_command_with_defaults(_makeContext(), finder)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertTrue(os.path.exists(os.path.join(cache_dir, "2014-11-01")))
+
+    def test_cache_kept_after_failure(self, attach_image, finder):
+        attach_image.side_effect = BadAlertImageError
+        measure = Measure.objects.get(pk="cerazette")
+        cache_dir = self.enterContext(tempfile.TemporaryDirectory())
+        with override_settings(ALERT_CACHE_DIR=cache_dir):
+            with self.assertRaises(SystemExit):
+                call_mocked_command(_makeContext(worst=[measure]), finder)
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(cache_dir, "2014-11-01"))),
+            ["pct-03V.pickle", "practice-P87629.pickle"],
+        )
+        cache = AlertRunCache("2014-11-01", cache_dir)
+        self.assertEqual(
+            cache.get("practice-P87629")["stats"]["worst"][0].id, "cerazette"
+        )
+
+
 @patch("frontend.views.bookmark_utils.attach_image")
 class SearchEmailTestCase(TestCase):
     fixtures = ["bookmark_alerts", "measures", "importlog"]
@@ -0,0 +1,138 @@
+from django.test import TestCase
+from frontend.models import MeasureGlobal, MeasureValue
+from frontend.tests.data_factory import DataFactory
+from frontend.views import alert_charts
+from matrixstore.tests.decorators import copy_fixtures_to_matrixstore
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+@copy_fixtures_to_matrixstore
+class TestAlertCharts(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        factory = DataFactory()
+        cls.months = factory.create_months_array(start_date="2018-02-01", num_months=6)
+        cls.ccgs = [factory.create_ccg() for _ in range(2)]
+        cls.pcns = [factory.create_pcn() for _ in range(2)]
+        cls.practices = [
+            factory.create_practice(ccg=ccg, pcn=pcn, setting=4)
+            for ccg, pcn in zip(cls.ccgs, cls.pcns)
+            for _ in range(2)
+        ]
+        cls.presentations = factory.create_presentations(3)
+        factory.create_tariff_and_ncso_costings_for_presentations(
+            cls.presentations, months=cls.months
+        )
+        for practice in cls.practices:
+            factory.create_prescribing_for_practice(
+                practice, presentations=cls.presentations, months=cls.months
+            )
+        cls.measure = factory.create_measure()
+        cls.measure.is_percentage = True
+        cls.measure.save()
+        for month in cls.months:
+            MeasureGlobal.objects.create(
+                measure=cls.measure,
+                month=month,
+                percentiles={"ccg": {"10": 0.1, "50": 0.5, "90": 0.9}},
+            )
+            MeasureValue.objects.create(
+                measure=cls.measure, pct=cls.ccgs[0], month=month, calc_value=0.4
+            )
+
+    def assertIsPNG(self, image):
+        self.assertTrue(image.startswith(PNG_SIGNATURE))
+
+    def test_measure_chart(self):
+        self.assertIsPNG(alert_charts.measure_chart(self.ccgs[0], self.measure.id))
+
+    def test_measure_chart_without_data(self):
+        with self.assertRaises(alert_charts.NoChartData):
+            alert_charts.measure_chart(self.ccgs[1], self.measure.id)
+
+    def test_analyse_chart(self):
+        url = "org=CCG&orgIds={}&numIds={}".format(
+            self.ccgs[0].code, self.presentations[0].bnf_code
+        )
+        self.assertIsPNG(alert_charts.analyse_chart(url, "Foo"))
+
+    def test_analyse_chart_for_chemical_denominator(self):
+        url = "org=practice&orgIds={}&numIds={}&denom=chemical&denomIds={}".format(
+            self.practices[0].code,
+            self.presentations[0].bnf_code,
+            self.presentations[1].bnf_code,
+        )
+        self.assertIsPNG(alert_charts.analyse_chart(url, "Foo vs bar"))
+
+    def test_analyse_chart_defaults_to_chemical_denominator(self):
+        # URLs saved from the analyse page omit `denom=chemical`
+        url = "org=practice&orgIds={}&numIds={}&denomIds={}".format(
+            self.practices[0].code,
+            self.presentations[0].bnf_code,
+            self.presentations[1].bnf_code,
+        )
+        self.assertEqual(
+            alert_charts.analyse_chart(url, "Foo vs bar"),
+            alert_charts.analyse_chart(url + "&denom=chemical", "Foo vs bar"),
+        )
+        self.assertNotEqual(
+            alert_charts.analyse_chart(url, "Foo vs bar"),
+            alert_charts.analyse_chart(url + "&denom=nothing", "Foo vs bar"),
+        )
+
+    def test_analyse_chart_for_practices_in_ccg(self):
+        url = "org=practice&orgIds={}&numIds={}".format(
+            self.ccgs[0].code, self.presentations[0].bnf_code
+        )
+        self.assertIsPNG(alert_charts.analyse_chart(url, "Foo"))
+
+    def test_analyse_chart_for_pcns_in_ccg(self):
+        url = "org=pcn&orgIds={}&numIds={}".format(
+            self.ccgs[0].code, self.presentations[0].bnf_code
+        )
+        self.assertIsPNG(alert_charts.analyse_chart(url, "Foo"))
+
+    def test_analyse_chart_for_all_practices(self):
+        url = "org=all&numIds={}".format(self.presentations[0].bnf_code)
+        self.assertIsPNG(alert_charts.analyse_chart(url, "Foo"))
+
+    def test_analyse_chart_for_unknown_org(self):
+        url = "org=practice&orgIds=XYZ999&numIds={}".format(
+            self.presentations[0].bnf_code
+        )
+        with self.assertRaises(alert_charts.NoChartData):
+            alert_charts.analyse_chart(url, "Foo")
+
+    def test_ncso_concessions_chart(self):
+        self.assertIsPNG(
+            alert_charts.ncso_concessions_chart(self.practices[0], "practice")
+        )
+
+
+class TestParseAnalyseURL(TestCase):
+    def test_parse(self):
+        params = alert_charts._parse_analyse_url(
+            "numerator=chemical&numeratorIds=0212000AA,&denom=total_list_size"
+            "&orgIds=03V,99P&org=CCG&selectedTab=map"
+        )
+        self.assertEqual(params["num"], "chemical")
+        self.assertEqual(params["numIds"], ["0212000AA"])
+        self.assertEqual(params["denomIds"], [])
+        self.assertEqual(params["denom"], "total_list_size")
+        self.assertEqual(params["orgIds"], ["03V", "99P"])
+        self.assertEqual(params["org"], "ccg")
+
+    def test_parse_bookmark_with_denominator_ids(self):
+        params = alert_charts._parse_analyse_url(
+            "/analyse/#org=CCG&orgIds=03V&numIds=0212000AA&denomIds=0212000B0"
+            "&selectedTab=chart"
+        )
+        self.assertEqual(params["denom"], "chemical")
+        self.assertEqual(params["denomIds"], ["0212000B0"])
+
+    def test_parse_legacy_denominator(self):
+        params = alert_charts._parse_analyse_url(
+            "org=CCG&numIds=0501&denom=star_pu_oral_antibac_items"
+        )
+        self.assertEqual(params["denom"], "star_pu.oral_antibacterials_item")
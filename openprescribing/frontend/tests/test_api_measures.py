@@ -1,7 +1,23 @@
 import datetime
 import json
 
-from frontend.models import PCT
+from api import measure_cache
+from api.views_measures import (
+    MeasureValueCSVRenderer,
+    _get_measure_aggregate_rows,
+    _get_measure_value_rows,
+    _get_measures,
+    _measure_value_data,
+    _roll_up_measure_values,
+    _stream_measure_values_csv,
+    _stream_measure_values_json,
+    populate_measure_cache,
+)
+from django.test import override_settings
+from frontend.management.commands.import_measures import write_measure_aggregates
+from frontend.models import PCT, MeasureAggregate, MeasureValue, Practice
+from mock import patch
+from rest_framework.renderers import JSONRenderer
 
 from .api_test_base import ApiTestBase
 
@@ -10,10 +26,14 @@ class TestAPIMeasureViews(ApiTestBase):
     fixtures = ["one_month_of_measures"]
     api_prefix = "/api/1.0"
 
+    @classmethod
+    def setUpTestData(cls):
+        write_measure_aggregates(["cerazette", "cerazette2"])
+
     def _get_json(self, url):
         response = self.client.get(url, follow=True)
         self.assertEqual(response.status_code, 200)
-        return json.loads(response.content.decode("utf8"))
+        return json.loads(response.getvalue().decode("utf8"))
 
     def test_api_measure_global(self):
         url = "/api/1.0/measure/?measure=cerazette&format=json"
@@ -393,3 +413,153 @@ class TestAPIMeasureViews(ApiTestBase):
         self.assertEqual("%.2f" % d["cost_savings"]["10"], "70149.77")
         self.assertEqual("%.2f" % d["cost_savings"]["50"], "59029.41")
         self.assertEqual("%.2f" % d["cost_savings"]["90"], "162.00")
+
+
+class TestMeasureValueStreaming(ApiTestBase):
+    fixtures = ["one_month_of_measures"]
+
+    def test_json_output_matches_roll_up(self):
+        for org_type, parent_org_type, org_ids in [
+            ("ccg", "ccg", ["02Q"]),
+            ("practice", "practice", ["C84001"]),
+            ("practice", "pct", ["02Q"]),
+            ("ccg", "ccg", []),
+        ]:
+            measure_values = MeasureValue.objects.by_org(
+                org_type, parent_org_type, org_ids
+            ).order_by("measure_id", "month")
+            expected = JSONRenderer().render(
+                {"measures": _roll_up_measure_values(measure_values, org_type)}
+            )
+            actual = self._stream_json(org_type, parent_org_type, org_ids)
+            self.assertEqual(
+                self._normalise(actual), self._normalise(expected), org_type
+            )
+
+    def _stream_json(self, org_type, parent_org_type, org_ids):
+        rows = _get_measure_value_rows(
+            org_type, parent_org_type, org_ids, [], [], by_measure=True
+        )
+        measures = _get_measures([], [])
+        return b"".join(_stream_measure_values_json(rows, measures, org_type))
+
+    def _normalise(self, content):
+        # Values for different orgs in the same month may come back in any
+        # order
+        measures = json.loads(content)["measures"]
+        for measure in measures:
+            measure["data"].sort(key=lambda d: (d["date"], d.get("org_id")))
+        return measures
+
+    def test_json_output_is_byte_identical(self):
+        measure_values = MeasureValue.objects.by_org("ccg", "ccg", ["02Q"])
+        expected = JSONRenderer().render(
+            {"measures": _roll_up_measure_values(measure_values, "ccg")}
+        )
+        actual = self._stream_json("ccg", "ccg", ["02Q"])
+        self.assertEqual(actual, expected)
+
+    def test_csv_output_is_byte_identical(self):
+        measure_values = MeasureValue.objects.by_org("practice", "practice", ["C84001"])
+        expected = MeasureValueCSVRenderer().render(
+            [_measure_value_data(mv, "practice") for mv in measure_values]
+        )
+        rows = _get_measure_value_rows(
+            "practice", "practice", ["C84001"], [], [], by_measure=False
+        )
+        stream = _stream_measure_values_csv(rows, "practice")
+        self.assertEqual(b"".join(stream), expected)
+
+    def test_rows_include_org_names(self):
+        rows = list(
+            _get_measure_value_rows(
+                "practice", "pct", ["02Q"], ["cerazette"], [], by_measure=True
+            )
+        )
+        self.assertTrue(rows)
+        names = dict(Practice.objects.values_list("code", "name"))
+        for row in rows:
+            org_id, org_name = row[-2:]
+            self.assertEqual(org_name, names[org_id])
+
+    def test_aggregate_output_matches_aggregate_by_measure_and_month(self):
+        write_measure_aggregates(["cerazette", "cerazette2"])
+        measures = _get_measures([], [])
+        for org_type in ["practice", "pcn", "ccg", "stp", "regional_team"]:
+            measure_values = MeasureValue.objects.by_org(
+                org_type, org_type, []
+            ).aggregate_by_measure_and_month()
+            expected = JSONRenderer().render(
+                {"measures": _roll_up_measure_values(measure_values, org_type)}
+            )
+            rows = _get_measure_aggregate_rows(org_type, [], [])
+            actual = b"".join(_stream_measure_values_json(rows, measures, org_type))
+            self.assertEqual(actual, expected, org_type)
+
+    def test_write_measure_aggregates_replaces_existing(self):
+        write_measure_aggregates(["cerazette"])
+        count = MeasureAggregate.objects.count()
+        self.assertGreater(count, 0)
+        write_measure_aggregates(["cerazette"])
+        self.assertEqual(MeasureAggregate.objects.count(), count)
+
+
+@override_settings(
+    ENABLE_CACHING=True,
+    SOURCE_COMMIT_ID="abc123",
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+)
+class TestAPIMeasureViewsCaching(ApiTestBase):
+    fixtures = ["one_month_of_measures"]
+
+    def setUp(self):
+        measure_cache.record_import("2015-09-01")
+
+    def _get(self, url):
+        response = self.client.get(url, follow=True)
+        self.assertEqual(response.status_code, 200)
+        return response.getvalue()
+
+    def test_response_is_cached(self):
+        url = "/api/1.0/measure_by_sicbl/?org=02Q&format=json"
+        with override_settings(ENABLE_CACHING=False):
+            uncached = self._get(url)
+        self.assertEqual(self._get(url), uncached)
+        # Only the ImportLog lookup should hit the database
+        with self.assertNumQueries(1):
+            self.assertEqual(self._get(url), uncached)
+
+    def test_new_import_invalidates_cache(self):
+        url = "/api/1.0/measure_by_sicbl/?measure=cerazette&format=json"
+        self._get(url)
+        MeasureValue.objects.filter(pct_id="02Q", practice_id=None).update(numerator=1)
+        data = json.loads(self._get(url))
+        self.assertEqual(data["measures"][0]["data"][0]["numerator"], 82000)
+        measure_cache.record_import("2015-09-01")
+        data = json.loads(self._get(url))
+        self.assertEqual(data["measures"][0]["data"][0]["numerator"], 1)
+
+    def test_new_deploy_invalidates_cache(self):
+        url = "/api/1.0/measure_by_sicbl/?measure=cerazette&format=json"
+        self._get(url)
+        MeasureValue.objects.filter(pct_id="02Q", practice_id=None).update(numerator=1)
+        with override_settings(SOURCE_COMMIT_ID="def456"):
+            data = json.loads(self._get(url))
+        self.assertEqual(data["measures"][0]["data"][0]["numerator"], 1)
+
+    def test_uncacheable_requests_are_not_cached(self):
+        url = "/api/1.0/measure_by_sicbl/?org=02Q&tags=core&format=json"
+        with patch.object(measure_cache, "set_content") as set_content:
+            self._get(url)
+        set_content.assert_not_called()
+
+    def test_populate_measure_cache(self):
+        populate_measure_cache()
+        with self.assertNumQueries(1):
+            data = json.loads(
+                self._get(
+                    "/api/1.0/measure_by_practice/"
+                    "?org=02Q&parent_org_type=ccg&measure=cerazette&format=json"
+                )
+            )
+        self.assertEqual(data["measures"][0]["id"], "cerazette")
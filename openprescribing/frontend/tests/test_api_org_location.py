@@ -1,10 +1,17 @@
 import datetime
 import json
 import os
+import shutil
+import tempfile
 import unittest
 
-from django.test import TestCase
-from frontend.models import PCT
+from api import org_tiles
+from api.org_boundaries import update_org_boundaries
+from django.test import TestCase, override_settings
+from frontend.management.commands.infer_practice_boundaries import (
+    infer_practice_boundaries,
+)
+from frontend.models import PCT, OrgBoundaryFeature
 
 
 class TestAPIOrgLocationViews(TestCase):
@@ -74,3 +81,118 @@ class TestAPIOrgLocationViews(TestCase):
         content = json.loads(response.content)
         pcn_codes = {feature["properties"]["code"] for feature in content["features"]}
         self.assertEqual(pcn_codes, {"PCN0001", "PCN0002"})
+
+
+class TestAPIOrgLocationPrecomputedViews(TestCase):
+    fixtures = ["orgs", "practices"]
+    api_prefix = "/api/1.0"
+
+    @classmethod
+    def setUpTestData(cls):
+        infer_practice_boundaries()
+
+    def _get_features(self, params):
+        url = "%s/org_location?format=json&%s" % (self.api_prefix, params)
+        response = self.client.get(url, follow=True)
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content)
+        return sorted(content["features"], key=lambda f: f["properties"]["code"])
+
+    def test_precomputed_boundaries_match_computed_boundaries(self):
+        OrgBoundaryFeature.objects.all().delete()
+        for params in [
+            "org_type=ccg",
+            "org_type=ccg&q=03Q",
+            "org_type=pcn",
+            "org_type=pcn&q=03V",
+            "org_type=stp",
+            "org_type=regional_team",
+        ]:
+            computed = self._get_features(params)
+            update_org_boundaries()
+            precomputed = self._get_features(params)
+            OrgBoundaryFeature.objects.all().delete()
+            self.assertEqual(precomputed, computed, params)
+
+    def test_simplified_boundaries(self):
+        update_org_boundaries()
+        full = self._get_features("org_type=pcn")
+        for params in ["org_type=pcn&tolerance=0.01", "org_type=pcn&zoom=1"]:
+            simplified = self._get_features(params)
+            self.assertEqual(
+                [f["properties"] for f in simplified],
+                [f["properties"] for f in full],
+            )
+            self.assertNotEqual(
+                [f["geometry"] for f in simplified],
+                [f["geometry"] for f in full],
+            )
+
+    def test_invalid_tolerance(self):
+        url = "%s/org_location?org_type=pcn&zoom=x&format=json" % self.api_prefix
+        response = self.client.get(url, follow=True)
+        self.assertEqual(response.status_code, 400)
+
+
+class TestAPIOrgLocationTiles(TestCase):
+    fixtures = ["orgs", "practices"]
+    api_prefix = "/api/1.0"
+
+    @classmethod
+    def setUpTestData(cls):
+        infer_practice_boundaries()
+
+    def setUp(self):
+        self.tile_cache_dir = tempfile.mkdtemp()
+        self.enterContext(override_settings(TILE_CACHE_DIR=self.tile_cache_dir))
+
+    def tearDown(self):
+        shutil.rmtree(self.tile_cache_dir)
+
+    def _get_tile(self, path):
+        url = "%s/org_location/tiles/%s.mvt" % (self.api_prefix, path)
+        return self.client.get(url)
+
+    def test_tiles(self):
+        for org_type in ["practice", "pcn", "ccg", "stp", "regional_team"]:
+            response = self._get_tile(org_type + "/0/0/0")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response["content-type"], org_tiles.CONTENT_TYPE)
+        # All the fixture CCGs and practices are in the one tile at zoom 0
+        self.assertGreater(len(self._get_tile("ccg/0/0/0").content), 0)
+        self.assertGreater(len(self._get_tile("practice/0/0/0").content), 0)
+
+    def test_tiles_from_precomputed_boundaries(self):
+        OrgBoundaryFeature.objects.all().delete()
+        org_types = ["pcn", "stp", "regional_team"]
+        computed = {
+            org_type: org_tiles.generate_tile(org_type, 0, 0, 0)
+            for org_type in org_types
+        }
+        update_org_boundaries()
+        for org_type in org_types:
+            orgs = org_tiles._get_orgs_with_geometry(org_type)
+            self.assertIs(orgs.model, OrgBoundaryFeature)
+            self.assertEqual(
+                org_tiles.generate_tile(org_type, 0, 0, 0), computed[org_type]
+            )
+
+    def test_tiles_are_cached(self):
+        self._get_tile("ccg/0/0/0")
+        path = os.path.join(self.tile_cache_dir, "tiles", "ccg", "0", "0", "0.mvt")
+        with open(path, "wb") as f:
+            f.write(b"cached")
+        self.assertEqual(self._get_tile("ccg/0/0/0").content, b"cached")
+
+    def test_updating_boundaries_invalidates_cache(self):
+        self._get_tile("ccg/0/0/0")
+        tiles_dir = os.path.join(self.tile_cache_dir, "tiles")
+        self.assertTrue(os.path.exists(tiles_dir))
+        with self.captureOnCommitCallbacks(execute=True):
+            update_org_boundaries()
+        self.assertEqual(os.listdir(self.tile_cache_dir), [])
+
+    def test_invalid_tiles(self):
+        self.assertEqual(self._get_tile("ccg/1/2/0").status_code, 404)
+        self.assertEqual(self._get_tile("ccg/17/0/0").status_code, 404)
+        self.assertEqual(self._get_tile("dentist/0/0/0").status_code, 404)
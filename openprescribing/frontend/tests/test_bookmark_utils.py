@@ -1,13 +1,10 @@
 import base64
-import os
+import random
 import re
-import socket
 import unittest
 from datetime import datetime
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from threading import Thread
 
-import requests
+import numpy as np
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
@@ -22,7 +19,7 @@ from frontend.models import (
 )
 from frontend.templatetags.template_extras import deltawords
 from frontend.tests.data_factory import DataFactory
-from frontend.views import bookmark_utils
+from frontend.views import alert_charts, bookmark_utils
 from frontend.views.spending_utils import ncso_spending_for_entity
 from matrixstore.tests.decorators import copy_fixtures_to_matrixstore
 from mock import MagicMock, patch
@@ -210,6 +207,58 @@ class TestCUSUM(unittest.TestCase):
                 self.assertEqual(test["deltawords"], "not at all")
 
 
+class TestCUSUMMatrix(unittest.TestCase):
+    def assertMatchesCUSUM(self, rows, window_size):
+        matrix = bookmark_utils.CUSUMMatrix(rows, window_size=window_size)
+        matrix.work()
+        last_alerts = matrix.get_last_alert_info()
+        for n, row in enumerate(rows):
+            cusum = bookmark_utils.CUSUM(row, window_size=window_size)
+            cusum.work()
+            expected = cusum.as_dict()
+            actual = matrix.as_dict(n)
+            for key in expected:
+                np.testing.assert_array_equal(
+                    np.array(actual[key], dtype=float),
+                    np.array(expected[key], dtype=float),
+                    "%s in row %s" % (key, row),
+                )
+            self.assertEqual(last_alerts[n], cusum.get_last_alert_info())
+
+    def test_matches_cusum_for_fixture_data(self):
+        with open(
+            settings.APPS_ROOT + "/frontend/tests/fixtures/" "alert_test_cases.txt"
+        ) as expected:
+            test_cases = expected.readlines()
+        for test in each_cusum_test(test_cases):
+            self.assertMatchesCUSUM([test["data"]], window_size=3)
+
+    def test_matches_cusum_for_random_data(self):
+        rng = random.Random(1)
+        for window_size in [1, 3, 12]:
+            for num_months in [1, 6, 18]:
+                rows = []
+                for _ in range(20):
+                    level = rng.uniform(0, 100)
+                    row = []
+                    for _ in range(num_months):
+                        if rng.random() < 0.1:
+                            level = rng.uniform(0, 100)
+                        if rng.random() < 0.1:
+                            row.append(None)
+                        else:
+                            row.append(round(level + rng.gauss(0, 5), 2))
+                    rows.append(row)
+                # Include a series with no data at all
+                rows.append([None] * num_months)
+                self.assertMatchesCUSUM(rows, window_size)
+
+    def test_no_series(self):
+        matrix = bookmark_utils.CUSUMMatrix(np.empty((0, 0)))
+        matrix.work()
+        self.assertEqual(matrix.get_last_alert_info(), [])
+
+
 class TestBookmarkUtilsPerforming(TestCase):
     fixtures = ["bookmark_alerts", "measurevalues_with_performance", "importlog"]
 
@@ -440,132 +489,32 @@ class TestBookmarkUtilsSavingsAchieved(TestBookmarkUtilsSavingsBase):
         self.assertEqual(savings["possible_top_savings_total"], 10000)
 
 
-class MockServerRequestHandler(BaseHTTPRequestHandler):
-    def log_message(self, format, *args):
-        pass
-
-    def do_GET(self):
-        if self.path == "/page.html":
-            self.send_response(requests.codes.ok)
-            self.send_header("Content-Type", "text/html")
-            self.end_headers()
-            response_content = b"""
-            <html>
-             <head>
-              <script src='/jquery.min.js'></script>
-              <style>
-               div {width: 100%; height: 100%}
-               #thing1 {background-color:red}
-               #thing1 {background-color:green}
-              </style>
-             </head>
-             <div id='thing1'></div>
-             <div id='thing2'></div>
-            </html>
-            """
-            self.wfile.write(response_content)
-            return
-        elif self.path == "/jquery.min.js":
-            self.send_response(requests.codes.ok)
-            self.send_header("Content-Type", "text/javascript")
-            self.end_headers()
-            with open(
-                settings.APPS_ROOT + "/media/js/"
-                "node_modules/jquery/dist/jquery.min.js",
-                "rb",
-            ) as f:
-                self.wfile.write(f.read())
-                return
-
-
-def get_free_port():
-    s = socket.socket(socket.AF_INET, type=socket.SOCK_STREAM)
-    s.bind(("localhost", 0))
-    address, port = s.getsockname()
-    s.close()
-    return port
-
-
-def start_mock_server(port):
-    mock_server = HTTPServer(("localhost", port), MockServerRequestHandler)
-    mock_server_thread = Thread(target=mock_server.serve_forever)
-    mock_server_thread.setDaemon(True)
-    mock_server_thread.start()
-
-
-class GenerateImageTestCase(unittest.TestCase):
+class AttachImageTestCase(unittest.TestCase):
     def setUp(self):
-        port = get_free_port()
-        start_mock_server(port)
         self.msg = EmailMultiAlternatives(
             "Subject", "body", "sender@email.com", ["recipient@email.com"]
         )
-        self.url = ":%s/page.html" % port
-        self.file_path = "/tmp/image.png"
-        self.selector = "#thing2"
-
-    def tearDown(self):
-        try:
-            os.remove(self.file_path)
-        except OSError as e:
-            import errno
-
-            # We don't care about a "No such file or directory" error
-            if e.errno != errno.ENOENT:
-                raise
-
-    @patch("subprocess.run")
-    def test_empty_image_raises(self, run):
-        run.return_value.returncode = 0
-        with open(self.file_path, "a"):
-            # create an empty file
-            os.utime(self.file_path, None)
-        with self.assertRaises(bookmark_utils.BadAlertImageError):
-            bookmark_utils.attach_image(
-                self.msg, self.url, self.file_path, self.selector
-            )
 
-    def test_image_generated(self):
-        # Note that the expected image may differ depending on the
-        # server where this is run: phantomjs interacts with the
-        # display settings on a server which may vary from your own
-        self.assertEqual(len(self.msg.attachments), 0)
-        image = bookmark_utils.attach_image(
-            self.msg, self.url, self.file_path, self.selector
+    def test_image_attached(self):
+        image = b"\x89PNG\r\n\x1a\nnot-really-a-png"
+        render_chart = MagicMock(return_value=image)
+        cid = bookmark_utils.attach_image(self.msg, render_chart, "arg1", "arg2")
+        render_chart.assert_called_once_with("arg1", "arg2")
+        self.assertEqual(len(self.msg.attachments), 1)
+        attachment = self.msg.attachments[0]
+        self.assertIn(cid, attachment["Content-ID"])
+        self.assertEqual(attachment.get_content_type(), "image/png")
+        # Attachments in emails are base64 *with line breaks*, so we remove
+        # those
+        self.assertEqual(
+            attachment.get_payload().replace("\n", "").encode("utf8"),
+            base64.b64encode(image),
         )
-        with open(
-            settings.APPS_ROOT + "/frontend/tests/fixtures/" "alert-email-image.png",
-            "rb",
-        ) as expected:
-            self.assertEqual(len(self.msg.attachments), 1)
-            attachment = self.msg.attachments[0]
-            # Check the attachment is as we expect
-            self.assertEqual(attachment.get_filename(), "image.png")
-            self.assertIn(image, attachment["Content-ID"])
-            # Attachments in emails are base64 *with line breaks*, so
-            # we remove those.
-            self.assertEqual(
-                attachment.get_payload().replace("\n", "").encode("utf8"),
-                base64.b64encode(expected.read()),
-            )
 
-    def test_small_image_generated_with_viewport_dimensions_specified(self):
-        # Note that the expected image may differ depending on the
-        # server where this is run: phantomjs interacts with the
-        # display settings on a server which may vary from your own
-        bookmark_utils.attach_image(
-            self.msg, self.url, self.file_path, self.selector, "100x100"
-        )
-        with open(
-            settings.APPS_ROOT + "/frontend/tests/fixtures/"
-            "alert-email-image-small.png",
-            "rb",
-        ) as expected:
-            attachment = self.msg.attachments[0]
-            self.assertEqual(
-                attachment.get_payload().replace("\n", "").encode("utf8"),
-                base64.b64encode(expected.read()),
-            )
+    def test_missing_data_raises(self):
+        render_chart = MagicMock(side_effect=alert_charts.NoChartData("no data"))
+        with self.assertRaises(bookmark_utils.BadAlertImageError):
+            bookmark_utils.attach_image(self.msg, render_chart)
 
 
 class UnescapeTestCase(unittest.TestCase):
@@ -0,0 +1,102 @@
+import json
+import os
+import shutil
+import tempfile
+
+from api import typeahead_index
+from django.test import override_settings
+
+from .api_test_base import ApiTestBase
+
+
+class TestTypeaheadIndex(ApiTestBase):
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.empty_dir = tempfile.mkdtemp()
+        with override_settings(TYPEAHEAD_INDEX_DIR=self.index_dir):
+            typeahead_index.build_index()
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+        shutil.rmtree(self.empty_dir)
+
+    def _get_json(self, url, index_dir):
+        url += "&format=json" if "?" in url else "?format=json"
+        with override_settings(TYPEAHEAD_INDEX_DIR=index_dir):
+            response = self.client.get(self.api_prefix + url, follow=True)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def assertMatchesDatabase(self, url, ordered=True):
+        expected = self._get_json(url, self.empty_dir)
+        actual = self._get_json(url, self.index_dir)
+        if not ordered:
+            expected = sorted(expected, key=json.dumps)
+            actual = sorted(actual, key=json.dumps)
+        self.assertEqual(actual, expected, url)
+
+    def test_org_codes(self):
+        for url in [
+            "/org_code?q=ainsdale",
+            "/org_code?q=P87",
+            "/org_code?q=p87",
+            "/org_code?q=a&org_type=practice",
+            "/org_code?q=AN&org_type=practice",
+            "/org_code?q=medical+pr&org_type=practice",
+            "/org_code?q=N84014&exact=true",
+            "/org_code?q=P87&exact=true",
+            "/org_code?q=PCN0002&org_type=pcn&exact=true",
+            "/org_code?q=transformational&org_type=pcn",
+        ]:
+            self.assertMatchesDatabase(url)
+
+    def test_unordered_org_codes(self):
+        # These are returned in whatever order the database chooses
+        for url in [
+            "/org_code",
+            "/org_code?q=03",
+            "/org_code?q=a&org_type=CCG",
+            "/org_code?org_type=ccg",
+            "/org_code?q=northampton&org_type=stp",
+            "/org_code?q=E54&org_type=stp&exact=true",
+            "/org_code?q=north&org_type=regional_team",
+            "/org_code?q=Y55&org_type=regional_team&exact=true",
+            "/org_code?q=03V,P87&org_type=practice,ccg",
+        ]:
+            self.assertMatchesDatabase(url, ordered=False)
+
+    def test_bnf_codes(self):
+        for url in [
+            "/bnf_code?q=lor",
+            "/bnf_code?q=0202010D0BD&exact=true",
+            "/bnf_code?q=0202010D0bd&exact=true",
+            "/bnf_code?q=diuretics",
+            "/bnf_code?q=cardio",
+            "/bnf_code?q=2.2&exact=true",
+            "/bnf_code?q=0202&exact=true",
+            "/bnf_code?q=02",
+            "/bnf_code?q=Bendroflume",
+            "/bnf_code?q=0202010F0AAAAAA",
+            "/bnf_code?q=non-current+product",
+            "/bnf_code?q=Labetalol+50",
+            "/bnf_code?q=lor,diuretics",
+        ]:
+            self.assertMatchesDatabase(url)
+
+    def test_rebuilding_replaces_live_index(self):
+        with override_settings(TYPEAHEAD_INDEX_DIR=self.index_dir):
+            first = typeahead_index.get_index()
+            typeahead_index.build_index()
+            second = typeahead_index.get_index()
+        self.assertNotEqual(first.path, second.path)
+        self.assertTrue(os.path.exists(first.path))
+        self.assertEqual(
+            sorted(os.listdir(self.index_dir)),
+            sorted(
+                [
+                    os.path.basename(first.path),
+                    os.path.basename(second.path),
+                    typeahead_index.LIVE_LINK_NAME,
+                ]
+            ),
+        )
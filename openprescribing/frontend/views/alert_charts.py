@@ -0,0 +1,362 @@
+"""
+Charts for alert emails, drawn with matplotlib directly from MeasureValues and
+the MatrixStore.
+
+These approximate the charts on the measure and analyse pages: the value for
+the organisation (or organisations) of interest over time, plotted against the
+deciles for all organisations of the same type.
+
+Many subscribers share the same chart, so rendered charts are cached, keyed by
+the chart's parameters and the latest month of data.
+"""
+
+import urllib.parse
+import warnings
+from io import BytesIO
+
+import numpy
+from api.view_utils import get_bnf_codes_from_number_str
+from frontend.managers import CENTILES
+from frontend.models import (
+    PCN,
+    PCT,
+    STP,
+    Measure,
+    MeasureGlobal,
+    MeasureValue,
+    Practice,
+)
+from frontend.views.spending_utils import ncso_spending_for_entity
+from frontend.views.views import cached
+from matplotlib.dates import DateFormatter
+from matplotlib.figure import Figure
+from matplotlib.ticker import PercentFormatter, StrMethodFormatter
+from matrixstore.db import get_db, get_row_grouper
+
+# Charts are drawn at the size at which they were previously screenshotted
+WIDTH = 800
+HEIGHT = 600
+DPI = 100
+
+ORG_COLOUR = "#ff7f0e"
+DECILE_COLOUR = "#1f77b4"
+MEDIAN_COLOUR = "#d62728"
+ESTIMATE_COLOUR = "#aec7e8"
+
+# Denominators in the analyse form which are practice statistics, and are
+# shown per 1000 patients
+PER_1000_DENOMINATORS = ("total_list_size", "astro_pu_items", "astro_pu_cost")
+
+STANDARD_ORG_TYPES = {"practice": "standard_practice", "ccg": "standard_ccg"}
+
+# Types of organisation for which the analyse page accepts the codes of Sub-ICB
+# Locations in place of the codes of their members
+PARENT_ORG_TYPES = ("practice", "pcn")
+
+
+class NoChartData(Exception):
+    pass
+
+
+def measure_chart(org, measure_id):
+    """
+    Return a PNG of the chart for the given measure and organisation, as shown
+    on the organisation's measure page
+    """
+    org_type, org_code = _get_org_type_and_code(org)
+    month = (
+        MeasureGlobal.objects.filter(measure_id=measure_id)
+        .order_by("-month")
+        .values_list("month", flat=True)
+        .first()
+    )
+    if month is None:
+        raise NoChartData("No data for measure {}".format(measure_id))
+    return cached(_render_measure_chart, org_type, org_code, measure_id, month)
+
+
+def analyse_chart(url, title):
+    """
+    Return a PNG of the chart for the given analyse page URL fragment
+    """
+    month = get_db().dates[-1]
+    return cached(_render_analyse_chart, url, title, month)
+
+
+def ncso_concessions_chart(entity, entity_type):
+    """
+    Return a PNG of the chart of the additional cost of price concessions, as
+    shown on the entity's concessions page
+
+    This isn't cached as concession data can change at any time.
+    """
+    monthly_totals = ncso_spending_for_entity(entity, entity_type)
+    if not monthly_totals:
+        raise NoChartData("No concessions data for {}".format(entity))
+    fig, ax = _new_chart("Additional cost of price concessions")
+    for is_estimate, colour in [(False, DECILE_COLOUR), (True, ESTIMATE_COLOUR)]:
+        rows = [row for row in monthly_totals if row["is_estimate"] == is_estimate]
+        ax.bar(
+            [row["month"] for row in rows],
+            [row["additional_cost"] for row in rows],
+            width=20,
+            color=colour,
+        )
+    ax.yaxis.set_major_formatter(StrMethodFormatter("£{x:,.0f}"))
+    return _to_png(fig, ax)
+
+
+def _render_measure_chart(org_type, org_code, measure_id, month):
+    measure = Measure.objects.get(id=measure_id)
+    org_field = {"practice": "practice_id", "pcn": "pcn_id", "ccg": "pct_id"}.get(
+        org_type, org_type + "_id"
+    )
+    values = list(
+        MeasureValue.objects.filter_by_org_type(org_type)
+        .filter(measure_id=measure_id, month__lte=month, **{org_field: org_code})
+        .order_by("month")
+        .values_list("month", "calc_value")
+    )
+    if not values:
+        raise NoChartData("No data for {} {}".format(org_type, org_code))
+    deciles = [
+        (global_month, percentiles.get(org_type) or {})
+        for global_month, percentiles in MeasureGlobal.objects.filter(
+            measure_id=measure_id, month__lte=month, percentiles__isnull=False
+        )
+        .order_by("month")
+        .values_list("month", "percentiles")
+    ]
+
+    fig, ax = _new_chart(measure.name)
+    decile_months = [decile_month for decile_month, _ in deciles]
+    for centile in CENTILES:
+        ax.plot(
+            decile_months,
+            [_or_nan(centiles.get(centile)) for _, centiles in deciles],
+            **_decile_style(centile),
+        )
+    months, calc_values = zip(*values)
+    ax.plot(
+        months,
+        [_or_nan(v) for v in calc_values],
+        color=ORG_COLOUR,
+        linewidth=2,
+        label=org_code,
+    )
+    if measure.is_percentage:
+        ax.yaxis.set_major_formatter(PercentFormatter(xmax=1.0))
+    return _to_png(fig, ax)
+
+
+def _render_analyse_chart(url, title, month):
+    params = _parse_analyse_url(url)
+    org_type = params["org"]
+    db = get_db()
+    if org_type == "all":
+        # A single line for all practices, with nothing to compare it with
+        org_ratios, org_offsets = _get_ratios(db, params, "all_practices")
+        comparison_ratios = org_ratios[:0]
+        org_ids = [None]
+    else:
+        org_ratios, org_offsets = _get_ratios(db, params, org_type)
+        parent_ids = _get_parent_org_ids(params)
+        if parent_ids:
+            # As on the analyse page, when a Sub-ICB Location is selected its
+            # members are compared only with each other
+            member_offsets = [
+                org_offsets[member_id]
+                for member_id in _get_member_org_ids(org_type, parent_ids)
+                if member_id in org_offsets
+            ]
+            if not member_offsets:
+                raise NoChartData("No prescribing for {}".format(url))
+            comparison_ratios = org_ratios[member_offsets]
+        # As on the analyse page, practices and CCGs are compared only with
+        # standard GP practices and the CCGs made up of them
+        elif org_type in STANDARD_ORG_TYPES:
+            comparison_ratios, _ = _get_ratios(db, params, STANDARD_ORG_TYPES[org_type])
+        else:
+            comparison_ratios = org_ratios
+        org_ids = [org_id for org_id in params["orgIds"] if org_id in org_offsets]
+        if params["orgIds"] and not org_ids and not parent_ids:
+            raise NoChartData("No prescribing for {}".format(url))
+
+    dates = [numpy.datetime64(date) for date in db.dates]
+    fig, ax = _new_chart(title)
+    if len(comparison_ratios):
+        with warnings.catch_warnings():
+            # Months in which no organisation prescribed give "All-NaN slice"
+            # warnings
+            warnings.simplefilter("ignore", RuntimeWarning)
+            decile_values = numpy.nanpercentile(
+                comparison_ratios, [int(c) for c in CENTILES], axis=0
+            )
+        for centile, row in zip(CENTILES, decile_values):
+            ax.plot(dates, row, **_decile_style(centile))
+    for org_id in org_ids:
+        ax.plot(
+            dates,
+            org_ratios[org_offsets[org_id]],
+            color=ORG_COLOUR,
+            linewidth=2,
+            label=org_id or "All practices",
+        )
+    ax.set_ylabel(_analyse_y_label(params))
+    return _to_png(fig, ax)
+
+
+def _get_parent_org_ids(params):
+    """
+    Return the codes of any Sub-ICB Locations given as `orgIds` for a chart
+    of practices or PCNs, which the analyse page expands to their members
+
+    Like `chart_utils.js` we recognise these by the length of their codes.
+    """
+    if params["org"] not in PARENT_ORG_TYPES:
+        return []
+    return [org_id for org_id in params["orgIds"] if len(org_id) in (3, 5)]
+
+
+def _get_member_org_ids(org_type, ccg_ids):
+    if org_type == "practice":
+        orgs = Practice.objects.filter(ccg_id__in=ccg_ids)
+    elif org_type == "pcn":
+        orgs = PCN.objects.filter(practice__ccg_id__in=ccg_ids).distinct()
+    else:
+        assert False, "Unexpected org_type {}".format(org_type)
+    return orgs.values_list("code", flat=True)
+
+
+def _parse_analyse_url(url):
+    """
+    Parse the URL fragment of an analyse page, as stored in a SearchBookmark,
+    in the same way as `analyse-hash.js`
+    """
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(url).fragment or url)
+    params = {key: values[-1] for key, values in query.items()}
+    for short, long in [
+        ("num", "numerator"),
+        ("denom", "denominator"),
+        ("numIds", "numeratorIds"),
+        ("denomIds", "denominatorIds"),
+    ]:
+        if long in params:
+            params[short] = params.pop(long)
+    for key in ("orgIds", "numIds", "denomIds"):
+        params[key] = [v for v in params.get(key, "").split(",") if v]
+    for key in ("numIds", "denomIds"):
+        params[key] = get_bnf_codes_from_number_str(params[key])
+    params["org"] = params.get("org", "CCG").lower()
+    # As in `analyse-form.js`, handle the old name for this denominator, and
+    # default to a chemical denominator if denominator IDs are given (the
+    # analyse page omits `denom=chemical` from the URLs it generates)
+    denom = params.get("denom", "nothing")
+    if denom == "star_pu_oral_antibac_items":
+        denom = "star_pu.oral_antibacterials_item"
+    if denom == "nothing" and params["denomIds"]:
+        denom = "chemical"
+    params["denom"] = denom
+    return params
+
+
+def _get_ratios(db, params, group_type):
+    """
+    Return a matrix of the ratio of numerator to denominator items for each
+    organisation and month, and a dict mapping organisation IDs to rows
+    """
+    group_by_org = get_row_grouper(group_type)
+    numerator = group_by_org.sum(_get_items(db, params["numIds"]))
+    denom = params["denom"]
+    if denom == "chemical":
+        denominator = group_by_org.sum(_get_items(db, params["denomIds"]))
+    elif denom == "nothing":
+        denominator = numpy.ones(numerator.shape)
+    else:
+        rows = list(
+            db.query("SELECT value FROM practice_statistic WHERE name = ?", [denom])
+        )
+        if not rows:
+            raise NoChartData("Unknown denominator {}".format(denom))
+        denominator = group_by_org.sum(_to_dense(rows[0][0])) / 1000.0
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        ratios = numpy.where(denominator > 0, numerator / denominator, numpy.nan)
+    return ratios, group_by_org.offsets
+
+
+def _get_items(db, bnf_code_prefixes):
+    if bnf_code_prefixes:
+        where = " OR ".join(["bnf_code LIKE ?"] * len(bnf_code_prefixes))
+        sql = "SELECT matrix_sum(items) FROM presentation WHERE {}".format(where)
+        params = [code + "%" for code in bnf_code_prefixes]
+    else:
+        sql = "SELECT items FROM all_presentations"
+        params = []
+    items = db.query_one(sql, params)[0]
+    if items is None:
+        raise NoChartData("No prescribing for {}".format(bnf_code_prefixes))
+    return _to_dense(items)
+
+
+def _analyse_y_label(params):
+    if params["denom"] == "nothing":
+        return "Items"
+    elif params["denom"] == "chemical":
+        return "Items ratio"
+    elif params["denom"] in PER_1000_DENOMINATORS or params["denom"].startswith(
+        "star_pu."
+    ):
+        return "Items per 1000 {}".format(params["denom"].replace("_", " "))
+    return ""
+
+
+def _get_org_type_and_code(org):
+    if isinstance(org, Practice):
+        return "practice", org.code
+    elif isinstance(org, PCN):
+        return "pcn", org.code
+    elif isinstance(org, PCT):
+        return "ccg", org.code
+    elif isinstance(org, STP):
+        return "stp", org.code
+    else:
+        assert False, "Unexpected org {}".format(org)
+
+
+def _new_chart(title):
+    fig = Figure(figsize=(WIDTH / DPI, HEIGHT / DPI), dpi=DPI)
+    ax = fig.add_subplot(1, 1, 1)
+    ax.set_title(title, loc="left", wrap=True)
+    ax.xaxis.set_major_formatter(DateFormatter("%b %Y"))
+    ax.spines["top"].set_visible(False)
+    ax.spines["right"].set_visible(False)
+    ax.grid(axis="y", color="#e6e6e6")
+    return fig, ax
+
+
+def _decile_style(centile):
+    if centile == "50":
+        return {"color": MEDIAN_COLOUR, "linestyle": "--", "linewidth": 1}
+    elif centile in ("10", "90"):
+        return {"color": DECILE_COLOUR, "linestyle": "--", "linewidth": 1}
+    else:
+        return {"color": DECILE_COLOUR, "linestyle": ":", "linewidth": 1}
+
+
+def _to_png(fig, ax):
+    ax.set_ylim(bottom=0)
+    fig.autofmt_xdate()
+    fig.tight_layout()
+    out = BytesIO()
+    fig.savefig(out, format="png")
+    return out.getvalue()
+
+
+def _to_dense(matrix):
+    if hasattr(matrix, "toarray"):
+        return matrix.toarray()
+    return numpy.asarray(matrix)
+
+
+def _or_nan(value):
+    return numpy.nan if value is None else value
@@ -1,16 +1,14 @@
 # -*- coding: utf-8 -*-
 import logging
-import os
 import re
-import subprocess
 import urllib.parse
+import warnings
 from datetime import date
 from html import unescape
-from tempfile import NamedTemporaryFile
 
 import numpy as np
 import pandas as pd
-from anymail.message import attach_inline_image_file
+from anymail.message import attach_inline_image
 from common.utils import email_as_text, nhs_titlecase
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
@@ -29,6 +27,7 @@ from frontend.models import (
     NCSOConcessionBookmark,
     Practice,
 )
+from frontend.views import alert_charts
 from frontend.views.spending_utils import (
     ncso_spending_breakdown_for_entity,
     ncso_spending_for_entity,
@@ -43,12 +42,6 @@ from frontend.views.views import (
 )
 from premailer import Premailer
 
-GRAB_CMD = (
-    "/usr/local/bin/phantomjs --ignore-ssl-errors=true "
-    + settings.APPS_ROOT
-    + "/frontend/management/commands/grab_chart.js"
-)
-
 logger = logging.getLogger(__name__)
 
 
@@ -232,6 +225,156 @@ class CUSUM(object):
         return cusum_pos, cusum_neg
 
 
+class CUSUMMatrix(object):
+    """Vectorised equivalent of running `CUSUM` over each row of a 2D array
+    of time series (e.g. percentiles for many measures or many orgs, by
+    month), giving exactly the same results.
+
+    We still have to step through the months one at a time, as each CUSUM
+    depends on the previous one, but at each step we deal with every series
+    at once.
+    """
+
+    def __init__(self, data, window_size=12, sensitivity=5):
+        self.data = np.array(data, dtype=float, ndmin=2)
+        self.window_size = window_size
+        self.sensitivity = sensitivity
+        not_null = ~np.isnan(self.data)
+        # Series with no data at all produce no results, as with `CUSUM`
+        self.empty = ~not_null.any(axis=1)
+        # Start far enough back that the first window includes a value
+        first_not_null = (np.cumsum(not_null, axis=1) == 0).sum(axis=1)
+        self.start_indices = np.maximum(0, first_not_null - window_size + 1)
+        self.pos_cusums = np.zeros(self.data.shape)
+        self.neg_cusums = np.zeros(self.data.shape)
+        self.target_means = np.zeros(self.data.shape)
+        self.alert_thresholds = np.zeros(self.data.shape)
+        self.alerts = np.zeros(self.data.shape, dtype=bool)
+
+    def work(self):
+        data = self.data
+        num_series = data.shape[0]
+        # Every series is reset in the first month, so these initial values
+        # are never used
+        pos_cusum = neg_cusum = np.zeros(num_series)
+        target_mean = alert_threshold = np.zeros(num_series)
+        with warnings.catch_warnings():
+            # As with `CUSUM`, windows may be empty or entirely null
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            for i in range(data.shape[1]):
+                datum = data[:, i]
+                # Note that, to match `CUSUM`, these use Python's slicing
+                # semantics, so `i - window_size` may be negative
+                window = data[:, i : self.window_size + i]
+                previous_window = data[:, i - self.window_size : i]
+                reset = i <= self.start_indices
+                within = ~(
+                    (pos_cusum > alert_threshold) | (neg_cusum < -alert_threshold)
+                )
+                moving = ~reset & ~within
+                target_mean = np.select(
+                    [reset, moving],
+                    [
+                        self.new_target_mean(window),
+                        self.new_target_mean(previous_window),
+                    ],
+                    target_mean,
+                )
+                # For series which are moving, peek ahead to see what the next
+                # CUSUM would be
+                next_pos, next_neg = self.compute_cusum(
+                    datum, target_mean, alert_threshold, pos_cusum, neg_cusum
+                )
+                going_up = (next_pos > pos_cusum) & (pos_cusum > alert_threshold)
+                going_down = (next_neg < neg_cusum) & (neg_cusum < -alert_threshold)
+                moving_reset = moving & ~(going_up | going_down)
+                alert_threshold = np.select(
+                    [reset, moving_reset],
+                    [
+                        self.new_alert_threshold(window),
+                        self.new_alert_threshold(previous_window),
+                    ],
+                    alert_threshold,
+                )
+                reset = reset | moving_reset
+                reset_pos, reset_neg = self.compute_cusum(
+                    datum, target_mean, alert_threshold
+                )
+                pos_cusum = np.where(reset, reset_pos, next_pos)
+                neg_cusum = np.where(reset, reset_neg, next_neg)
+                self.pos_cusums[:, i] = pos_cusum
+                self.neg_cusums[:, i] = neg_cusum
+                self.target_means[:, i] = target_mean
+                self.alert_thresholds[:, i] = alert_threshold
+                self.alerts[:, i] = (pos_cusum > alert_threshold) | (
+                    neg_cusum < -alert_threshold
+                )
+
+    def new_target_mean(self, window):
+        return np.nanmean(window, axis=1)
+
+    def new_alert_threshold(self, window):
+        return np.nanstd(window * self.sensitivity, axis=1)
+
+    def compute_cusum(
+        self, datum, target_mean, alert_threshold, pos_cusum=None, neg_cusum=None
+    ):
+        delta = 0.5 * alert_threshold / self.sensitivity
+        cusum_pos = datum - (target_mean + delta)
+        cusum_neg = datum - (target_mean - delta)
+        if pos_cusum is not None:
+            cusum_pos += pos_cusum
+            cusum_neg += neg_cusum
+        # Note that NaNs become zero here, as they do with `max` and `min`
+        cusum_pos = np.round(np.where(cusum_pos > 0, cusum_pos, 0), 2)
+        cusum_neg = np.round(np.where(cusum_neg < 0, cusum_neg, 0), 2)
+        return cusum_pos, cusum_neg
+
+    def as_dicts(self):
+        """Return a list of the dicts which `CUSUM.as_dict` would return for
+        each series
+        """
+        return [self.as_dict(row) for row in range(self.data.shape[0])]
+
+    def as_dict(self, row):
+        if self.empty[row]:
+            return CUSUM([None]).as_dict()
+        data = self.data[row]
+        pos = self.pos_cusums[row] > self.alert_thresholds[row]
+        neg = ~pos & self.alerts[row]
+        return {
+            "smax": list(self.pos_cusums[row]),
+            "smin": list(self.neg_cusums[row]),
+            "target_mean": list(self.target_means[row]),
+            "alert_threshold": list(self.alert_thresholds[row]),
+            "alert": list(np.flatnonzero(self.alerts[row])),
+            "alert_percentile_pos": [d if p else None for d, p in zip(data, pos)],
+            "alert_percentile_neg": [d if n else None for d, n in zip(data, neg)],
+        }
+
+    def get_last_alert_info(self):
+        """Return a list of the values which `CUSUM.get_last_alert_info` would
+        return for each series
+        """
+        return [self._get_last_alert_info(row) for row in range(self.data.shape[0])]
+
+    def _get_last_alert_info(self, row):
+        alerts = self.alerts[row]
+        # As with `CUSUM`, a lone alert in the first month doesn't count
+        if self.empty[row] or not alerts[-1] or not alerts[1:].any():
+            return None
+        end_index = start_index = len(alerts) - 1
+        while start_index > 0 and alerts[start_index - 1]:
+            start_index -= 1
+        return {
+            # Note that if the alert started in the first month this is the
+            # most recent target mean, as with `CUSUM`
+            "from": self.target_means[row][start_index - 1],
+            "to": self.data[row][end_index],
+            "period": (end_index - start_index) + 1,
+        }
+
+
 def percentiles_without_jaggedness(df2, is_percentage=False):
     """Remove records that are outside the standard error of the mean or
     where they hit 0% or 100% more than once.
@@ -343,16 +486,12 @@ class InterestingMeasureFinder(object):
         df = self.measurevalues_dataframe(
             MeasureValue.objects.filter(**measure_filter), "percentile"
         )
-        for row in df.itertuples():
-            measure = Measure.objects.get(pk=row[0])
-            percentiles = row[1:]
-            cusum = CUSUM(
-                percentiles, window_size=window, sensitivity=5, name=measure.id
-            )
-            cusum.work()
-
-            last_alert = cusum.get_last_alert_info()
+        # Run CUSUM over the percentiles for every measure at once
+        cusum = CUSUMMatrix(df.to_numpy(dtype=float), window_size=window, sensitivity=5)
+        cusum.work()
+        for measure_id, last_alert in zip(df.index, cusum.get_last_alert_info()):
             if last_alert:
+                measure = Measure.objects.get(pk=measure_id)
                 last_alert["measure"] = measure
                 if last_alert["from"] < last_alert["to"]:
                     if measure.low_is_good:
@@ -482,53 +621,16 @@ class InterestingMeasureFinder(object):
         }
 
 
-def attach_image(msg, url, file_path, selector, dimensions="1024x1024"):
-    if "selectedTab=map" in url:
-        wait = 8000
-        dimensions = "1000x600"
-    elif "selectedTab=chart" in url:
-        wait = 1000
-        dimensions = "800x600"
-    elif "selectedTab" in url:
-        wait = 500
-        dimensions = "800x600"
-    else:
-        wait = 1000
-    cmd = '{cmd} "{host}{url}" {file_path} "{selector}" {dimensions} {wait}'
-    cmd = cmd.format(
-        cmd=GRAB_CMD,
-        host=settings.GRAB_HOST,
-        url=url,
-        file_path=file_path,
-        selector=selector,
-        dimensions=dimensions,
-        wait=wait,
-    )
-    response = subprocess.run(
-        cmd,
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        universal_newlines=True,
-        # Fix for PhantomJS under new versions of Debian/Ubuntu
-        # See https://github.com/ariya/phantomjs/issues/15449
-        env=dict(os.environ, OPENSSL_CONF="/etc/ssl"),
-    )
-    if response.returncode > 0:
-        raise BadAlertImageError(
-            f"phantomjs command failed with code {response.returncode}\n\n"
-            f"cmd:\n{cmd}\n\n"
-            f"stdout:\n{response.stdout}\n\n"
-            f"stderr:\n{response.stderr}"
-        )
-    else:
-        logger.debug(
-            "Command %s completed with output %s" % (cmd, response.stdout.strip())
-        )
-    if os.path.getsize(file_path) == 0:
-        msg = "File at %s empty (generated from url %s)" % (file_path, url)
-        raise BadAlertImageError(msg)
-    return attach_inline_image_file(msg, file_path, subtype="png")
+def attach_image(msg, render_chart, *args):
+    """
+    Render a chart by calling `render_chart` with `args` and attach it to the
+    message as an inline PNG, returning its content ID
+    """
+    try:
+        image = render_chart(*args)
+    except alert_charts.NoChartData as e:
+        raise BadAlertImageError(str(e))
+    return attach_inline_image(msg, image, subtype="png")
 
 
 def getIntroText(stats, org_type):
@@ -694,51 +796,77 @@ def finalise_email(msg, template_name, context, tags):
     return msg
 
 
-def get_chart_id(measure_id):
-    return "#{}-with-title".format(measure_id)
+def get_org_email_chart_measure_ids(stats):
+    """Return the IDs of the measures whose charts are included in the email
+    for an OrgBookmark with the given stats"""
+    measure_ids = []
+    most_changing = stats["most_changing"]
+    if most_changing["declines"]:
+        measure_ids.append(most_changing["declines"][0]["measure"].id)
+    if stats["worst"]:
+        measure_ids.append(stats["worst"][0].id)
+    if stats["interesting"]:
+        measure_ids.append(stats["interesting"][0].id)
+    return measure_ids
 
 
-def make_org_email(org_bookmark, stats, tag=None):
+def render_org_email_charts(org, stats):
+    """Return a dict mapping measure IDs to PNGs of the charts included in the
+    email for an OrgBookmark with the given stats, for passing to
+    `make_org_email`
+
+    Charts for which there is no data are omitted, and so will raise
+    BadAlertImageError when the email is made.
+    """
+    charts = {}
+    for measure_id in get_org_email_chart_measure_ids(stats):
+        if measure_id in charts:
+            continue
+        try:
+            charts[measure_id] = alert_charts.measure_chart(org, measure_id)
+        except alert_charts.NoChartData:
+            pass
+    return charts
+
+
+def make_org_email(org_bookmark, stats, tag=None, charts=None):
+    """Make the email for an OrgBookmark
+
+    Charts are rendered as needed and stored in `charts`, a dict mapping
+    measure IDs to PNGs, so that they can be reused in other emails about the
+    same org.
+    """
     msg = initialise_email(org_bookmark, "dashboard-alerts")
     dashboard_uri = org_bookmark.dashboard_url()
     dashboard_uri = settings.GRAB_HOST + dashboard_uri + "?" + msg.qs
 
-    with NamedTemporaryFile(suffix=".png") as getting_worse_file:
-        most_changing = stats["most_changing"]
-        if most_changing["declines"]:
-            measure_id = most_changing["declines"][0]["measure"].id
-            getting_worse_img = attach_image(
-                msg,
-                org_bookmark.dashboard_url(measure_id),
-                getting_worse_file.name,
-                get_chart_id(measure_id),
-            )
-        else:
-            getting_worse_img = None
-
-    with NamedTemporaryFile(suffix=".png") as still_bad_file:
-        if stats["worst"]:
-            measure_id = stats["worst"][0].id
-            still_bad_img = attach_image(
-                msg,
-                org_bookmark.dashboard_url(measure_id),
-                still_bad_file.name,
-                get_chart_id(measure_id),
-            )
-        else:
-            still_bad_img = None
-
-    with NamedTemporaryFile(suffix=".png") as interesting_file:
-        if stats["interesting"]:
-            measure_id = stats["interesting"][0].id
-            interesting_img = attach_image(
-                msg,
-                org_bookmark.dashboard_url(measure_id),
-                interesting_file.name,
-                get_chart_id(measure_id),
-            )
-        else:
-            interesting_img = None
+    org = org_bookmark.get_org()
+    if charts is None:
+        charts = {}
+
+    def render_chart(measure_id):
+        if measure_id not in charts:
+            charts[measure_id] = alert_charts.measure_chart(org, measure_id)
+        return charts[measure_id]
+
+    most_changing = stats["most_changing"]
+    if most_changing["declines"]:
+        measure_id = most_changing["declines"][0]["measure"].id
+        getting_worse_img = attach_image(msg, render_chart, measure_id)
+    else:
+        getting_worse_img = None
+
+    if stats["worst"]:
+        measure_id = stats["worst"][0].id
+        still_bad_img = attach_image(msg, render_chart, measure_id)
+    else:
+        still_bad_img = None
+
+    if stats["interesting"]:
+        measure_id = stats["interesting"][0].id
+        interesting_img = attach_image(msg, render_chart, measure_id)
+    else:
+        interesting_img = None
 
     unsubscribe_link = settings.GRAB_HOST + reverse(
         "bookmarks", kwargs={"key": org_bookmark.user.profile.key}
@@ -777,13 +905,9 @@ def make_search_email(search_bookmark, tag=None):
         qs = "?" + msg.qs
     dashboard_uri = settings.GRAB_HOST + dashboard_uri + qs + "#" + parsed_url.fragment
 
-    with NamedTemporaryFile(suffix=".png") as graph_file:
-        graph = attach_image(
-            msg,
-            search_bookmark.dashboard_url(),
-            graph_file.name,
-            "#results .tab-pane.active",
-        )
+    graph = attach_image(
+        msg, alert_charts.analyse_chart, search_bookmark.url, search_bookmark.name
+    )
 
     unsubscribe_link = settings.GRAB_HOST + reverse(
         "bookmarks", kwargs={"key": search_bookmark.user.profile.key}
@@ -843,10 +967,9 @@ def make_ncso_concession_email(bookmark, tag=None):
     unsubscribe_path = reverse("bookmarks", kwargs={"key": bookmark.user.profile.key})
     unsubscribe_link = settings.GRAB_HOST + unsubscribe_path
 
-    with NamedTemporaryFile(suffix=".png") as f:
-        chart_image_cid = attach_image(
-            msg, concessions_path, f.name, "#monthly-totals-chart"
-        )
+    chart_image_cid = attach_image(
+        msg, alert_charts.ncso_concessions_chart, bookmark.entity, bookmark.entity_type
+    )
 
     context = {
         "latest_month": latest_month,
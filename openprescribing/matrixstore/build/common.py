@@ -15,9 +15,10 @@ def get_practice_stats_filename(date):
 
 def get_prescribing_filename(date):
     """
-    Return the full path to the prescribing CSV file this date
+    Return the full path to the directory of sorted prescribing columns for
+    this date (see `sort_prescribing`)
     """
-    return _get_filename(date, "prescribing")
+    return os.path.join(settings.MATRIXSTORE_IMPORT_DIR, "{}_prescribing".format(date))
 
 
 def get_filename_for_download(remote_filename):
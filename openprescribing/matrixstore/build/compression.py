@@ -0,0 +1,48 @@
+"""
+Serialize and compress matrices for the MatrixStore concurrently
+
+Compressing matrices at the higher LZ4 levels is the most expensive part of
+writing them.  `lz4` releases the GIL while compressing so we do this in a pool
+of threads, which avoids copying every matrix to another process, while the
+calling thread carries on producing matrices and writing the results to SQLite
+in their original order.
+"""
+
+import functools
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from matrixstore.serializer import DEFAULT_COMPRESSION_PROFILE, serialize_compressed
+
+MAX_WORKERS = os.cpu_count() or 1
+
+# Maximum number of items being processed, or waiting to be consumed, at once.
+# This bounds the number of matrices held in memory.
+MAX_PENDING = 64
+
+
+def get_serializer(profile=DEFAULT_COMPRESSION_PROFILE):
+    """
+    Return a function which serializes and compresses an object using the
+    given profile
+    """
+    return functools.partial(serialize_compressed, profile=profile)
+
+
+def map_in_order(function, iterable, max_workers=MAX_WORKERS, max_pending=MAX_PENDING):
+    """
+    Yield `function(item)` for each item in `iterable`, in order, running up to
+    `max_workers` calls concurrently
+
+    The iterable is consumed in the calling thread, and no more than
+    `max_pending` items are read ahead of the results consumed.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = deque()
+        for item in iterable:
+            pending.append(pool.submit(function, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -1,23 +1,26 @@
 """
-Download prescribing data from BigQuery to gzipped CSV files in the
-`settings.MATRIXSTORE_IMPORT_DIR` directory
+Download prescribing data from BigQuery to directories of sorted `.npy`
+column files (one per month) in the `settings.MATRIXSTORE_IMPORT_DIR`
+directory
 """
+
 import glob
 import logging
+import multiprocessing
 import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 from django.conf import settings
-
 from gcutils.bigquery import Client, StorageClient
 
 from .common import (
-    get_prescribing_filename,
     get_filename_for_download,
+    get_prescribing_filename,
     get_temp_filename,
 )
 from .dates import generate_dates
-from .sort_and_merge_gzipped_csv_files import sort_and_merge_gzipped_csv_files
-
+from .sort_prescribing import sort_prescribing_csv_files
 
 logger = logging.getLogger(__name__)
 
@@ -27,8 +30,28 @@ logger = logging.getLogger(__name__)
 # the export has finished using the suffix below
 SENTINEL_SUFFIX = "done"
 
+# Maximum number of months for which BigQuery extract and export jobs are in
+# flight at once
+MAX_BIGQUERY_JOBS = 4
+
+# Maximum number of shard files being downloaded at once, across all months
+MAX_DOWNLOADS = 8
 
-def download_prescribing(end_date, months=None):
+# Maximum number of months being consolidated at once.  Each consolidation is
+# an external merge sort in NumPy (see `sort_prescribing`) which is CPU and disk
+# bound, so there's no point running more of these than we have cores.
+MAX_CONSOLIDATIONS = min(4, os.cpu_count() or 1)
+
+
+def download_prescribing(
+    end_date,
+    months=None,
+    bq_client=None,
+    bucket=None,
+    max_bigquery_jobs=MAX_BIGQUERY_JOBS,
+    max_downloads=MAX_DOWNLOADS,
+    max_consolidations=MAX_CONSOLIDATIONS,
+):
     # Getting a local copy of prescribing data for a given month is a
     # multi-stage process:
     #
@@ -38,8 +61,10 @@ def download_prescribing(end_date, months=None):
     #    into multiple files)
     # 3. Download those shard files
     # 4. Consolidate the shards into a single file, sorted by BNF code
-    bq_client = Client("prescribing_export")
-    bucket = StorageClient().bucket()
+    if bq_client is None:
+        bq_client = Client("prescribing_export")
+    if bucket is None:
+        bucket = StorageClient().bucket()
     # To determine what steps to execute we need to work backwards through this
     # process. For instance, if we already have data downloaded for a given
     # date then there is no point checking whether the corresponding files
@@ -51,26 +76,85 @@ def download_prescribing(end_date, months=None):
     dates_to_download = filter_dates_to_download(dates_to_consolidate)
     dates_to_export = filter_dates_to_export(dates_to_download, bucket)
     dates_to_extract = filter_dates_to_extract(dates_to_export, bq_client)
-    # Once we know what needs doing we loop over the required dates and carry
-    # out the tasks. There's obvious scope for speeding this up by doing things
-    # in parallel, but we keep it simple for now.
-    for date in dates:
-        if date in dates_to_extract:
-            extract_data_for_date(date, bq_client)
+    logger.info(
+        "Of %s months: %s to extract, %s to export, %s to download, "
+        "%s to consolidate",
+        len(dates),
+        len(dates_to_extract),
+        len(dates_to_export),
+        len(dates_to_download),
+        len(dates_to_consolidate),
+    )
+    # Each month passes through the stages above in order, but different
+    # months can be at different stages at the same time.  We run each month
+    # in its own (mostly idle) thread, and bound the concurrency of each stage
+    # separately: a semaphore limits the number of months with BigQuery jobs
+    # in flight, downloads of individual shards go to a shared thread pool,
+    # and consolidation goes to a pool of processes.
+    #
+    # If anything fails the months which were completed stay completed, so
+    # re-running picks up where we left off.
+    bigquery_slots = threading.Semaphore(max_bigquery_jobs)
+    progress = Progress(len(dates_to_consolidate))
+    # We use "spawn" rather than "fork" because forking a process which is
+    # running other threads is unsafe
+    mp_context = multiprocessing.get_context("spawn")
+
+    def process_date(date):
         if date in dates_to_export:
-            export_data_for_date(date, bq_client, bucket)
+            with bigquery_slots:
+                if date in dates_to_extract:
+                    extract_data_for_date(date, bq_client)
+                export_data_for_date(date, bq_client, bucket)
         if date in dates_to_download:
-            download_data_for_date(date, bucket)
+            download_data_for_date(date, bucket, download_pool)
         if date in dates_to_consolidate:
-            consolidate_data_for_date(date)
+            consolidate_data_for_date(date, consolidate_pool)
+            progress.completed(date)
         clean_up_downloaded_files(date)
 
+    with ThreadPoolExecutor(
+        max_workers=max_downloads
+    ) as download_pool, ProcessPoolExecutor(
+        max_workers=max_consolidations, mp_context=mp_context
+    ) as consolidate_pool, ThreadPoolExecutor(
+        max_workers=max(len(dates), 1)
+    ) as date_pool:
+        futures = [date_pool.submit(process_date, date) for date in dates]
+        # Wait for every month to finish, even if one fails, so that as much
+        # work as possible is saved for next time
+        errors = [
+            future.exception()
+            for future in as_completed(futures)
+            if future.exception() is not None
+        ]
+    if errors:
+        raise errors[0]
+
+
+class Progress:
+    """
+    Log the number of months consolidated so far
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def completed(self, date):
+        with self.lock:
+            self.count += 1
+            logger.info(
+                "Consolidated data for %s (%s/%s months)", date, self.count, self.total
+            )
+
 
 def filter_dates_to_consolidate(dates):
     """
-    Return only those dates for which a consolidated prescribing file (i.e. a
-    single gzipped CSV file containing all prescribing for a given month) does
-    not exist
+    Return only those dates for which consolidated prescribing data (i.e. a
+    single directory of sorted columns containing all prescribing for a given
+    month) does not exist
     """
     return [
         date for date in dates if not os.path.exists(get_prescribing_filename(date))
@@ -168,45 +252,56 @@ def export_data_for_date(date, bq_client, bucket):
     bucket.blob(sentinel_file).upload_from_string("done")
 
 
-def download_data_for_date(date, bucket):
+def download_data_for_date(date, bucket, pool):
     """
     Download exported prescribing data for the given date from Google Cloud
-    Storage
+    Storage, fetching shards concurrently using the supplied thread pool
     """
     prefix = remote_storage_prefix_for_date(date)
-    blobs = bucket.list_blobs(prefix=prefix)
-    # Sort the files so we always download the sentinel file last
-    blobs = sorted(blobs, key=lambda blob: blob.name)
+    blobs = list(bucket.list_blobs(prefix=prefix))
+    # Download the sentinel file last, so that its presence locally means that
+    # all the shards have been downloaded
+    sentinel_name = prefix + SENTINEL_SUFFIX
+    shards = [blob for blob in blobs if blob.name != sentinel_name]
+    sentinels = [blob for blob in blobs if blob.name == sentinel_name]
     logger.info(
-        "Downloading %s files from gs://%s/%s*", len(blobs), bucket.name, prefix
+        "Downloading %s files from gs://%s/%s*", len(shards), bucket.name, prefix
     )
-    for blob in blobs:
-        local_name = get_filename_for_download(blob.name)
-        if not os.path.exists(local_name):
-            temp_name = get_temp_filename(local_name)
-            blob.download_to_filename(temp_name)
-            os.rename(temp_name, local_name)
-            logger.info("Downloaded %s", blob.name)
+    for future in [pool.submit(download_blob, blob) for blob in shards]:
+        future.result()
+    for blob in sentinels:
+        download_blob(blob)
     if not download_is_complete(date):
         raise RuntimeError(
             "Export for {date} looks incomplete (no sentinel file)".format(date=date)
         )
 
 
-def consolidate_data_for_date(date):
+def download_blob(blob):
+    local_name = get_filename_for_download(blob.name)
+    if not os.path.exists(local_name):
+        temp_name = get_temp_filename(local_name)
+        blob.download_to_filename(temp_name)
+        os.rename(temp_name, local_name)
+        logger.info("Downloaded %s", blob.name)
+
+
+def consolidate_data_for_date(date, pool):
     """
-    Consolidate downloaded prescribing data for the given date into a single
-    gzipped CSV file, sorted by (bnf_code, practice, month)
+    Consolidate downloaded prescribing data for the given date into a
+    directory of columns, sorted by (bnf_code, practice), using the supplied
+    process pool
+
+    The sort itself needs no access to settings so it can run in a freshly
+    spawned process.
     """
     pattern = "{}*.csv.gz".format(local_storage_prefix_for_date(date))
-    input_files = glob.glob(pattern)
-    target_file = get_prescribing_filename(date)
-    temp_file = get_temp_filename(target_file)
-    logger.info("Consolidating %s data files into %s", len(input_files), target_file)
-    sort_and_merge_gzipped_csv_files(
-        input_files, temp_file, ("bnf_code", "practice", "month")
-    )
-    os.rename(temp_file, target_file)
+    input_files = sorted(glob.glob(pattern))
+    target_dir = get_prescribing_filename(date)
+    temp_dir = get_temp_filename(target_dir)
+    logger.info("Consolidating %s data files into %s", len(input_files), target_dir)
+    pool.submit(sort_prescribing_csv_files, input_files, temp_dir).result()
+    os.rename(temp_dir, target_dir)
 
 
 def clean_up_downloaded_files(date):
@@ -5,7 +5,7 @@ import os.path
 import sqlite3
 
 
-def generate_filename(sqlite_path):
+def generate_filename(sqlite_path, content_hash=None):
     """
     Generates a name for the supplied MatrixStore file which includes various
     details about it
@@ -14,10 +14,14 @@ def generate_filename(sqlite_path):
     latest build of the latest data. It includes a hash of the file's contents
     which can be used as a cache key and also for de-duplication (so it's easy
     to see if rebuilding a file has resulted in any change to the data).
+
+    If a hash of the file's contents has already been computed (e.g. by
+    `manifest.compute_manifest`) it can be supplied as `content_hash` to avoid
+    hashing the file again.
     """
     last_modified = datetime.datetime.utcfromtimestamp(os.path.getmtime(sqlite_path))
     max_date = get_max_date_from_file(sqlite_path)
-    hash_str = hash_file(sqlite_path)
+    hash_str = content_hash or hash_file(sqlite_path)
     return "matrixstore_{max_date}_{modified}_{hash}.sqlite".format(
         max_date=max_date.strftime("%Y-%m"),
         modified=last_modified.strftime("%Y-%m-%d--%H-%M"),
@@ -1,64 +1,71 @@
 """
 Import practice statistics from downloaded CSV files into SQLite
 """
-import csv
-import gzip
+
 import json
 import logging
 import os.path
 import sqlite3
+from collections import namedtuple
 
-from matrixstore.matrix_ops import sparse_matrix, finalise_matrix
-from matrixstore.serializer import serialize_compressed
+import numpy
+import pandas
+from matrixstore.matrix_ops import finalise_dense_matrix, is_integer
+from matrixstore.serializer import DEFAULT_COMPRESSION_PROFILE
 
 from .common import get_practice_stats_filename
-
+from .compression import get_serializer, map_in_order
 
 logger = logging.getLogger(__name__)
 
 
+# Each CSV file of practice statistics is read as a batch of columns: the
+# practice code and date of each row, and a dict mapping each statistic name to
+# an array of its values
+PracticeStatistics = namedtuple("PracticeStatistics", ["practices", "dates", "values"])
+
+
 class MissingHeaderError(Exception):
     pass
 
 
-def import_practice_stats(sqlite_path):
+def import_practice_stats(sqlite_path, compression_profile=DEFAULT_COMPRESSION_PROFILE):
     if not os.path.exists(sqlite_path):
         raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
     connection = sqlite3.connect(sqlite_path)
     dates = [date for (date,) in connection.execute("SELECT date FROM date")]
     practice_statistics = get_practice_statistics_for_dates(dates)
-    write_practice_stats(connection, practice_statistics)
+    write_practice_stats(
+        connection, practice_statistics, compression_profile=compression_profile
+    )
     connection.commit()
     connection.close()
 
 
-def write_practice_stats(connection, practice_statistics):
+def write_practice_stats(
+    connection, practice_statistics, compression_profile=DEFAULT_COMPRESSION_PROFILE
+):
     cursor = connection.cursor()
     # Map practice codes and date strings to their corresponding row/column in
     # the matrix
     practices = dict(cursor.execute("SELECT code, offset FROM practice"))
     dates = dict(cursor.execute("SELECT date, offset FROM date"))
     matrices = build_matrices(practice_statistics, practices, dates)
-    for statistic_name, matrix in matrices:
-        # Once we can use SQLite v3.24.0 which has proper UPSERT support we
-        # won't need to do this
-        cursor.execute(
-            "INSERT OR IGNORE INTO practice_statistic (name) VALUES (?)",
-            [statistic_name],
-        )
-        cursor.execute(
-            """
-            UPDATE practice_statistic SET value=? WHERE name=?
-            """,
-            [serialize_compressed(matrix), statistic_name],
-        )
+    serialize = get_serializer(compression_profile)
+    serialized_matrices = map_in_order(
+        lambda item: (item[0], serialize(item[1])), matrices
+    )
+    # Matrices are built in order of name, so the table is written
+    # sequentially
+    cursor.executemany(
+        "INSERT INTO practice_statistic (name, value) VALUES (?, ?)",
+        serialized_matrices,
+    )
 
 
 def get_practice_statistics_for_dates(dates):
     """
-    Yield all practice statistics for the given dates as tuples of the form:
-
-        statistic_name, practice_code, date, statistic_value
+    Yield a PracticeStatistics batch for each of the given dates
     """
     dates = sorted(dates)
     filenames = [get_practice_stats_filename(date) for date in dates]
@@ -71,49 +78,64 @@ def get_practice_statistics_for_dates(dates):
         )
     for filename in filenames:
         logger.info("Reading practice statistics from %s", filename)
-        with gzip.open(filename, "rt") as f:
-            for row in parse_practice_statistics_csv(f):
-                yield row
+        yield read_practice_statistics_csv(filename)
 
 
-def parse_practice_statistics_csv(input_stream):
+def read_practice_statistics_csv(filepath_or_buffer):
     """
-    Accepts a stream of CSV and yields practice stastics as tuples of the form:
-
-        statistic_name, practice_code, date, statistic_value
+    Accepts a path to a (possibly gzipped) CSV file, or a stream of CSV, and
+    returns its contents as a single PracticeStatistics batch
     """
-    reader = csv.reader(input_stream)
-    headers = next(reader)
-    try:
-        date_col = headers.index("month")
-        practice_col = headers.index("practice")
-        star_pu_col = headers.index("star_pu")
-    except ValueError as e:
-        raise MissingHeaderError(str(e))
-    other_headers = [
-        (i, header)
-        for (i, header) in enumerate(headers)
-        if i not in (date_col, practice_col, star_pu_col) and header != "pct_id"
-    ]
-    for row in reader:
-        # We only need the YYYY-MM-DD part of the date
-        date = row[date_col][:10]
+    df = pandas.read_csv(
+        filepath_or_buffer,
+        dtype={"month": str, "practice": str, "star_pu": str, "pct_id": str},
+        keep_default_na=False,
+        # Parse floats exactly as Python's `float` does
+        float_precision="round_trip",
+    )
+    missing_headers = {"month", "practice", "star_pu"} - set(df.columns)
+    if missing_headers:
+        raise MissingHeaderError(
+            "Missing headers: {}".format(", ".join(sorted(missing_headers)))
+        )
+    values = {
+        statistic_name: to_numeric(df[statistic_name])
+        for statistic_name in df.columns
+        if statistic_name not in ("month", "practice", "star_pu", "pct_id")
+    }
+    # Decoding all the STAR-PU values for the batch in a single call is much
+    # faster than decoding them row by row
+    star_pu = pandas.DataFrame.from_records(
+        json.loads("[{}]".format(",".join(df["star_pu"]))), index=df.index
+    )
+    for star_pu_name in star_pu.columns:
+        # A value missing for some practices is treated as zero, as it would
+        # be in a sparse matrix
+        values["star_pu." + star_pu_name] = to_numeric(star_pu[star_pu_name].fillna(0))
+    return PracticeStatistics(
         # These sometimes have trailing spaces in the CSV
-        practice = row[practice_col].strip()
-        for i, statistic_name in other_headers:
-            value_str = row[i]
-            value = float(value_str) if "." in value_str else int(value_str)
-            yield statistic_name, practice, date, value
-        star_pu = json.loads(row[star_pu_col])
-        for star_pu_name, value in star_pu.items():
-            yield "star_pu." + star_pu_name, practice, date, value
+        practices=df["practice"].str.strip().to_numpy(),
+        # We only need the YYYY-MM-DD part of the date
+        dates=df["month"].str[:10].to_numpy(),
+        values=values,
+    )
+
+
+def to_numeric(series):
+    """
+    Return the values of `series` as an array of int64 if they are all
+    integers, or float64 otherwise
+    """
+    if numpy.issubdtype(series.dtype, numpy.integer):
+        return series.to_numpy(dtype=numpy.int64)
+    return series.to_numpy(dtype=numpy.float64)
 
 
 def build_matrices(practice_statistics, practices, dates):
     """
-    Accepts an iterable of practice statistics, plus mappings of pratice codes
-    and date strings to their respective row/column offsets. Yields pairs of
-    the form:
+    Accepts an iterable of PracticeStatistics batches, plus mappings of
+    pratice codes and date strings to their respective row/column offsets.
+    Yields pairs of the form:
 
         statistic_name, matrix
 
@@ -123,23 +145,31 @@ def build_matrices(practice_statistics, practices, dates):
     max_row = max(practices.values())
     max_col = max(dates.values())
     shape = (max_row + 1, max_col + 1)
+    practice_codes = pandas.Index(list(practices))
+    practice_offsets = numpy.array(list(practices.values()))
     matrices = {}
-    for statistic_name, practice, date, value in practice_statistics:
-        try:
-            practice_offset = practices[practice]
-        except KeyError:
-            # Because we download all practice statistics for a given date
-            # range we end up including practices which have not prescribed at
-            # all during this period and hence which aren't included in our
-            # list of known practices. We just want to ignore these.
-            continue
-        date_offset = dates[date]
-        try:
-            matrix = matrices[statistic_name]
-        except KeyError:
-            matrix = sparse_matrix(shape, integer=isinstance(value, int))
-            matrices[statistic_name] = matrix
-        matrix[practice_offset, date_offset] = value
+    for batch in practice_statistics:
+        rows = practice_codes.get_indexer(batch.practices)
+        # Because we download all practice statistics for a given date range
+        # we end up including practices which have not prescribed at all
+        # during this period and hence which aren't included in our list of
+        # known practices. We just want to ignore these.
+        known = rows != -1
+        rows = practice_offsets[rows[known]]
+        unique_dates, inverse = numpy.unique(batch.dates, return_inverse=True)
+        cols = numpy.array([dates[date] for date in unique_dates], dtype=int)
+        cols = cols[inverse][known]
+        for statistic_name, values in batch.values.items():
+            matrix = matrices.get(statistic_name)
+            if matrix is None:
+                # Practice statistics are dense so there's no advantage to
+                # building sparse matrices
+                matrix = numpy.zeros(shape, dtype=values.dtype)
+                matrices[statistic_name] = matrix
+            elif is_integer(matrix) and not is_integer(values):
+                matrix = matrix.astype(numpy.float64)
+                matrices[statistic_name] = matrix
+            matrix[rows, cols] = values[known]
     logger.info("Writing %s practice statistics matrices to SQLite", len(matrices))
     for statistic_name, matrix in sorted(matrices.items()):
-        yield statistic_name, finalise_matrix(matrix)
+        yield statistic_name, finalise_dense_matrix(matrix)
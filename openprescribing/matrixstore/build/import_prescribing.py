@@ -1,191 +1,207 @@
 """
-Import prescribing data from CSV files into SQLite
+Import prescribing data from sorted column files (see `sort_prescribing`) into
+SQLite
 """
-from collections import namedtuple
-import csv
-from itertools import groupby
+
 import logging
 import os
 import sqlite3
-import gzip
-import heapq
+from collections import namedtuple
 
-from matrixstore.matrix_ops import sparse_matrix, finalise_matrix
-from matrixstore.serializer import serialize_compressed
+import numpy
+import scipy.sparse
+from matrixstore.matrix_ops import finalise_matrix
+from matrixstore.serializer import DEFAULT_COMPRESSION_PROFILE
 
 from .common import get_prescribing_filename
-
+from .compression import get_serializer, map_in_order
+from .sort_prescribing import read_prescribing_file
 
 logger = logging.getLogger(__name__)
 
 
 MatrixRow = namedtuple("MatrixRow", "bnf_code items quantity actual_cost net_cost")
 
-
-class MissingHeaderError(Exception):
-    pass
+VALUE_COLUMNS = ["items", "quantity", "actual_cost", "net_cost"]
 
 
-def import_prescribing(filename):
+def import_prescribing(
+    filename, bnf_map=None, compression_profile=DEFAULT_COMPRESSION_PROFILE
+):
     if not os.path.exists(filename):
         raise RuntimeError("No SQLite file at: {}".format(filename))
     connection = sqlite3.connect(filename)
     # Trade crash-safety for insert speed
     connection.execute("PRAGMA synchronous=OFF")
     dates = [date for (date,) in connection.execute("SELECT date FROM date")]
-    prescriptions = get_prescriptions_for_dates(dates)
-    write_prescribing(connection, prescriptions)
+    prescribing_by_date = get_prescribing_for_dates(dates)
+    write_prescribing(
+        connection,
+        prescribing_by_date,
+        bnf_map=bnf_map,
+        compression_profile=compression_profile,
+    )
     connection.commit()
     connection.close()
 
 
-def write_prescribing(connection, prescriptions):
+def write_prescribing(
+    connection,
+    prescribing_by_date,
+    bnf_map=None,
+    compression_profile=DEFAULT_COMPRESSION_PROFILE,
+):
+    """
+    Write matrices for every presentation, given a dict mapping date strings
+    to the PrescribingColumns for that month, and a dict mapping old BNF codes
+    to their current versions (see `update_bnf_map`)
+    """
     cursor = connection.cursor()
     # Map practice codes and date strings to their corresponding row/column
     # offset in the matrix
     practices = dict(cursor.execute("SELECT code, offset FROM practice"))
     dates = dict(cursor.execute("SELECT date, offset FROM date"))
-    matrices = build_matrices(prescriptions, practices, dates)
-    rows = format_as_sql_rows(matrices, connection)
+    matrices = build_matrices(prescribing_by_date, practices, dates, bnf_map or {})
+    rows = format_as_sql_rows(matrices, compression_profile)
+    # Matrices are built in order of BNF code, so both the table and its
+    # primary key index are written sequentially and packed tightly, with no
+    # need to VACUUM afterwards
     cursor.executemany(
         """
-        UPDATE presentation SET items=?, quantity=?, actual_cost=?, net_cost=?
-        WHERE bnf_code=?
+        INSERT INTO presentation (items, quantity, actual_cost, net_cost, bnf_code)
+        VALUES (?, ?, ?, ?, ?)
         """,
         rows,
     )
 
 
-def get_prescriptions_for_dates(dates):
+def get_prescribing_for_dates(dates):
     """
-    Yield all prescribing data for the given dates as tuples of the form:
-
-        bnf_code, practice_code, date, items, quantity, actual_cost, net_cost
-
-    sorted by bnf_code, practice and date.
+    Return a dict mapping each of the given dates to its (memory-mapped)
+    PrescribingColumns
     """
-    dates = sorted(dates)
-    filenames = [get_prescribing_filename(date) for date in dates]
-    missing_files = [f for f in filenames if not os.path.exists(f)]
+    filenames = {date: get_prescribing_filename(date) for date in dates}
+    missing_files = [f for f in filenames.values() if not os.path.exists(f)]
     if missing_files:
         raise RuntimeError(
-            "Some required CSV files were missing:\n  {}".format(
-                "\n  ".join(missing_files)
+            "Some required prescribing files were missing:\n  {}".format(
+                "\n  ".join(sorted(missing_files))
             )
         )
-    prescribing_streams = [read_gzipped_prescribing_csv(f) for f in filenames]
-    # We assume that the input files are already sorted by (bnf_code, practice,
-    # month) so to ensure that the combined stream is sorted we just need to
-    # merge them correctly, which heapq.merge handles nicely for us
-    return heapq.merge(*prescribing_streams)
-
-
-def read_gzipped_prescribing_csv(filename):
-    with gzip.open(filename, "rt") as f:
-        for row in parse_prescribing_csv(f):
-            yield row
-
-
-def parse_prescribing_csv(input_stream):
-    """
-    Accepts a stream of CSV and yields prescribing data as tuples of the form:
-
-        bnf_code, practice_code, date, items, quantity, actual_cost, net_cost
-    """
-    reader = csv.reader(input_stream)
-    headers = next(reader)
-    try:
-        bnf_code_col = headers.index("bnf_code")
-        practice_col = headers.index("practice")
-        date_col = headers.index("month")
-        items_col = headers.index("items")
-        quantity_col = headers.index("quantity")
-        actual_cost_col = headers.index("actual_cost")
-        net_cost_col = headers.index("net_cost")
-    except ValueError as e:
-        raise MissingHeaderError(str(e))
-    for row in reader:
-        yield (
-            # These sometimes have trailing spaces in the CSV
-            row[bnf_code_col].strip(),
-            row[practice_col].strip(),
-            # We only need the YYYY-MM-DD part of the date
-            row[date_col][:10],
-            int(row[items_col]),
-            float(row[quantity_col]),
-            pounds_to_pence(row[actual_cost_col]),
-            pounds_to_pence(row[net_cost_col]),
-        )
-
+    return {date: read_prescribing_file(f) for date, f in filenames.items()}
 
-def pounds_to_pence(value):
-    return int(round(float(value) * 100))
 
-
-def build_matrices(prescriptions, practices, dates):
+def build_matrices(prescribing_by_date, practices, dates, bnf_map):
     """
-    Accepts an iterable of prescriptions plus mappings of pratice codes and
-    date strings to their respective row/column offsets. Yields tuples of the
-    form:
+    Accepts a dict mapping date strings to PrescribingColumns, mappings of
+    practice codes and date strings to their respective row/column offsets,
+    and a mapping of old BNF codes to new.  Yields tuples of the form:
 
         bnf_code, items_matrix, quantity_matrix, actual_cost_matrix, net_cost_matrix
 
     Where the matrices contain the prescribed values for that presentation for
-    every practice and date.
+    every practice and date, in order of BNF code.
+
+    Each month's data is indexed by BNF code, so the values for a presentation
+    can be gathered directly from the columns of every month without reading
+    any other rows.  Prescribing under old BNF codes is gathered along with
+    prescribing under the current code, and any values for the same practice
+    and month are summed.
     """
     max_row = max(practices.values())
     max_col = max(dates.values())
     shape = (max_row + 1, max_col + 1)
-    grouped_by_bnf_code = groupby(prescriptions, lambda row: row[0])
-    for bnf_code, row_group in grouped_by_bnf_code:
-        items_matrix = sparse_matrix(shape, integer=True)
-        quantity_matrix = sparse_matrix(shape, integer=False)
-        actual_cost_matrix = sparse_matrix(shape, integer=True)
-        net_cost_matrix = sparse_matrix(shape, integer=True)
-        for _, practice, date, items, quantity, actual_cost, net_cost in row_group:
-            practice_offset = practices[practice]
-            date_offset = dates[date]
-            items_matrix[practice_offset, date_offset] = items
-            quantity_matrix[practice_offset, date_offset] = quantity
-            actual_cost_matrix[practice_offset, date_offset] = actual_cost
-            net_cost_matrix[practice_offset, date_offset] = net_cost
+    months = []
+    all_bnf_codes = set()
+    old_bnf_codes = set()
+    for date, columns in prescribing_by_date.items():
+        # Map the month's practice indices to matrix rows
+        practice_rows = numpy.array(
+            [practices[code] for code in columns.practice_codes.astype(str)],
+            dtype=numpy.int64,
+        )
+        # Map each (current) BNF code to the ranges of rows containing its
+        # prescribing
+        ranges = {}
+        for bnf_code, start, end in zip(
+            columns.bnf_codes.astype(str), columns.offsets[:-1], columns.offsets[1:]
+        ):
+            if bnf_code in bnf_map:
+                old_bnf_codes.add(bnf_code)
+                bnf_code = bnf_map[bnf_code]
+            ranges.setdefault(bnf_code, []).append((start, end))
+        all_bnf_codes.update(ranges)
+        months.append((dates[date], practice_rows, ranges, columns))
+    logger.info("Building matrices for %s presentations", len(all_bnf_codes))
+    if old_bnf_codes:
+        logger.info(
+            "Moving prescribing data from %s old BNF codes to their current versions",
+            len(old_bnf_codes),
+        )
+    for bnf_code in sorted(all_bnf_codes):
+        rows = []
+        cols = []
+        values = {name: [] for name in VALUE_COLUMNS}
+        for date_offset, practice_rows, ranges, columns in months:
+            for start, end in ranges.get(bnf_code, []):
+                rows.append(practice_rows[columns.practice_index[start:end]])
+                cols.append(numpy.full(end - start, date_offset))
+                for name in VALUE_COLUMNS:
+                    values[name].append(getattr(columns, name)[start:end])
+        rows = numpy.concatenate(rows)
+        cols = numpy.concatenate(cols)
         yield MatrixRow(
             bnf_code,
-            finalise_matrix(items_matrix),
-            finalise_matrix(quantity_matrix),
-            finalise_matrix(actual_cost_matrix),
-            finalise_matrix(net_cost_matrix),
+            *[
+                build_matrix(numpy.concatenate(values[name]), rows, cols, shape)
+                for name in VALUE_COLUMNS
+            ],
         )
 
 
-def format_as_sql_rows(matrices, connection):
+def build_matrix(values, rows, cols, shape):
+    # Any duplicate entries, from prescribing under old and new BNF codes, are
+    # summed here
+    matrix = scipy.sparse.csc_matrix((values, (rows, cols)), shape=shape)
+    # Zero values weren't stored when we populated matrices element by
+    # element, so we drop them here for consistency
+    matrix.eliminate_zeros()
+    return finalise_matrix(matrix)
+
+
+def format_as_sql_rows(matrices, compression_profile=DEFAULT_COMPRESSION_PROFILE):
     """
     Given an iterable of MatrixRows (which contain a BNF code plus all
     prescribing data for that presentation) yield tuples of values ready for
     insertion into SQLite
+
+    Matrices are serialized concurrently (see `compression`) while further
+    MatrixRows are built.
+    """
+    serialize = get_serializer(compression_profile)
+
+    def format_row(row):
+        return (
+            serialize(row.items),
+            serialize(row.quantity),
+            serialize(row.actual_cost),
+            serialize(row.net_cost),
+            row.bnf_code,
+        )
+
+    yield from map_in_order(format_row, log_progress(matrices))
+
+
+def log_progress(matrices):
+    """
+    Pass through the supplied MatrixRows, logging progress
     """
-    cursor = connection.cursor()
-    num_presentations = next(cursor.execute("SELECT COUNT(*) FROM presentation"))[0]
     count = 0
     for row in matrices:
         count += 1
-        # We make sure we have a row for every BNF code in the data, even ones
-        # we didn't know about previously. This is a hack that we won't need
-        # once we can use SQLite v3.24.0 which has proper UPSERT support.
-        cursor.execute(
-            "INSERT OR IGNORE INTO presentation (bnf_code) VALUES (?)", [row.bnf_code]
-        )
         if should_log_message(count):
-            logger.info(
-                "Writing data for %s (%s/%s)", row.bnf_code, count, num_presentations
-            )
-        yield (
-            serialize_compressed(row.items),
-            serialize_compressed(row.quantity),
-            serialize_compressed(row.actual_cost),
-            serialize_compressed(row.net_cost),
-            row.bnf_code,
-        )
+            logger.info("Writing data for %s (%s)", row.bnf_code, count)
+        yield row
     logger.info("Finished writing data for %s presentations", count)
 
 
@@ -4,6 +4,7 @@ statistics imported into it.
 
 Data on practices and presentations is obtained by connecting to BigQuery.
 """
+
 import logging
 import os
 import sqlite3
@@ -13,10 +14,14 @@ from gcutils.bigquery import Client
 from .common import get_temp_filename
 from .dates import generate_dates
 
-
 logger = logging.getLogger(__name__)
 
 
+# Most matrices are too large to fit in a single page and are stored in chains
+# of overflow pages, so we use the largest page size SQLite supports to keep
+# these chains short
+PAGE_SIZE = 65536
+
 SCHEMA_SQL = """
     CREATE TABLE presentation (
         bnf_code TEXT,
@@ -78,6 +83,8 @@ def init_db(end_date, sqlite_path, months=None):
     temp_filename = get_temp_filename(sqlite_path)
     sqlite_conn = sqlite3.connect(temp_filename)
     bq_conn = Client("hscic")
+    # This must be set before any tables are created
+    sqlite_conn.execute("PRAGMA page_size = {}".format(PAGE_SIZE))
     sqlite_conn.executescript(SCHEMA_SQL)
     dates = generate_dates(end_date, months=months)
     import_dates(sqlite_conn, dates)
@@ -0,0 +1,135 @@
+"""
+Manifests describing the contents of MatrixStore files
+
+Each build writes a JSON manifest alongside the SQLite file, recording the
+file's size and, for each table, its number of rows and a checksum of its
+contents.  `matrixstore_set_live` checks a file against its manifest before
+making it live.  Comparing sizes and row counts is quick and catches truncated
+or partially copied files; comparing checksums requires reading every row.
+
+Checksums are computed from the rows themselves rather than the bytes of the
+file, so they don't depend on how SQLite has laid out its pages.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+
+
+class ManifestError(Exception):
+    pass
+
+
+def get_manifest_filename(sqlite_path):
+    return os.path.splitext(sqlite_path)[0] + ".manifest.json"
+
+
+def compute_manifest(sqlite_path):
+    """
+    Return the manifest for the given MatrixStore file as a dict
+    """
+    connection = sqlite3.connect(sqlite_path)
+    tables = {}
+    for table in get_table_names(connection):
+        hashobj = hashlib.sha256()
+        count = 0
+        for row in connection.execute("SELECT * FROM {} ORDER BY rowid".format(table)):
+            hash_row(hashobj, row)
+            count += 1
+        tables[table] = {"rows": count, "sha256": hashobj.hexdigest()}
+    connection.close()
+    # A hash of all the table checksums identifies the file's contents
+    content_hash = hashlib.sha256(json.dumps(tables, sort_keys=True).encode("utf8"))
+    return {
+        "size": os.path.getsize(sqlite_path),
+        "sha256": content_hash.hexdigest(),
+        "tables": tables,
+    }
+
+
+def write_manifest(manifest, sqlite_path):
+    with open(get_manifest_filename(sqlite_path), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def read_manifest(sqlite_path):
+    filename = get_manifest_filename(sqlite_path)
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise ManifestError("No manifest found at: {}".format(filename))
+
+
+def verify_manifest(sqlite_path, checksums=False):
+    """
+    Raise ManifestError if the given MatrixStore file doesn't match its
+    manifest
+
+    By default we only compare the file size, the set of tables and their row
+    counts.  If `checksums` is True we compare the full contents of every
+    table, which is much slower.
+    """
+    manifest = read_manifest(sqlite_path)
+    size = os.path.getsize(sqlite_path)
+    if size != manifest["size"]:
+        raise ManifestError(
+            "Expected {} to be {} bytes but it is {} bytes".format(
+                sqlite_path, manifest["size"], size
+            )
+        )
+    if checksums:
+        tables = compute_manifest(sqlite_path)["tables"]
+    else:
+        connection = sqlite3.connect(sqlite_path)
+        tables = {
+            table: {
+                "rows": connection.execute(
+                    "SELECT COUNT(*) FROM {}".format(table)
+                ).fetchone()[0]
+            }
+            for table in get_table_names(connection)
+        }
+        connection.close()
+    if set(tables) != set(manifest["tables"]):
+        raise ManifestError(
+            "Expected tables {} in {} but found {}".format(
+                sorted(manifest["tables"]), sqlite_path, sorted(tables)
+            )
+        )
+    for table, details in tables.items():
+        for key, value in details.items():
+            expected = manifest["tables"][table][key]
+            if value != expected:
+                raise ManifestError(
+                    "Expected {} of {} in {} to be {} but found {}".format(
+                        key, table, sqlite_path, expected, value
+                    )
+                )
+
+
+def get_table_names(connection):
+    return [
+        name
+        for (name,) in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' ORDER BY name"
+        )
+    ]
+
+
+def hash_row(hashobj, row):
+    # Each value is prefixed with its type and length so that different rows
+    # can't produce the same sequence of bytes
+    for value in row:
+        if value is None:
+            hashobj.update(b"n")
+            continue
+        if isinstance(value, bytes):
+            tag, data = b"b", value
+        elif isinstance(value, str):
+            tag, data = b"s", value.encode("utf8")
+        else:
+            tag, data = b"v", repr(value).encode("ascii")
+        hashobj.update(b"%s%d:" % (tag, len(data)))
+        hashobj.update(data)
@@ -6,19 +6,21 @@ and they're slightly too expensive to calculate at runtime (45-60 seconds).
 The resulting matrices are the same shape as the rest of the matrices and thus
 contain individual totals for each practice and month.
 """
+
 import logging
 import os.path
 import sqlite3
 
 from matrixstore.connection import MatrixStore
-from matrixstore.matrix_ops import is_integer, convert_to_smallest_int_type
-from matrixstore.serializer import serialize_compressed
+from matrixstore.matrix_ops import convert_to_smallest_int_type, is_integer
+from matrixstore.serializer import DEFAULT_COMPRESSION_PROFILE
 
+from .compression import get_serializer, map_in_order
 
 logger = logging.getLogger(__name__)
 
 
-def precalculate_totals(sqlite_path):
+def precalculate_totals(sqlite_path, compression_profile=DEFAULT_COMPRESSION_PROFILE):
     if not os.path.exists(sqlite_path):
         raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
     connection = sqlite3.connect(sqlite_path)
@@ -26,13 +28,15 @@ def precalculate_totals(sqlite_path):
     # we want to use our own transactions below
     previous_isolation_level = connection.isolation_level
     connection.isolation_level = None
-    precalculate_totals_for_db(connection)
+    precalculate_totals_for_db(connection, compression_profile=compression_profile)
     connection.isolation_level = previous_isolation_level
     connection.commit()
     connection.close()
 
 
-def precalculate_totals_for_db(connection):
+def precalculate_totals_for_db(
+    connection, compression_profile=DEFAULT_COMPRESSION_PROFILE
+):
     matrixstore = MatrixStore(connection)
     logger.info("Summing prescribing over all presentations")
     values = matrixstore.query_one(
@@ -63,13 +67,12 @@ def precalculate_totals_for_db(connection):
         VALUES
           (?, ?, ?, ?)
         """,
-        list(map(prepare_matrix_value, values)),
+        list(map_in_order(get_serializer(compression_profile), map(shrink, values))),
     )
     cursor.execute("RELEASE update_totals")
 
 
-def prepare_matrix_value(matrix):
+def shrink(matrix):
     if is_integer(matrix):
         matrix = convert_to_smallest_int_type(matrix)
-    data = serialize_compressed(matrix)
-    return data
+    return matrix
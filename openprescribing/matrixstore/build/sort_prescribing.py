@@ -0,0 +1,329 @@
+"""
+Sort and merge the CSV shards of a month of prescribing data, as exported from
+BigQuery, into a directory of column files sorted by (bnf_code, practice)
+
+This is an external merge sort: each shard is parsed (in parallel) in chunks of
+at most `RUN_SIZE` rows, each chunk is sorted in memory and written to disk as
+a "run", and then the runs are merged a block at a time.  So memory use is
+bounded regardless of the size of the input.
+
+The output directory contains one NumPy `.npy` file per column of
+`PrescribingColumns`, which can be memory-mapped and read without any further
+parsing.  Rows are indexed by presentation: the rows for `bnf_codes[i]` are
+those from `offsets[i]` up to `offsets[i + 1]`.  Practices are stored as
+indices into `practice_codes`.
+"""
+
+import io
+import logging
+import os
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+import pandas
+
+logger = logging.getLogger(__name__)
+
+
+# The three key fields come first so that we can compare records by viewing
+# their first `SORT_KEY_WIDTH` bytes as a single byte string (see
+# `get_sort_keys`).  BNF codes and practice codes are currently 15 and 6
+# characters long, but we leave some headroom.  Shorter values are padded with
+# null bytes, which sort before any other character, so this ordering is the
+# same as the ordering of (bnf_code, practice, date) tuples.
+RECORD_DTYPE = numpy.dtype(
+    [
+        ("bnf_code", "S20"),
+        ("practice", "S12"),
+        ("date", "S10"),
+        ("items", "i8"),
+        ("quantity", "f8"),
+        ("actual_cost", "i8"),
+        ("net_cost", "i8"),
+    ]
+)
+
+# The offset of the first non-key field
+SORT_KEY_WIDTH = RECORD_DTYPE.fields["items"][1]
+SORT_KEY_DTYPE = numpy.dtype(
+    {
+        "names": ["key"],
+        "formats": ["S{}".format(SORT_KEY_WIDTH)],
+        "offsets": [0],
+        "itemsize": RECORD_DTYPE.itemsize,
+    }
+)
+
+# Maximum number of rows sorted in memory at once, per shard
+RUN_SIZE = 500000
+
+# Number of records read from each run at each step of the merge
+MERGE_BLOCK_SIZE = 50000
+
+# Number of shards parsed at once.  Decompression and pandas's CSV tokenizer
+# both release the GIL so threads are sufficient here.
+MAX_WORKERS = 4
+
+CSV_DTYPES = {
+    "bnf_code": str,
+    "practice": str,
+    "month": str,
+    "items": numpy.int64,
+    "quantity": numpy.float64,
+    "actual_cost": numpy.float64,
+    "net_cost": numpy.float64,
+}
+
+
+# Columns with one value per row
+ROW_COLUMNS = {
+    "practice_index": numpy.int32,
+    "items": numpy.int64,
+    "quantity": numpy.float64,
+    "actual_cost": numpy.int64,
+    "net_cost": numpy.int64,
+}
+
+PrescribingColumns = namedtuple(
+    "PrescribingColumns", ["bnf_codes", "offsets", "practice_codes", *ROW_COLUMNS]
+)
+
+
+class InvalidHeaderError(Exception):
+    pass
+
+
+def sort_prescribing_csv_files(
+    input_filenames,
+    output_dir,
+    run_size=RUN_SIZE,
+    block_size=MERGE_BLOCK_SIZE,
+    max_workers=MAX_WORKERS,
+):
+    """
+    Given a list of prescribing CSV files (which may or may not be gzipped),
+    all for the same month, write their contents as sorted columns to the
+    directory `output_dir` (which must not exist)
+    """
+    parent_dir = os.path.dirname(os.path.abspath(output_dir))
+    with tempfile.TemporaryDirectory(dir=parent_dir) as run_dir:
+
+        def write_runs(filename):
+            return write_sorted_runs(filename, run_dir, run_size)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            runs = [
+                run for runs in pool.map(write_runs, input_filenames) for run in runs
+            ]
+        logger.info("Merging %s sorted runs into %s", len(runs), output_dir)
+        runs = [numpy.load(filename, mmap_mode="r") for filename in runs]
+        total = sum(len(run) for run in runs)
+        os.mkdir(output_dir)
+
+        def allocate(name, length, dtype):
+            return numpy.lib.format.open_memmap(
+                os.path.join(output_dir, name + ".npy"),
+                mode="w+",
+                dtype=dtype,
+                shape=(length,),
+            )
+
+        columns = to_columns(merge_runs(runs, block_size), total, allocate)
+        for name in ROW_COLUMNS:
+            getattr(columns, name).flush()
+        for name in ["bnf_codes", "offsets", "practice_codes"]:
+            numpy.save(os.path.join(output_dir, name + ".npy"), getattr(columns, name))
+
+
+def write_sorted_runs(filename, run_dir, run_size):
+    """
+    Parse the given CSV file, sort it in chunks of `run_size` rows, and write
+    each sorted chunk to a file in `run_dir`, returning the filenames
+    """
+    run_filenames = []
+    for n, records in enumerate(read_prescribing_csv(filename, run_size)):
+        run_filename = os.path.join(
+            run_dir, "{}.{}.npy".format(os.path.basename(filename), n)
+        )
+        numpy.save(run_filename, sort_records(records))
+        run_filenames.append(run_filename)
+    return run_filenames
+
+
+def read_prescribing_csv(filename, chunk_size):
+    """
+    Yield the rows of the given prescribing CSV file as arrays of
+    `RECORD_DTYPE` of at most `chunk_size` rows
+    """
+    try:
+        chunks = pandas.read_csv(
+            filename,
+            usecols=list(CSV_DTYPES),
+            dtype=CSV_DTYPES,
+            keep_default_na=False,
+            # Parse floats exactly as Python's `float` does
+            float_precision="round_trip",
+            chunksize=chunk_size,
+        )
+        for chunk in chunks:
+            yield to_records(chunk)
+    except ValueError as e:
+        if "Usecols do not match columns" in str(e):
+            raise InvalidHeaderError("{}: {}".format(filename, e))
+        raise
+
+
+def to_records(df):
+    records = numpy.empty(len(df), dtype=RECORD_DTYPE)
+    # These sometimes have trailing spaces in the CSV
+    records["bnf_code"] = to_fixed_width(df["bnf_code"].str.strip(), "bnf_code")
+    records["practice"] = to_fixed_width(df["practice"].str.strip(), "practice")
+    # We only need the YYYY-MM-DD part of the date
+    records["date"] = to_fixed_width(df["month"].str[:10], "date")
+    records["items"] = df["items"]
+    records["quantity"] = df["quantity"]
+    records["actual_cost"] = pounds_to_pence(df["actual_cost"])
+    records["net_cost"] = pounds_to_pence(df["net_cost"])
+    return records
+
+
+def to_fixed_width(series, field):
+    # NumPy silently truncates strings which are too long for the field, so
+    # we check for these first
+    width = RECORD_DTYPE[field].itemsize
+    if len(series) and series.str.len().max() > width:
+        raise ValueError(
+            "Value longer than {} characters in {}: {}".format(
+                width, field, series[series.str.len() > width].iloc[0]
+            )
+        )
+    return series.to_numpy(dtype="S{}".format(width))
+
+
+def pounds_to_pence(values):
+    return numpy.round(values.to_numpy() * 100).astype(numpy.int64)
+
+
+def get_sort_keys(records):
+    """
+    Return a view of the (bnf_code, practice, date) prefix of each record as
+    a single byte string
+    """
+    return records.view(SORT_KEY_DTYPE)["key"]
+
+
+def sort_records(records):
+    return records[numpy.argsort(get_sort_keys(records), kind="stable")]
+
+
+def merge_runs(runs, block_size):
+    """
+    Merge the given arrays of sorted records, yielding sorted blocks of records
+
+    At each step we read the next block of records from each run.  Any record
+    which sorts no later than the last record of the "smallest" block can be
+    yielded, as every record still to be read from any run must sort after it.
+    This always includes the whole of the smallest block, so each step makes
+    progress.
+    """
+    positions = [0] * len(runs)
+    while True:
+        blocks = [
+            (n, run[positions[n] : positions[n] + block_size])
+            for n, run in enumerate(runs)
+            if positions[n] < len(run)
+        ]
+        if not blocks:
+            break
+        bound = min(get_sort_keys(block)[-1] for _, block in blocks)
+        chunks = []
+        for n, block in blocks:
+            count = numpy.searchsorted(get_sort_keys(block), bound, side="right")
+            chunks.append(block[:count])
+            positions[n] += count
+        yield sort_records(numpy.concatenate(chunks))
+
+
+def to_columns(blocks, total, allocate):
+    """
+    Convert sorted blocks of records, `total` records in all, into
+    PrescribingColumns
+
+    `allocate(name, length, dtype)` is called to create the array for each
+    column with one value per row, so that these can be written directly to
+    disk.
+    """
+    columns = {
+        name: allocate(name, total, dtype) for name, dtype in ROW_COLUMNS.items()
+    }
+    bnf_codes = []
+    offsets = []
+    practice_ids = {}
+    dates = set()
+    previous_bnf_code = None
+    start = 0
+    for block in blocks:
+        end = start + len(block)
+        # Record where each presentation starts
+        codes = block["bnf_code"]
+        changes = numpy.flatnonzero(codes[1:] != codes[:-1]) + 1
+        if codes[0] != previous_bnf_code:
+            changes = numpy.concatenate([[0], changes])
+        bnf_codes.extend(codes[changes])
+        offsets.extend(changes + start)
+        previous_bnf_code = codes[-1]
+        # Replace practice codes with indices into the list of all practice
+        # codes seen so far
+        unique_codes, inverse = numpy.unique(block["practice"], return_inverse=True)
+        ids = numpy.array(
+            [practice_ids.setdefault(code, len(practice_ids)) for code in unique_codes],
+            dtype=ROW_COLUMNS["practice_index"],
+        )
+        columns["practice_index"][start:end] = ids[inverse]
+        dates.update(numpy.unique(block["date"]).tolist())
+        for name in ROW_COLUMNS:
+            if name != "practice_index":
+                columns[name][start:end] = block[name]
+        start = end
+    assert start == total
+    if len(dates) > 1:
+        raise ValueError(
+            "Expected a single month of prescribing, found: {}".format(sorted(dates))
+        )
+    return PrescribingColumns(
+        bnf_codes=numpy.array(bnf_codes, dtype=RECORD_DTYPE["bnf_code"]),
+        offsets=numpy.array(offsets + [total], dtype=numpy.int64),
+        practice_codes=numpy.array(list(practice_ids), dtype=RECORD_DTYPE["practice"]),
+        **columns,
+    )
+
+
+def read_prescribing_file(dirname):
+    """
+    Return the PrescribingColumns written by `sort_prescribing_csv_files` to
+    the given directory, as memory-mapped arrays
+    """
+    return PrescribingColumns(
+        *[
+            numpy.load(os.path.join(dirname, name + ".npy"), mmap_mode="r")
+            for name in PrescribingColumns._fields
+        ]
+    )
+
+
+def read_prescribing_csv_into_memory(lines):
+    """
+    Parse, sort and convert the given lines of prescribing CSV (all for the
+    same month) into PrescribingColumns held in memory
+
+    This is intended for small amounts of test data.
+    """
+    chunks = list(read_prescribing_csv(io.StringIO("".join(lines)), RUN_SIZE))
+    records = numpy.concatenate(chunks) if chunks else numpy.empty(0, RECORD_DTYPE)
+    return to_columns(
+        [sort_records(records)] if len(records) else [],
+        len(records),
+        lambda name, length, dtype: numpy.empty(length, dtype=dtype),
+    )
@@ -0,0 +1,138 @@
+"""
+Reports, for each compression profile, the time taken to compress every matrix
+in a MatrixStore file, the size of the resulting file, and the p50 and p95
+latencies for decompressing a matrix when reading.
+
+Matrices are read from an existing file (by default the live one) and written
+to temporary copies, so the file itself is left unchanged.
+"""
+
+import os
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from matrixstore.build.compression import get_serializer, map_in_order
+from matrixstore.serializer import COMPRESSION_PROFILES, deserialize
+
+# Tables containing serialized matrices, and the columns they're stored in
+MATRIX_COLUMNS = {
+    "presentation": ["items", "quantity", "actual_cost", "net_cost"],
+    "practice_statistic": ["value"],
+    "all_presentations": ["items", "quantity", "actual_cost", "net_cost"],
+}
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--filename", help="MatrixStore file to use (default: the live file)"
+        )
+        parser.add_argument(
+            "--profiles",
+            nargs="+",
+            choices=sorted(COMPRESSION_PROFILES),
+            help="Profiles to compare (default: all)",
+        )
+        parser.add_argument(
+            "--sample",
+            type=int,
+            default=1000,
+            help="Number of presentations for which to time decompression",
+        )
+
+    def handle(self, filename=None, profiles=None, sample=None, **kwargs):
+        filename = filename or settings.MATRIXSTORE_LIVE_FILE
+        profiles = profiles or list(COMPRESSION_PROFILES)
+        self.stdout.write(
+            "{:<12} {:>12} {:>12} {:>12} {:>12}".format(
+                "profile", "compress", "size", "p50 read", "p95 read"
+            )
+        )
+        with tempfile.TemporaryDirectory(dir=settings.MATRIXSTORE_BUILD_DIR) as tmp:
+            for profile in profiles:
+                path = os.path.join(tmp, "{}.sqlite".format(profile))
+                shutil.copyfile(filename, path)
+                duration = recompress(filename, path, profile)
+                size = os.path.getsize(path)
+                timings = time_reads(path, sample)
+                os.unlink(path)
+                self.stdout.write(
+                    "{:<12} {:>11.1f}s {:>10.1f}MB {:>10.1f}us {:>10.1f}us".format(
+                        profile,
+                        duration,
+                        size / 1e6,
+                        percentile(timings, 50),
+                        percentile(timings, 95),
+                    )
+                )
+
+
+def recompress(source, target, profile):
+    """
+    Write every matrix in the `source` file to the same row in the `target`
+    file, compressed with the given profile, and return the time taken
+    """
+    serialize = get_serializer(profile)
+    source_connection = sqlite3.connect(source)
+    connection = sqlite3.connect(target)
+    start = time.perf_counter()
+    for table, columns in MATRIX_COLUMNS.items():
+
+        def recompress_row(row):
+            return [serialize(deserialize(value)) for value in row[1:]] + [row[0]]
+
+        rows = source_connection.execute(
+            "SELECT rowid, {} FROM {} WHERE {} IS NOT NULL".format(
+                ", ".join(columns), table, columns[0]
+            )
+        )
+        connection.executemany(
+            "UPDATE {} SET {} WHERE rowid=?".format(
+                table, ", ".join("{}=?".format(column) for column in columns)
+            ),
+            map_in_order(recompress_row, rows),
+        )
+    connection.commit()
+    duration = time.perf_counter() - start
+    # Reclaim the space freed by any matrices which are now smaller
+    connection.execute("VACUUM")
+    connection.close()
+    source_connection.close()
+    return duration
+
+
+def time_reads(path, sample):
+    """
+    Return the time taken, in microseconds, to decompress and deserialize each
+    of the matrices for a sample of presentations
+    """
+    connection = sqlite3.connect(path)
+    values = [
+        value
+        for row in connection.execute(
+            "SELECT items, quantity, actual_cost, net_cost FROM presentation "
+            "WHERE items IS NOT NULL ORDER BY bnf_code LIMIT ?",
+            [sample],
+        )
+        for value in row
+    ]
+    connection.close()
+    timings = []
+    for value in values:
+        start = time.perf_counter()
+        deserialize(value)
+        timings.append((time.perf_counter() - start) * 1e6)
+    return timings
+
+
+def percentile(values, p):
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
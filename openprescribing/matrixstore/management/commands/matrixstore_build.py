@@ -5,7 +5,6 @@ MatrixStore format and writes that file into `MATRIXSTORE_BUILD_DIR`
 
 import logging
 import os
-import sqlite3
 
 from django.conf import settings
 from django.core.management import BaseCommand
@@ -17,8 +16,10 @@ from matrixstore.build.generate_filename import generate_filename
 from matrixstore.build.import_practice_stats import import_practice_stats
 from matrixstore.build.import_prescribing import import_prescribing
 from matrixstore.build.init_db import init_db
+from matrixstore.build.manifest import compute_manifest, write_manifest
 from matrixstore.build.precalculate_totals import precalculate_totals
-from matrixstore.build.update_bnf_map import update_bnf_map
+from matrixstore.build.update_bnf_map import get_bnf_map
+from matrixstore.serializer import COMPRESSION_PROFILES, DEFAULT_COMPRESSION_PROFILE
 
 logger = logging.getLogger(__name__)
 
@@ -38,11 +39,28 @@ class Command(BaseCommand):
         parser.add_argument(
             "--quiet", help="Don't emit logging output", action="store_true"
         )
+        parser.add_argument(
+            "--compression-profile",
+            help="How to compress matrices (default: {})".format(
+                DEFAULT_COMPRESSION_PROFILE
+            ),
+            choices=sorted(COMPRESSION_PROFILES),
+            default=DEFAULT_COMPRESSION_PROFILE,
+        )
 
-    def handle(self, end_date, months=None, quiet=False, **kwargs):
+    def handle(
+        self,
+        end_date,
+        months=None,
+        quiet=False,
+        compression_profile=DEFAULT_COMPRESSION_PROFILE,
+        **kwargs
+    ):
         log_level = "INFO" if not quiet else "ERROR"
         with LogToStream("matrixstore", self.stdout, log_level):
-            return build(end_date, months=months)
+            return build(
+                end_date, months=months, compression_profile=compression_profile
+            )
 
 
 class LogToStream(object):
@@ -72,35 +90,22 @@ class LogToStream(object):
         self.logger.removeHandler(self.handler)
 
 
-def build(end_date, months=None):
+def build(end_date, months=None, compression_profile=DEFAULT_COMPRESSION_PROFILE):
     directory = settings.MATRIXSTORE_BUILD_DIR
     sqlite_temp = get_temp_filename(os.path.join(directory, "matrixstore.sqlite"))
     init_db(end_date, sqlite_temp, months=months)
     download_practice_stats(end_date, months=months)
-    import_practice_stats(sqlite_temp)
+    import_practice_stats(sqlite_temp, compression_profile=compression_profile)
     download_prescribing(end_date, months=months)
-    import_prescribing(sqlite_temp)
-    update_bnf_map(sqlite_temp)
-    precalculate_totals(sqlite_temp)
-    vacuum_database(sqlite_temp)
-    basename = generate_filename(sqlite_temp)
+    import_prescribing(
+        sqlite_temp, get_bnf_map(), compression_profile=compression_profile
+    )
+    precalculate_totals(sqlite_temp, compression_profile=compression_profile)
+    manifest = compute_manifest(sqlite_temp)
+    basename = generate_filename(sqlite_temp, content_hash=manifest["sha256"])
     filename = os.path.join(directory, basename)
+    # The manifest is written first so that any file with a final name has one
+    write_manifest(manifest, filename)
     logger.info("Moving file to final location: %s", filename)
     os.rename(sqlite_temp, filename)
     return filename
-
-
-def vacuum_database(sqlite_path):
-    """
-    Rebuild the database file, repacking it into the minimal amount of space
-    and ensuring that table and index data is stored contiguously
-
-    This also has the advantage that files built with the same data should be
-    byte-for-byte identical, regardless of the order in which data was
-    processed.
-    """
-    logger.info("Vacuuming database file")
-    connection = sqlite3.connect(sqlite_path)
-    connection.execute("VACUUM")
-    connection.commit()
-    connection.close()
@@ -5,6 +5,14 @@ version of the most up-to-date file in MATRIXSTORE_BUILD_DIR (as determined by
 the filename). If a date is supplied it restricts its search to files whose
 timestamp (in the filename) matches that date.  If a filename is supplied it
 will use that file.
+
+Before updating the symlink the file is checked against the manifest written
+alongside it by `matrixstore_build`.  By default this compares only the file's
+size and the row counts of its tables; use `--verify-checksums` to compare the
+full contents of every table.
+
+With `--smoke-test` the file is also checked against the expected values for
+the spending smoke tests (see `pipeline.matrixstore_smoketests`).
 """
 
 import os
@@ -13,6 +21,9 @@ import re
 from django.conf import settings
 from django.core.management import BaseCommand
 from matrixstore.build.common import get_temp_filename
+from matrixstore.build.manifest import ManifestError, verify_manifest
+from matrixstore.connection import MatrixStore
+from pipeline.matrixstore_smoketests import run_smoketests
 
 
 class Command(BaseCommand):
@@ -29,8 +40,31 @@ class Command(BaseCommand):
         parser.add_argument(
             "--filename", help="Don't search for files; just use this one"
         )
+        parser.add_argument(
+            "--verify-checksums",
+            action="store_true",
+            help="Check the checksum of every table against the manifest (slow)",
+        )
+        parser.add_argument(
+            "--skip-verify",
+            action="store_true",
+            help="Don't check the file against its manifest",
+        )
+        parser.add_argument(
+            "--smoke-test",
+            action="store_true",
+            help="Check the file against the expected values for the smoke tests",
+        )
 
-    def handle(self, date=None, filename=None, **kwargs):
+    def handle(
+        self,
+        date=None,
+        filename=None,
+        verify_checksums=False,
+        skip_verify=False,
+        smoke_test=False,
+        **kwargs
+    ):
         symlink = settings.MATRIXSTORE_LIVE_FILE
         if os.path.exists(symlink) and not os.path.islink(symlink):
             raise RuntimeError(
@@ -40,6 +74,26 @@ class Command(BaseCommand):
             target_file = get_target_file(filename)
         else:
             target_file = get_most_recent_file(date)
+        if not skip_verify:
+            self.stdout.write("Verifying {} against manifest".format(target_file))
+            try:
+                verify_manifest(
+                    os.path.join(settings.MATRIXSTORE_BUILD_DIR, target_file),
+                    checksums=verify_checksums,
+                )
+            except ManifestError as e:
+                raise RuntimeError(str(e))
+        if smoke_test:
+            self.stdout.write("Running smoke tests against {}".format(target_file))
+            db = MatrixStore.from_file(
+                os.path.join(settings.MATRIXSTORE_BUILD_DIR, target_file)
+            )
+            try:
+                failures = run_smoketests(db)
+            finally:
+                db.close()
+            if failures:
+                raise RuntimeError("Smoke tests failed:\n" + "\n".join(failures))
         self.stdout.write("Updating live symlink to: {}".format(target_file))
         temp_file = get_temp_filename(symlink)
         os.symlink(target_file, temp_file)
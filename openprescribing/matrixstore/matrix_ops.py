@@ -25,6 +25,24 @@ def finalise_matrix(matrix):
     return matrix
 
 
+def finalise_dense_matrix(matrix):
+    """
+    Return a dense matrix in a form suitable for storage, which may be sparse
+    if that would use less memory
+    """
+    if is_integer(matrix):
+        matrix = convert_to_smallest_int_type(matrix)
+    # Only build the sparse form when it might be smaller, assuming 32-bit
+    # indices
+    nonzero = numpy.count_nonzero(matrix)
+    sparse_size = nonzero * (matrix.dtype.itemsize + 4) + (matrix.shape[1] + 1) * 4
+    if sparse_size < matrix.nbytes:
+        sparse = csc_matrix(matrix)
+        if get_sparse_memory_usage(sparse) < get_dense_memory_usage(sparse):
+            return sparse
+    return matrix
+
+
 def zeros_like(matrix, order=None):
     """
     Return a zero-valued matrix of the same shape as `matrix` and with
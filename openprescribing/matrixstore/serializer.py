@@ -7,6 +7,20 @@ import lz4.frame
 # compressed data
 LZ4_MAGIC_NUMBER = struct.pack("<I", 0x184D2204)
 
+# Settings for `serialize_compressed`, as keyword arguments to
+# `lz4.frame.compress`.  Level 0 is LZ4's fast mode and higher levels use LZ4
+# HC, which compresses more slowly but decompresses just as fast.  All of these
+# produce standard LZ4 frames so `deserialize` reads them all.
+COMPRESSION_PROFILES = {
+    "lz4-fast": {"compression_level": 0},
+    "lz4-hc-4": {"compression_level": 4},
+    "lz4-hc-10": {"compression_level": 10},
+    "lz4-hc-max": {"compression_level": lz4.frame.COMPRESSIONLEVEL_MAX},
+}
+
+# See commit comments for details of how this compression level was chosen
+DEFAULT_COMPRESSION_PROFILE = "lz4-hc-10"
+
 
 def serialize(obj):
     """
@@ -48,13 +62,15 @@ def deserialize_uncompressed(data):
     return pickle.loads(buffers[-1], buffers=buffers)
 
 
-def serialize_compressed(obj):
+def serialize_compressed(obj, profile=DEFAULT_COMPRESSION_PROFILE):
     """
-    Serialize an arbitrary Python object and compress the result using LZ4
+    Serialize an arbitrary Python object and compress the result using LZ4 with
+    the named profile from `COMPRESSION_PROFILES`
     """
     data = serialize(obj)
-    # See commit comments for details of how this compression level was chosen
-    return lz4.frame.compress(data, compression_level=10, return_bytearray=True)
+    return lz4.frame.compress(
+        data, return_bytearray=True, **COMPRESSION_PROFILES[profile]
+    )
 
 
 def deserialize(data):
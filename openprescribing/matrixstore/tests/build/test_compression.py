@@ -0,0 +1,36 @@
+import threading
+import time
+
+from django.test import SimpleTestCase
+from matrixstore.build.compression import get_serializer, map_in_order
+from matrixstore.serializer import deserialize
+
+
+class MapInOrderTest(SimpleTestCase):
+    def test_results_are_in_order(self):
+        def slow_square(n):
+            # Make earlier items finish later
+            time.sleep((10 - n) / 1000)
+            return n * n
+
+        results = list(map_in_order(slow_square, range(10), max_workers=4))
+        self.assertEqual(results, [n * n for n in range(10)])
+
+    def test_reads_ahead_no_more_than_max_pending(self):
+        consumed = []
+        lock = threading.Lock()
+
+        def items():
+            for n in range(20):
+                with lock:
+                    consumed.append(n)
+                yield n
+
+        results = map_in_order(lambda n: n, items(), max_workers=2, max_pending=3)
+        self.assertEqual(next(results), 0)
+        self.assertLessEqual(len(consumed), 3)
+        self.assertEqual(list(results), list(range(1, 20)))
+
+    def test_serializer(self):
+        serialize = get_serializer("lz4-fast")
+        self.assertEqual(deserialize(serialize([1, 2, 3])), [1, 2, 3])
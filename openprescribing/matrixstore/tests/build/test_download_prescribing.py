@@ -0,0 +1,151 @@
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase, override_settings
+from matrixstore.build.common import get_prescribing_filename
+from matrixstore.build.download_prescribing import (
+    download_prescribing,
+    local_storage_prefix_for_date,
+)
+from matrixstore.build.sort_prescribing import read_prescribing_file
+from matrixstore.tests.build.test_sort_prescribing import columns_to_rows
+
+HEADER = [
+    "bnf_code",
+    "practice",
+    "month",
+    "items",
+    "quantity",
+    "actual_cost",
+    "net_cost",
+]
+
+
+class FakeClient:
+    """
+    Stands in for `gcutils.bigquery.Client`, "exporting" a few shards of
+    unsorted rows for each month
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.table_ids = set()
+        self.extracted = []
+        self.lock = threading.Lock()
+
+    def list_tables(self):
+        return [SimpleNamespace(table_id=table_id) for table_id in self.table_ids]
+
+    def get_table(self, table_id):
+        return FakeTable(self, table_id)
+
+
+class FakeTable:
+    def __init__(self, client, table_id):
+        self.client = client
+        self.table_id = table_id
+
+    def insert_rows_from_query(self, sql, substitutions=None):
+        with self.client.lock:
+            self.client.table_ids.add(self.table_id)
+            self.client.extracted.append(substitutions["month"])
+
+    def export_to_storage(self, storage_prefix):
+        month = self.table_id[-7:].replace("_", "-") + "-01"
+        for shard in range(3):
+            rows = [
+                ["{:02d}0000".format(n), "P{}".format(shard), month, n, n, n, n]
+                for n in range(10, 0, -1)
+            ]
+            name = "{}{:012d}.csv.gz".format(storage_prefix, shard)
+            self.client.bucket.blobs[name] = make_gzipped_csv([HEADER] + rows)
+
+
+class FakeBucket:
+    """
+    Stands in for the bucket returned by `gcutils.bigquery.StorageClient`
+    """
+
+    name = "fake-bucket"
+
+    def __init__(self):
+        self.blobs = {}
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def list_blobs(self, prefix):
+        return [
+            FakeBlob(self, name) for name in list(self.blobs) if name.startswith(prefix)
+        ]
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def exists(self):
+        return self.name in self.bucket.blobs
+
+    def upload_from_string(self, content):
+        self.bucket.blobs[self.name] = content.encode("utf8")
+
+    def download_to_filename(self, filename):
+        with open(filename, "wb") as f:
+            f.write(self.bucket.blobs[self.name])
+
+
+def make_gzipped_csv(rows):
+    lines = "".join(",".join(map(str, row)) + "\n" for row in rows)
+    return gzip.compress(lines.encode("utf8"))
+
+
+class DownloadPrescribingTest(SimpleTestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        overrides = override_settings(
+            MATRIXSTORE_IMPORT_DIR=self.tempdir, CHECK_DATA_IN_BQ=False
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.bucket = FakeBucket()
+        self.bq_client = FakeClient(self.bucket)
+        self.dates = ["2019-01-01", "2019-02-01", "2019-03-01"]
+
+    def download(self):
+        download_prescribing(
+            "2019-03",
+            months=3,
+            bq_client=self.bq_client,
+            bucket=self.bucket,
+            max_bigquery_jobs=2,
+            max_downloads=2,
+            max_consolidations=2,
+        )
+
+    def test_downloads_and_consolidates_each_month(self):
+        self.download()
+        self.assertEqual(sorted(self.bq_client.extracted), self.dates)
+        for date in self.dates:
+            columns = read_prescribing_file(get_prescribing_filename(date))
+            rows = columns_to_rows(columns)
+            self.assertEqual(len(rows), 30)
+            self.assertEqual(len(columns.bnf_codes), 10)
+            # Downloaded shards have been cleaned up
+            self.assertFalse(os.path.exists(local_storage_prefix_for_date(date)))
+
+    def test_resumes_where_it_left_off(self):
+        self.download()
+        shutil.rmtree(get_prescribing_filename(self.dates[1]))
+        self.bq_client.extracted = []
+        self.download()
+        # The export still exists in storage so there's no need to extract
+        # anything again
+        self.assertEqual(self.bq_client.extracted, [])
+        self.assertTrue(os.path.exists(get_prescribing_filename(self.dates[1])))
@@ -0,0 +1,126 @@
+import gzip
+import os
+import random
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase
+from matrixstore.build.sort_prescribing import (
+    InvalidHeaderError,
+    read_prescribing_csv_into_memory,
+    read_prescribing_file,
+    sort_prescribing_csv_files,
+)
+
+
+def columns_to_rows(columns):
+    """
+    Return the rows of a PrescribingColumns as sorted tuples of the form:
+
+        bnf_code, practice_code, items, quantity, actual_cost, net_cost
+    """
+    rows = []
+    for bnf_code, start, end in zip(
+        columns.bnf_codes.astype(str), columns.offsets[:-1], columns.offsets[1:]
+    ):
+        for n in range(start, end):
+            rows.append(
+                (
+                    bnf_code,
+                    str(columns.practice_codes[columns.practice_index[n]], "ascii"),
+                    int(columns.items[n]),
+                    float(columns.quantity[n]),
+                    int(columns.actual_cost[n]),
+                    int(columns.net_cost[n]),
+                )
+            )
+    return rows
+
+
+HEADER = "bnf_code,practice,month,items,quantity,actual_cost,net_cost,extra\n"
+
+
+class SortPrescribingTest(SimpleTestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.output = os.path.join(self.tempdir, "sorted")
+
+    def write_csv(self, name, lines, header=HEADER):
+        filename = os.path.join(self.tempdir, name)
+        with gzip.open(filename, "wt") as f:
+            f.write(header)
+            f.writelines(lines)
+        return filename
+
+    def test_sorts_and_merges_files(self):
+        rng = random.Random(1)
+        expected = []
+        filenames = []
+        for shard in range(3):
+            lines = []
+            for n in range(200):
+                bnf_code = "0{}0{}".format(rng.randint(1, 9), rng.randint(1, 99))
+                practice = "P{:05d}".format(shard * 1000 + n)
+                lines.append(
+                    # Trailing spaces and embedded commas should be handled
+                    '{} ,{},2019-01-01 00:00:00 UTC,{},{},{},{},"a, b"\n'.format(
+                        bnf_code, practice, n, n / 2, n / 100, n / 50
+                    )
+                )
+                expected.append(
+                    (
+                        bnf_code,
+                        practice,
+                        n,
+                        n / 2,
+                        int(round(n / 100 * 100)),
+                        int(round(n / 50 * 100)),
+                    )
+                )
+            filenames.append(self.write_csv("shard{}.csv.gz".format(shard), lines))
+        # Small runs and blocks so that we exercise the merge
+        sort_prescribing_csv_files(
+            filenames, self.output, run_size=37, block_size=11, max_workers=2
+        )
+        columns = read_prescribing_file(self.output)
+        rows = columns_to_rows(columns)
+        self.assertEqual(rows, sorted(expected))
+        # Each presentation appears once in the index
+        self.assertEqual(len(columns.bnf_codes), len({row[0] for row in expected}))
+
+    def test_empty_input(self):
+        filename = self.write_csv("empty.csv.gz", [])
+        sort_prescribing_csv_files([filename], self.output)
+        self.assertEqual(columns_to_rows(read_prescribing_file(self.output)), [])
+
+    def test_missing_column(self):
+        filename = self.write_csv(
+            "bad.csv.gz", ["0101,P1,2019-01-01,1,1,1\n"], header=HEADER[:-21] + "\n"
+        )
+        with self.assertRaises(InvalidHeaderError):
+            sort_prescribing_csv_files([filename], self.output)
+
+    def test_multiple_months(self):
+        filename = self.write_csv(
+            "months.csv.gz",
+            ["0101,P1,2019-01-01,1,1,1,1,\n", "0101,P1,2019-02-01,1,1,1,1,\n"],
+        )
+        with self.assertRaises(ValueError):
+            sort_prescribing_csv_files([filename], self.output)
+
+    def test_read_into_memory(self):
+        columns = read_prescribing_csv_into_memory(
+            [HEADER, "0202,P2,2019-01-01,1,2.5,3,4,\n", "0101,P1,2019-01-01,5,6,7,8,\n"]
+        )
+        self.assertEqual(
+            columns_to_rows(columns),
+            [("0101", "P1", 5, 6.0, 700, 800), ("0202", "P2", 1, 2.5, 300, 400)],
+        )
+
+    def test_value_too_long(self):
+        filename = self.write_csv(
+            "long.csv.gz", ["0101,P123456789ABCD,2019-01-01,1,1,1,1,\n"]
+        )
+        with self.assertRaises(ValueError):
+            sort_prescribing_csv_files([filename], self.output)
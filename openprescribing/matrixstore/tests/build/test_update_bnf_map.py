@@ -0,0 +1,21 @@
+from django.test import SimpleTestCase
+from matrixstore.build.update_bnf_map import resolve_bnf_map
+
+
+class ResolveBNFMapTest(SimpleTestCase):
+    def test_simple_updates(self):
+        self.assertEqual(
+            resolve_bnf_map([("A1", "B1"), ("A2", "B2")]), {"A1": "B1", "A2": "B2"}
+        )
+
+    def test_follows_chains_of_updates(self):
+        self.assertEqual(
+            resolve_bnf_map([("B", "C"), ("A", "B"), ("C", "D")]),
+            {"A": "D", "B": "D", "C": "D"},
+        )
+
+    def test_leaves_cycles_unchanged(self):
+        self.assertEqual(
+            resolve_bnf_map([("A", "B"), ("B", "A"), ("C", "A"), ("D", "D")]),
+            {"C": "A"},
+        )
@@ -1,10 +1,12 @@
 import os
 import shutil
+import sqlite3
 import tempfile
 
 from django.conf import settings
 from django.core.management import call_command
 from django.test import SimpleTestCase, override_settings
+from matrixstore.build.manifest import compute_manifest, write_manifest
 
 
 @override_settings(MATRIXSTORE_BUILD_DIR=None, MATRIXSTORE_LIVE_FILE=None)
@@ -25,6 +27,7 @@ class TestMatrixStoreSetLive(SimpleTestCase):
         for name in cls.files.values():
             path = os.path.join(cls.tempdir, name)
             open(path, "w").close()
+            write_manifest(compute_manifest(path), path)
 
     def test_updates_to_latest_with_no_args(self):
         self.call_command()
@@ -50,6 +53,50 @@ class TestMatrixStoreSetLive(SimpleTestCase):
         with self.assertRaises(RuntimeError):
             self.call_command(filename="no_such_file")
 
+    def test_throws_error_for_missing_manifest(self):
+        filename = "matrixstore_2017-01_2017-03-15--12-45_0000000000a.sqlite"
+        open(os.path.join(self.tempdir, filename), "w").close()
+        with self.assertRaises(RuntimeError):
+            self.call_command(filename=filename)
+
+    def test_throws_error_for_file_not_matching_manifest(self):
+        filename = "matrixstore_2017-02_2017-03-15--12-45_0000000000b.sqlite"
+        path = os.path.join(self.tempdir, filename)
+        self.write_table(path, [1, 2, 3])
+        manifest = compute_manifest(path)
+        manifest["tables"]["test"]["rows"] = 2
+        write_manifest(manifest, path)
+        with self.assertRaises(RuntimeError):
+            self.call_command(filename=filename)
+
+    def test_verify_checksums_detects_changed_contents(self):
+        filename = "matrixstore_2017-03_2017-03-15--12-45_0000000000c.sqlite"
+        path = os.path.join(self.tempdir, filename)
+        self.write_table(path, [1, 2, 3])
+        write_manifest(compute_manifest(path), path)
+        # Change a value without changing the size of the file
+        connection = sqlite3.connect(path)
+        connection.execute("UPDATE test SET value=4 WHERE value=3")
+        connection.commit()
+        connection.close()
+        self.call_command(filename=filename)
+        self.assertEqual(os.readlink(self.live_file), filename)
+        with self.assertRaises(RuntimeError):
+            self.call_command(filename=filename, verify_checksums=True)
+
+    def test_skip_verify(self):
+        filename = "matrixstore_2017-04_2017-03-15--12-45_0000000000d.sqlite"
+        open(os.path.join(self.tempdir, filename), "w").close()
+        self.call_command(filename=filename, skip_verify=True)
+        self.assertEqual(os.readlink(self.live_file), filename)
+
+    def write_table(self, path, values):
+        connection = sqlite3.connect(path)
+        connection.execute("CREATE TABLE test (value INTEGER)")
+        connection.executemany("INSERT INTO test VALUES (?)", [[v] for v in values])
+        connection.commit()
+        connection.close()
+
     def call_command(self, **kwargs):
         call_command("matrixstore_set_live", stdout=self.devnull, **kwargs)
 
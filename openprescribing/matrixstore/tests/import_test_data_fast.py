@@ -1,17 +1,14 @@
+import io
+
 from matrixstore.build.import_practice_stats import (
-    parse_practice_statistics_csv,
+    read_practice_statistics_csv,
     write_practice_stats,
 )
-from matrixstore.build.import_prescribing import (
-    parse_prescribing_csv,
-    write_prescribing,
-)
+from matrixstore.build.import_prescribing import write_prescribing
 from matrixstore.build.init_db import SCHEMA_SQL, generate_dates, import_dates
 from matrixstore.build.precalculate_totals import precalculate_totals_for_db
-from matrixstore.build.update_bnf_map import (
-    delete_presentations_with_no_prescribing,
-    move_values_from_old_code_to_new,
-)
+from matrixstore.build.sort_prescribing import read_prescribing_csv_into_memory
+from matrixstore.build.update_bnf_map import resolve_bnf_map
 from matrixstore.csv_utils import dicts_to_csv
 
 
@@ -32,7 +29,6 @@ def import_test_data_fast(sqlite_conn, data_factory, end_date, months=None):
     init_db(sqlite_conn, data_factory, dates)
     import_practice_stats(sqlite_conn, data_factory, dates)
     import_prescribing(sqlite_conn, data_factory, dates)
-    update_bnf_map(sqlite_conn, data_factory)
     precalculate_totals_for_db(sqlite_conn)
 
     sqlite_conn.isolation_level = previous_isolation_level
@@ -55,29 +51,30 @@ def import_practice_stats(sqlite_conn, data_factory, dates):
         practice_statistics_csv = dicts_to_csv(filtered_practice_stats)
         # This blows up if we give it an empty CSV because it can't find the
         # headers it expects
-        practice_statistics = parse_practice_statistics_csv(practice_statistics_csv)
+        practice_statistics = [
+            read_practice_statistics_csv(io.StringIO("".join(practice_statistics_csv)))
+        ]
     else:
         practice_statistics = []
     write_practice_stats(sqlite_conn, practice_statistics)
 
 
 def import_prescribing(sqlite_conn, data_factory, dates):
-    filtered_prescribing = _filter_by_date(data_factory.prescribing, dates)
-    sorted_prescribing = sorted(
-        filtered_prescribing, key=lambda p: (p["bnf_code"], p["practice"], p["month"])
+    prescribing_by_date = {}
+    for date in dates:
+        filtered_prescribing = list(_filter_by_date(data_factory.prescribing, [date]))
+        # This blows up if we give it an empty CSV because it can't find the
+        # headers it expects
+        if filtered_prescribing:
+            prescribing_csv = dicts_to_csv(filtered_prescribing)
+            prescribing_by_date[date] = read_prescribing_csv_into_memory(
+                prescribing_csv
+            )
+    bnf_map = resolve_bnf_map(
+        (item["former_bnf_code"], item["current_bnf_code"])
+        for item in data_factory.bnf_map
     )
-    prescribing_csv = dicts_to_csv(sorted_prescribing)
-    prescribing = parse_prescribing_csv(prescribing_csv)
-    write_prescribing(sqlite_conn, prescribing)
-
-
-def update_bnf_map(sqlite_conn, data_factory):
-    cursor = sqlite_conn.cursor()
-    for item in data_factory.bnf_map:
-        move_values_from_old_code_to_new(
-            cursor, item["former_bnf_code"], item["current_bnf_code"]
-        )
-    delete_presentations_with_no_prescribing(cursor)
+    write_prescribing(sqlite_conn, prescribing_by_date, bnf_map=bnf_map)
 
 
 def _get_active_practice_codes(data_factory, dates):
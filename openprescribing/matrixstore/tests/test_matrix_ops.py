@@ -4,6 +4,7 @@ import numpy
 from django.test import SimpleTestCase
 from matrixstore.matrix_ops import (
     convert_to_smallest_int_type,
+    finalise_dense_matrix,
     finalise_matrix,
     sparse_matrix,
 )
@@ -93,3 +94,34 @@ class TestFinaliseMatrix(SimpleTestCase):
             i = int(n / cols)
             j = n % cols
             yield i, j
+
+
+class TestFinaliseDenseMatrix(SimpleTestCase):
+    def setUp(self):
+        self.random = random.Random()
+        self.random.seed(14)
+
+    def test_matches_finalise_matrix(self):
+        for density in [0.1, 0.5, 0.6, 0.7, 0.8]:
+            for integer in [True, False]:
+                matrix = sparse_matrix((8, 8), integer=integer)
+                for coords in self._random_coords(matrix.shape, density):
+                    matrix[coords] = self.random.randint(1, 1000)
+                expected = finalise_matrix(matrix)
+                finalised = finalise_dense_matrix(matrix.toarray())
+                self.assertEqual(type(finalised), type(expected))
+                self.assertEqual(finalised.dtype, expected.dtype)
+                self.assertEqual(to_list(finalised), to_list(expected))
+
+    def _random_coords(self, shape, sample_density):
+        rows, cols = shape
+        for n in self.random.sample(
+            range(rows * cols), int(rows * cols * sample_density)
+        ):
+            yield divmod(n, cols)
+
+
+def to_list(matrix):
+    if isinstance(matrix, SparseMatrixBase):
+        matrix = matrix.toarray()
+    return matrix.tolist()
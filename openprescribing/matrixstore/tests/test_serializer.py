@@ -3,7 +3,12 @@ import sqlite3
 import numpy
 import scipy.sparse
 from django.test import SimpleTestCase
-from matrixstore.serializer import deserialize, serialize, serialize_compressed
+from matrixstore.serializer import (
+    COMPRESSION_PROFILES,
+    deserialize,
+    serialize,
+    serialize_compressed,
+)
 
 
 class TestSerializer(SimpleTestCase):
@@ -18,6 +23,12 @@ class TestSerializer(SimpleTestCase):
         self.assertLess(len(compressed_data), len(data))
         self.assertEqual(deserialize(compressed_data), obj)
 
+    def test_compression_profiles(self):
+        obj = {"hello": "world" * 256}
+        for profile in COMPRESSION_PROFILES:
+            with self.subTest(profile=profile):
+                self.assertEqual(deserialize(serialize_compressed(obj, profile)), obj)
+
     def test_matrix_serialisation(self):
         obj = scipy.sparse.csc_matrix((5, 4))
         new_obj = deserialize(serialize(obj))
@@ -21,6 +21,9 @@ PIPELINE_IMPORT_LOG_PATH = os.path.join(
 MATRIXSTORE_IMPORT_DIR = os.path.join(PIPELINE_DATA_BASEDIR, "matrixstore_import")
 MATRIXSTORE_BUILD_DIR = os.path.join(PIPELINE_DATA_BASEDIR, "matrixstore_build")
 MATRIXSTORE_LIVE_FILE = os.path.join(MATRIXSTORE_BUILD_DIR, "matrixstore_live.sqlite")
+TYPEAHEAD_INDEX_DIR = os.path.join(PIPELINE_DATA_BASEDIR, "typeahead_index")
+TILE_CACHE_DIR = os.path.join(PIPELINE_DATA_BASEDIR, "tile_cache")
+ALERT_CACHE_DIR = os.path.join(PIPELINE_DATA_BASEDIR, "alert_cache")
 
 SLACK_SENDING_ACTIVE = True
 
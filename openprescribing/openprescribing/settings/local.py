@@ -130,6 +130,17 @@ MATRIXSTORE_BUILD_DIR = os.path.join(PIPELINE_DATA_BASEDIR, "matrixstore_build")
 # This is expected to be a symlink to a file in MATRIXSTORE_BUILD_DIR
 MATRIXSTORE_LIVE_FILE = os.path.join(MATRIXSTORE_BUILD_DIR, "matrixstore_live.sqlite")
 
+# Contains the index used by the org_code and bnf_code typeahead APIs, with a
+# "live" symlink to the current version
+TYPEAHEAD_INDEX_DIR = os.path.join(PIPELINE_DATA_BASEDIR, "typeahead_index")
+
+# Contains cached vector tiles of organisation boundaries
+TILE_CACHE_DIR = os.path.join(PIPELINE_DATA_BASEDIR, "tile_cache")
+
+# Contains the stats and charts computed for each org while sending monthly
+# alerts, so that an interrupted run can be resumed
+ALERT_CACHE_DIR = os.path.join(PIPELINE_DATA_BASEDIR, "alert_cache")
+
 # This is where we put outliers data
 OUTLIERS_DATA_DIR = Path(os.path.join(PIPELINE_DATA_BASEDIR, "outliers"))
 
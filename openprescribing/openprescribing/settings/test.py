@@ -91,6 +91,17 @@ MATRIXSTORE_BUILD_DIR = os.path.join(PIPELINE_DATA_BASEDIR, "matrixstore_build")
 # This is expected to be a symlink to a file in MATRIXSTORE_BUILD_DIR
 MATRIXSTORE_LIVE_FILE = os.path.join(MATRIXSTORE_BUILD_DIR, "matrixstore_live.sqlite")
 
+# Contains the index used by the org_code and bnf_code typeahead APIs, with a
+# "live" symlink to the current version
+TYPEAHEAD_INDEX_DIR = os.path.join(PIPELINE_DATA_BASEDIR, "typeahead_index")
+
+# Contains cached vector tiles of organisation boundaries
+TILE_CACHE_DIR = os.path.join(PIPELINE_DATA_BASEDIR, "tile_cache")
+
+# Keep the stats and charts computed while sending monthly alerts in memory
+# only, so that tests never see values cached by other tests
+ALERT_CACHE_DIR = None
+
 SLACK_SENDING_ACTIVE = False
 
 # Running with a different storage backend in test is not ideal but it's what
@@ -11,31 +11,78 @@ will report any changes to Slack.
 We do expect the numbers appearing on the site to change after importing data,
 so (a) we don't check if an import is in progress, and (b) the import process
 deletes old records of numbers.
+
+Pages are rendered in-process with Django's test client, spread over a pool of
+worker processes, so no browser is needed.  Numbers which the site's JavaScript
+fetches after the page has loaded are checked by requesting the corresponding
+API endpoints directly (see API_PATHS_TO_SCRAPE).
 """
 
 import json
+import multiprocessing
 import os
 import re
-import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from glob import glob
 
 from bs4 import BeautifulSoup
 from django.conf import settings
 from django.core.management import BaseCommand
+from django.db import connections
+from django.test import Client
 from django.urls import get_resolver
 from pipeline.runner import in_progress as import_in_progress
-from selenium import webdriver
-from selenium.common.exceptions import TimeoutException
-from selenium.webdriver.firefox.options import Options
 
 from openprescribing.slack import notify_slack
 from openprescribing.utils import mkdir_p
 
+# Requests are made as if to the live site, which is in ALLOWED_HOSTS in
+# production
+HOST = "openprescribing.net"
+
+DEFAULT_WORKERS = 8
+
+# API endpoints called by the pages scraped below, with the same organisations,
+# presentation and measure substituted in as in `build_path`
+API_PATHS_TO_SCRAPE = [
+    ("api_spending", "api/1.0/spending/?code=0205051R0BBAIAN&format=json"),
+    (
+        "api_spending_by_ccg",
+        "api/1.0/spending_by_sicbl/?code=0205051R0BBAIAN&org=15N&format=json",
+    ),
+    (
+        "api_spending_by_practice",
+        "api/1.0/spending_by_practice/?code=0205051R0BBAIAN&org=L83100&format=json",
+    ),
+    ("api_measure", "api/1.0/measure/?measure=ace&format=json"),
+    ("api_measure_by_ccg", "api/1.0/measure_by_sicbl/?measure=ace&org=15N&format=json"),
+    (
+        "api_measure_by_practice",
+        "api/1.0/measure_by_practice/?measure=ace&org=L83100&format=json",
+    ),
+    (
+        "api_measure_by_stp",
+        "api/1.0/measure_by_icb/?measure=ace&org=E54000037&format=json",
+    ),
+    (
+        "api_measure_by_regional_team",
+        "api/1.0/measure_by_regional_team/?measure=ace&org=Y58&format=json",
+    ),
+]
+
 
 class Command(BaseCommand):
     help = __doc__
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=DEFAULT_WORKERS,
+            help="Number of pages to render at once",
+        )
+
     def handle(self, *args, **options):
         if import_in_progress():
             notify_slack("Not checking numbers: import in progress")
@@ -47,16 +94,8 @@ class Command(BaseCommand):
         log_path = os.path.join(settings.CHECK_NUMBERS_BASE_PATH, timestamp)
         mkdir_p(log_path)
 
-        numbers = {}
-        options = Options()
-        options.headless = True
-        with webdriver.Firefox(options=options) as browser:
-            browser.set_page_load_timeout(60)
-
-            for name, path in paths_to_scrape():
-                source = get_page_source(browser, path, name, log_path)
-                numbers_list = extract_numbers(source)
-                numbers[name] = {"path": path, "numbers": numbers_list}
+        paths = list(paths_to_scrape()) + API_PATHS_TO_SCRAPE
+        numbers = scrape_numbers(paths, log_path, options["workers"])
 
         write_numbers(numbers, log_path)
 
@@ -159,27 +198,50 @@ def build_path(pattern, keys):
     return path
 
 
-def get_page_source(browser, path, name, log_path):
-    """Request URL, write copy of response to log_path, and return page source."""
-
-    url = "https://openprescribing.net/" + path
-    try:
-        browser.get(url)
-    except TimeoutException:
-        raise RuntimeError("Timed out requesting " + path)
-
-    # Wait until all AJAX requests are complete.
-    t0 = time.time()
-    while browser.execute_script("return jQuery.active > 0"):
-        time.sleep(0.1)
-        assert time.time() - t0 < 60, "Timed out checking numbers on {}".format(path)
-
-    source = browser.page_source
+def scrape_numbers(paths, log_path, max_workers):
+    """Render each of `paths` in a pool of worker processes, and return a
+    dictionary mapping each name to its path and the numbers found on it.
+    """
 
-    with open(os.path.join(log_path, name + ".html"), "w") as f:
+    # Database connections can't be shared between processes, so we close them
+    # before forking and each worker opens its own
+    connections.close_all()
+    with ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("fork")
+    ) as executor:
+        futures = [
+            (name, path, executor.submit(get_numbers, name, path, log_path))
+            for name, path in paths
+        ]
+        return {
+            name: {"path": path, "numbers": future.result()}
+            for name, path, future in futures
+        }
+
+
+def get_numbers(name, path, log_path):
+    """Render path, write copy of response to log_path, and return numbers."""
+
+    response = Client(HTTP_HOST=HOST).get("/" + path, secure=True, follow=True)
+    if response.status_code != 200:
+        raise RuntimeError(
+            "Got status {} requesting {}".format(response.status_code, path)
+        )
+    # Uncached measure API responses are streamed
+    if response.streaming:
+        content = b"".join(response.streaming_content)
+    else:
+        content = response.content
+    source = content.decode("utf8")
+
+    is_json = response["Content-Type"].startswith("application/json")
+    extension = "json" if is_json else "html"
+    with open(os.path.join(log_path, "{}.{}".format(name, extension)), "w") as f:
         f.write(source)
 
-    return source
+    if is_json:
+        return extract_json_numbers(json.loads(source))
+    return extract_numbers(source)
 
 
 def extract_numbers(source):
@@ -208,6 +270,18 @@ def extract_numbers(source):
     return rx.findall(body.text)
 
 
+def extract_json_numbers(data):
+    """Return all numbers in decoded JSON, in the order in which they appear."""
+
+    if isinstance(data, dict):
+        return [n for value in data.values() for n in extract_json_numbers(value)]
+    elif isinstance(data, list):
+        return [n for value in data for n in extract_json_numbers(value)]
+    elif isinstance(data, (int, float)) and not isinstance(data, bool):
+        return [data]
+    return []
+
+
 def compare_numbers(previous_numbers, numbers):
     """Compare dictionaries of numbers, returning list of any differences."""
 
@@ -1,12 +1,18 @@
 from django.core.management import BaseCommand
 
-from ...runner import run_all
+from ...runner import MAX_WORKERS, run_all
 
 
 class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument("year", type=int)
         parser.add_argument("month", type=int)
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=MAX_WORKERS,
+            help="Maximum number of tasks to run at once",
+        )
 
     def handle(self, *args, **kwargs):
-        run_all(kwargs["year"], kwargs["month"])
+        run_all(kwargs["year"], kwargs["month"], max_workers=kwargs["workers"])
@@ -0,0 +1,25 @@
+"""
+Checks a MatrixStore file against the expected values for the smoke tests,
+without making any network requests
+"""
+
+from django.core.management import BaseCommand, CommandError
+from matrixstore.connection import MatrixStore
+from pipeline.matrixstore_smoketests import run_smoketests
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Path to MatrixStore file")
+
+    def handle(self, *args, **kwargs):
+        db = MatrixStore.from_file(kwargs["path"])
+        try:
+            failures = run_smoketests(db)
+        finally:
+            db.close()
+        if failures:
+            raise CommandError("Smoke tests failed:\n" + "\n".join(failures))
+        self.stdout.write("All smoke tests passed")
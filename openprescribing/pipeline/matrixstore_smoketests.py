@@ -0,0 +1,169 @@
+"""
+Checks a MatrixStore file against the expected values for the spending smoke
+tests (see `smoketests.py`) without making any network requests, so that a new
+build can be checked before it is made live.
+
+Spending is calculated directly from the file's matrices, in the same way as
+the spending API.  Only practice to CCG relationships are read from the
+database.  We also check that the pre-calculated totals in the
+`all_presentations` table match the sum of prescribing over all presentations,
+and that there is some prescribing in every month.
+"""
+
+import json
+import os
+
+import numpy
+from django.conf import settings
+from frontend.models import Practice
+from matrixstore.row_grouper import RowGrouper
+
+from .smoketests import SPENDING_TESTS
+
+# Maps the API endpoint requested by each spending smoke test to the type of
+# organisation it groups practices by
+ORG_TYPES = {
+    "spending": None,
+    "spending_by_practice": "practice",
+    "spending_by_ccg": "ccg",
+}
+
+FIELDS = ["items", "quantity", "actual_cost", "net_cost"]
+
+
+def run_smoketests(db, spending_tests=SPENDING_TESTS):
+    """
+    Return a list of descriptions of the ways in which the supplied MatrixStore
+    doesn't match what we expect, which is empty if all is well
+    """
+    failures = []
+    for test_name, (path_fragment, params) in sorted(spending_tests.items()):
+        failures.extend(check_spending(db, test_name, ORG_TYPES[path_fragment], params))
+    failures.extend(check_totals(db))
+    failures.extend(check_months(db))
+    return failures
+
+
+def check_spending(db, test_name, org_type, params):
+    expected = load_expected(test_name)
+    num_months = len(expected["items"])
+    if num_months > len(db.dates):
+        return [
+            "{}: expected {} months of data but found {}".format(
+                test_name, num_months, len(db.dates)
+            )
+        ]
+    practice_codes = get_practice_codes(db, org_type, params.get("org"))
+    if not practice_codes:
+        return ["{}: no practices found for {}".format(test_name, params["org"])]
+    items, quantity, actual_cost = get_spending(
+        db, params["code"].split(","), practice_codes
+    )
+    failures = []
+    # The expected values are for the most recent months
+    offset = len(db.dates) - num_months
+    for i, date in enumerate(db.dates[offset:]):
+        # Expected values come from querying BQ and so values for `items` and
+        # `quantity` are integers, and value for `cost` is a string
+        # representing a number of pounds with at most two decimal places.
+        # Costs in the MatrixStore are in pence.
+        actual = (
+            int(items[offset + i]),
+            int(round(quantity[offset + i])),
+            int(actual_cost[offset + i]),
+        )
+        wanted = (
+            expected["items"][i],
+            expected["quantity"][i],
+            int(round(float(expected["cost"][i]) * 100)),
+        )
+        if actual != wanted:
+            failures.append(
+                "{}: expected (items, quantity, pence) of {} in {} but found {}".format(
+                    test_name, wanted, date, actual
+                )
+            )
+    return failures
+
+
+def check_totals(db):
+    """
+    Check that the totals in `all_presentations` match the sum over all
+    presentations
+    """
+    totals = db.query_one("SELECT {} FROM all_presentations".format(", ".join(FIELDS)))
+    sums = db.query_one(
+        "SELECT {} FROM presentation".format(
+            ", ".join("MATRIX_SUM({})".format(field) for field in FIELDS)
+        )
+    )
+    failures = []
+    for field, total, sum_ in zip(FIELDS, totals, sums):
+        if total is None or sum_ is None:
+            failures.append("all_presentations: no data for {}".format(field))
+        elif not numpy.allclose(to_dense(total), to_dense(sum_)):
+            failures.append(
+                "all_presentations: {} does not match the sum over all "
+                "presentations".format(field)
+            )
+    return failures
+
+
+def check_months(db):
+    items = to_dense(db.query_one("SELECT items FROM all_presentations")[0])
+    return [
+        "all_presentations: no prescribing in {}".format(date)
+        for date, total in zip(db.dates, items.sum(axis=0))
+        if total == 0
+    ]
+
+
+def get_practice_codes(db, org_type, org_id):
+    if org_type is None:
+        return list(db.practice_offsets)
+    elif org_type == "practice":
+        codes = [org_id]
+    elif org_type == "ccg":
+        codes = Practice.objects.filter(ccg_id=org_id).values_list("code", flat=True)
+    else:
+        raise ValueError("Unhandled org_type: " + org_type)
+    return [code for code in codes if code in db.practice_offsets]
+
+
+def get_spending(db, bnf_code_prefixes, practice_codes):
+    """
+    Return the total items, quantity and actual cost (in pence) for each month
+    over all presentations matching the supplied BNF code prefixes and all the
+    supplied practices
+    """
+    where = " OR ".join(["bnf_code LIKE ?"] * len(bnf_code_prefixes))
+    sql = (
+        "SELECT MATRIX_SUM(items), MATRIX_SUM(quantity), MATRIX_SUM(actual_cost) "
+        "FROM presentation WHERE {}".format(where)
+    )
+    matrices = db.query_one(sql, [code + "%" for code in bnf_code_prefixes])
+    group_all = RowGrouper(
+        (db.practice_offsets[code], "all") for code in practice_codes
+    )
+    return [
+        (
+            to_dense(group_all.sum(matrix))[0]
+            if matrix is not None
+            else numpy.zeros(len(db.dates))
+        )
+        for matrix in matrices
+    ]
+
+
+def load_expected(test_name):
+    path = os.path.join(
+        settings.PIPELINE_METADATA_DIR, "smoketests", test_name + ".json"
+    )
+    with open(path) as f:
+        return json.load(f)
+
+
+def to_dense(matrix):
+    if hasattr(matrix, "toarray"):
+        return matrix.toarray()
+    return numpy.asarray(matrix)
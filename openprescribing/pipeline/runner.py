@@ -6,11 +6,14 @@ import os
 import re
 import shlex
 import textwrap
+import threading
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import networkx as nx
 from django.conf import settings
 from django.core.management import call_command as django_call_command
+from django.db import connection
 from gcutils.storage import Client as StorageClient
 
 from openprescribing.slack import notify_slack
@@ -18,6 +21,12 @@ from openprescribing.utils import find_files
 
 from .models import TaskLog
 
+# Maximum number of tasks run at once
+MAX_WORKERS = 4
+
+# Tasks may run concurrently, so we serialise updates to the import log
+import_records_lock = threading.Lock()
+
 
 class Source(object):
     def __init__(self, name, attrs):
@@ -132,9 +141,12 @@ class Task(object):
     def set_last_imported_path(self, path):
         """Set the path of the most recently imported data for this source."""
         now = datetime.datetime.now().replace(microsecond=0).isoformat()
-        records = load_import_records()
-        records[self.source.name].append({"imported_file": path, "imported_at": now})
-        dump_import_records(records)
+        with import_records_lock:
+            records = load_import_records()
+            records[self.source.name].append(
+                {"imported_file": path, "imported_at": now}
+            )
+            dump_import_records(records)
 
     def unimported_paths(self):
         """Return list of of paths to input files for task that have not been
@@ -386,6 +398,11 @@ def run_task(task, year, month, **kwargs):
     try:
         task.run(year, month, **kwargs)
         task_log.mark_succeeded()
+        print(
+            "Finished task {} in {}".format(
+                task.name, task_log.ended_at - task_log.started_at
+            )
+        )
     except BaseException:
         # We want to catch absolutely every error here, including things that
         # wouldn't be caught by `except Exception` (like `KeyboardInterrupt`),
@@ -400,29 +417,136 @@ def run_task(task, year, month, **kwargs):
         raise
 
 
-def run_all(year, month, under_test=False):
+def run_task_graph(tasks, run, max_workers=MAX_WORKERS):
+    """Call `run(task)` for each of `tasks`, starting each task as soon as all
+    its dependencies have completed, with at most `max_workers` tasks running
+    at once.
+
+    Dependencies on tasks not in `tasks` are assumed to have been met already.
+    If a task fails then no further tasks are started, and once the tasks
+    already running have finished the first exception is re-raised.
+    """
+    tasks = list(tasks)
+    names = {task.name for task in tasks}
+    waiting_for = {
+        task.name: {dep.name for dep in task.dependencies if dep.name in names}
+        for task in tasks
+    }
+    dependents = defaultdict(list)
+    for task in tasks:
+        for name in waiting_for[task.name]:
+            dependents[name].append(task)
+    ready = [task for task in tasks if not waiting_for[task.name]]
+    completed = set()
+    errors = []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while True:
+            while ready and not errors:
+                task = ready.pop(0)
+                running[executor.submit(run_in_thread, run, task)] = task
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                try:
+                    future.result()
+                except BaseException as e:
+                    errors.append(e)
+                    continue
+                completed.add(task.name)
+                for dependent in dependents[task.name]:
+                    waiting_for[dependent.name].discard(task.name)
+                    if not waiting_for[dependent.name]:
+                        ready.append(dependent)
+
+    if errors:
+        raise errors[0]
+    assert completed == names, "Could not run: {}".format(
+        ", ".join(sorted(names - completed))
+    )
+
+
+def run_in_thread(run, task):
+    try:
+        run(task)
+    finally:
+        # Each thread gets its own database connection, which Django won't
+        # close for us
+        connection.close()
+
+
+def get_critical_path(tasks, year, month):
+    """Return the chain of dependent tasks which took longest to run for the
+    given month, as a list of (task name, duration) pairs.
+
+    Durations are the wall time of each task's most recent successful run.
+    """
+    durations = {}
+    for task_log in TaskLog.objects.filter(
+        year=year, month=month, status=TaskLog.SUCCESSFUL
+    ).order_by("started_at"):
+        durations[task_log.task_name] = task_log.ended_at - task_log.started_at
+    zero = datetime.timedelta(0)
+    # Maps task name to the total duration of the longest chain of tasks
+    # ending with that task, and the previous task in that chain
+    longest = {}
+    for task in tasks.ordered():
+        previous = max(
+            (dep.name for dep in task.dependencies),
+            key=lambda name: longest[name][0],
+            default=None,
+        )
+        total = durations.get(task.name, zero)
+        if previous is not None:
+            total += longest[previous][0]
+        longest[task.name] = (total, previous)
+    if not longest:
+        return []
+    name = max(longest, key=lambda name: longest[name][0])
+    path = []
+    while name is not None:
+        path.append((name, durations.get(name, zero)))
+        name = longest[name][1]
+    return path[::-1]
+
+
+def run_all(year, month, under_test=False, max_workers=MAX_WORKERS):
     tasks = load_tasks()
 
+    def run(task, **kwargs):
+        run_task(task, year, month, **kwargs)
+
     if not under_test:
+        # These wait for input, so must be run one at a time
         for task in tasks.by_type("manual_fetch"):
-            run_task(task, year, month)
+            run(task)
 
-        for task in tasks.by_type("auto_fetch"):
-            run_task(task, year, month)
+        run_task_graph(tasks.by_type("auto_fetch"), run, max_workers)
 
     upload_all_to_storage(tasks)
 
-    for task in tasks.by_type("convert").ordered():
-        run_task(task, year, month)
-
-    for task in tasks.by_type("import").ordered():
-        run_task(task, year, month)
+    run_task_graph(
+        list(tasks.by_type("convert")) + list(tasks.by_type("import")),
+        run,
+        max_workers,
+    )
 
     prescribing_path = tasks["convert_hscic_prescribing"].imported_paths()[-1]
     last_imported = re.findall(r"/(\d{4}_\d{2})/", prescribing_path)[0]
 
-    for task in tasks.by_type("post_process").ordered():
-        run_task(task, year, month, last_imported=last_imported)
+    run_task_graph(
+        tasks.by_type("post_process"),
+        lambda task: run(task, last_imported=last_imported),
+        max_workers,
+    )
+
+    critical_path = get_critical_path(tasks, year, month)
+    print("Critical path:")
+    for task_name, duration in critical_path:
+        print("  {:<45} {}".format(task_name, duration))
 
     if not under_test:
         # Remove numbers.json files.  These are created by check_numbers, and we want to
@@ -19,6 +19,40 @@ The expected numbers are generated from pipeline/misc/smoke.sh
 
 PRESCRIBING_DATA_MONTHS = 5 * 12
 
+# Maps the name of each spending smoke test to the API endpoint and parameters
+# it requests.  These are also checked directly against new MatrixStore files
+# by `matrixstore_smoketests`.
+SPENDING_TESTS = {
+    "presentation_by_all": ("spending", {"code": "0501013B0AAAAAA"}),
+    "chemical_by_all": ("spending", {"code": "0407010F0"}),
+    "bnf_section_by_all": ("spending", {"code": "0702"}),
+    # Cerazette 75mcg.
+    "presentation_by_one_practice": (
+        "spending_by_practice",
+        {"code": "0703021Q0BBAAAA", "org": "F84747"},
+    ),
+    # Rosuvastatin Calcium.
+    "chemical_by_one_practice": (
+        "spending_by_practice",
+        {"code": "0212000AA", "org": "F84747"},
+    ),
+    # Multiple generic statins.
+    "multiple_chemicals_by_one_practice": (
+        "spending_by_practice",
+        {"code": "0212000B0,0212000C0,0212000M0,0212000X0,0212000Y0", "org": "C85020"},
+    ),
+    "bnf_section_by_one_practice": (
+        "spending_by_practice",
+        {"code": "0304", "org": "L84077"},
+    ),
+    "presentation_by_one_ccg": (
+        "spending_by_ccg",
+        {"code": "0403030E0AAAAAA", "org": "10Q"},
+    ),
+    "chemical_by_one_ccg": ("spending_by_ccg", {"code": "0212000AA", "org": "10Q"}),
+    "bnf_section_by_one_ccg": ("spending_by_ccg", {"code": "0801", "org": "10Q"}),
+}
+
 
 class SmokeTestBase(unittest.TestCase):
     DOMAIN = "https://openprescribing.net"
@@ -30,9 +64,10 @@ class SmokeTestBase(unittest.TestCase):
             now = datetime.now()
         return now
 
-    def _run_tests(self, test_name, path_fragment, params):
+    def _run_tests(self, test_name):
+        path_fragment, params = SPENDING_TESTS[test_name]
         url = "{}/api/1.0/{}/".format(self.DOMAIN, path_fragment)
-        params["format"] = "csv"
+        params = dict(params, format="csv")
         r = requests.get(url, params=params)
         f = io.StringIO(r.text)
         all_rows = list(csv.DictReader(f))
@@ -61,54 +96,38 @@ class SmokeTestBase(unittest.TestCase):
 
 class TestSmokeTestSpendingByEveryone(SmokeTestBase):
     def test_presentation_by_all(self):
-        params = {"code": "0501013B0AAAAAA"}
-        self._run_tests("presentation_by_all", "spending", params)
+        self._run_tests("presentation_by_all")
 
     def test_chemical_by_all(self):
-        params = {"code": "0407010F0"}
-        self._run_tests("chemical_by_all", "spending", params)
+        self._run_tests("chemical_by_all")
 
     def test_bnf_section_by_all(self):
-        params = {"code": "0702"}
-        self._run_tests("bnf_section_by_all", "spending", params)
+        self._run_tests("bnf_section_by_all")
 
 
 class TestSmokeTestSpendingByOnePractice(SmokeTestBase):
     def test_presentation_by_one_practice(self):
-        params = {"code": "0703021Q0BBAAAA", "org": "F84747"}  # Cerazette 75mcg.
-        self._run_tests("presentation_by_one_practice", "spending_by_practice", params)
+        self._run_tests("presentation_by_one_practice")
 
     def test_chemical_by_one_practice(self):
-        params = {"code": "0212000AA", "org": "F84747"}  # Rosuvastatin Calcium.
-        self._run_tests("chemical_by_one_practice", "spending_by_practice", params)
+        self._run_tests("chemical_by_one_practice")
 
     def test_multiple_chemicals_by_one_practice(self):
-        # Multiple generic statins.
-        params = {
-            "code": "0212000B0,0212000C0,0212000M0,0212000X0,0212000Y0",
-            "org": "C85020",
-        }
-        self._run_tests(
-            "multiple_chemicals_by_one_practice", "spending_by_practice", params
-        )
+        self._run_tests("multiple_chemicals_by_one_practice")
 
     def test_bnf_section_by_one_practice(self):
-        params = {"code": "0304", "org": "L84077"}
-        self._run_tests("bnf_section_by_one_practice", "spending_by_practice", params)
+        self._run_tests("bnf_section_by_one_practice")
 
 
 class TestSmokeTestSpendingByCCG(SmokeTestBase):
     def test_presentation_by_one_ccg(self):
-        params = {"code": "0403030E0AAAAAA", "org": "10Q"}
-        self._run_tests("presentation_by_one_ccg", "spending_by_ccg", params)
+        self._run_tests("presentation_by_one_ccg")
 
     def test_chemical_by_one_ccg(self):
-        params = {"code": "0212000AA", "org": "10Q"}
-        self._run_tests("chemical_by_one_ccg", "spending_by_ccg", params)
+        self._run_tests("chemical_by_one_ccg")
 
     def test_bnf_section_by_one_ccg(self):
-        params = {"code": "0801", "org": "10Q"}
-        self._run_tests("bnf_section_by_one_ccg", "spending_by_ccg", params)
+        self._run_tests("bnf_section_by_one_ccg")
 
 
 class TestSmokeTestMeasures(SmokeTestBase):
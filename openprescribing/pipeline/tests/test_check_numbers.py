@@ -0,0 +1,73 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase, TestCase, override_settings
+from pipeline.management.commands.check_numbers import (
+    HOST,
+    compare_numbers,
+    extract_json_numbers,
+    extract_numbers,
+    get_numbers,
+)
+
+
+class TestCheckNumbers(SimpleTestCase):
+    def test_extract_numbers(self):
+        source = """
+        <html><body>
+          <p>Spent £1,234.56 on 12,345 items (&pound;7 each)</p>
+          <svg><text>255,255,255</text></svg>
+        </body></html>
+        """
+        self.assertEqual(extract_numbers(source), ["£1,234.56", "12,345", "£7"])
+
+    def test_extract_json_numbers(self):
+        data = [
+            {"date": "2018-08-01", "items": 12, "actual_cost": 3.5, "flag": True},
+            {
+                "date": "2018-09-01",
+                "items": 14,
+                "actual_cost": None,
+                "percentiles": [1],
+            },
+        ]
+        self.assertEqual(extract_json_numbers(data), [12, 3.5, 14, 1])
+
+    def test_compare_numbers(self):
+        previous_numbers = {
+            "unchanged": {"path": "a/", "numbers": ["1,000"]},
+            "changed": {"path": "b/", "numbers": ["1,000"]},
+            "missing": {"path": "c/", "numbers": []},
+        }
+        numbers = {
+            "unchanged": {"path": "a/", "numbers": ["1,000"]},
+            "changed": {"path": "b/", "numbers": ["2,000"]},
+            "added": {"path": "d/", "numbers": []},
+        }
+        self.assertEqual(
+            compare_numbers(previous_numbers, numbers),
+            ["Missing: missing (c/)", "Changed: changed (b/)", "Added: added (d/)"],
+        )
+
+
+@override_settings(ALLOWED_HOSTS=[HOST], ENABLE_CACHING=False)
+class TestGetNumbers(TestCase):
+    fixtures = ["one_month_of_measures"]
+
+    def setUp(self):
+        self.log_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.log_path)
+
+    def test_get_numbers_from_streamed_response(self):
+        # Uncached measure API responses are StreamingHttpResponses
+        path = "api/1.0/measure_by_practice/?measure=cerazette&org=C84001&format=json"
+        numbers = get_numbers("api_measure_by_practice", path, self.log_path)
+        with open(os.path.join(self.log_path, "api_measure_by_practice.json")) as f:
+            data = json.load(f)
+        self.assertEqual(data["measures"][0]["data"][0]["org_id"], "C84001")
+        self.assertEqual(numbers, extract_json_numbers(data))
+        self.assertTrue(numbers)
@@ -0,0 +1,95 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase, override_settings
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.matrixstore_factory import matrixstore_from_data_factory
+from pipeline.matrixstore_smoketests import run_smoketests
+
+SPENDING_TESTS = {
+    "presentation_by_all": ("spending", {"code": "0123456789ABCD3"}),
+    "section_by_one_practice": (
+        "spending_by_practice",
+        {"code": "0123", "org": "ABC000"},
+    ),
+}
+
+
+class TestMatrixStoreSmokeTests(SimpleTestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tempdir, "smoketests"))
+        self.factory = DataFactory()
+        self.factory.create_all(
+            start_date="2018-06-01",
+            num_months=3,
+            num_practices=2,
+            num_presentations=2,
+        )
+        self.db = matrixstore_from_data_factory(self.factory)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_passes_with_matching_data(self):
+        self.write_expected("presentation_by_all", self.get_expected("0123456789ABCD3"))
+        self.write_expected(
+            "section_by_one_practice", self.get_expected("0123", "ABC000")
+        )
+        self.assertEqual(self.run_smoketests(), [])
+
+    def test_reports_mismatched_data(self):
+        expected = self.get_expected("0123456789ABCD3")
+        expected["items"][1] += 1
+        self.write_expected("presentation_by_all", expected)
+        self.write_expected(
+            "section_by_one_practice", self.get_expected("0123", "ABC000")
+        )
+        failures = self.run_smoketests()
+        self.assertEqual(len(failures), 1)
+        self.assertIn("presentation_by_all", failures[0])
+        self.assertIn("2018-07-01", failures[0])
+
+    def test_reports_too_few_months(self):
+        expected = self.get_expected("0123456789ABCD3")
+        for values in expected.values():
+            values.insert(0, values[0])
+        self.write_expected("presentation_by_all", expected)
+        self.write_expected(
+            "section_by_one_practice", self.get_expected("0123", "ABC000")
+        )
+        self.assertEqual(
+            self.run_smoketests(),
+            ["presentation_by_all: expected 4 months of data but found 3"],
+        )
+
+    def get_expected(self, bnf_code_prefix, practice=None):
+        expected = {"cost": [], "items": [], "quantity": []}
+        for month in self.factory.months:
+            prescriptions = [
+                p
+                for p in self.factory.prescribing
+                if p["month"] == month
+                and p["bnf_code"].startswith(bnf_code_prefix)
+                and (practice is None or p["practice"] == practice)
+            ]
+            expected["cost"].append(
+                "{:.2f}".format(sum(p["actual_cost"] for p in prescriptions))
+            )
+            expected["items"].append(sum(p["items"] for p in prescriptions))
+            expected["quantity"].append(
+                round(sum(p["quantity"] for p in prescriptions))
+            )
+        return expected
+
+    def write_expected(self, test_name, expected):
+        path = os.path.join(self.tempdir, "smoketests", test_name + ".json")
+        with open(path, "w") as f:
+            json.dump(expected, f)
+
+    def run_smoketests(self):
+        with override_settings(PIPELINE_METADATA_DIR=self.tempdir):
+            return run_smoketests(self.db, SPENDING_TESTS)
@@ -1,11 +1,20 @@
+import datetime
 import json
 import os
+import threading
+import time
 
 import mock
 from django.conf import settings
 from django.test import TestCase, override_settings
 from pipeline.models import TaskLog
-from pipeline.runner import in_progress, load_tasks, run_task
+from pipeline.runner import (
+    get_critical_path,
+    in_progress,
+    load_tasks,
+    run_task,
+    run_task_graph,
+)
 
 
 class PipelineTests(TestCase):
@@ -365,6 +374,102 @@ The last imported data can be found at:
         logs = TaskLog.objects.filter(year=2017, month=7, task_name="fetch_source_b")
         self.assertEqual(2, logs.count())
 
+    def test_run_task_graph(self):
+        events = []
+        # The three fetch tasks have no dependencies, so this will only be
+        # passed if they run at the same time
+        barrier = threading.Barrier(3, timeout=5)
+
+        def run(task):
+            events.append(("start", task.name))
+            if task.task_type in ["manual_fetch", "auto_fetch"]:
+                barrier.wait()
+            events.append(("end", task.name))
+
+        run_task_graph(self.tasks, run, max_workers=3)
+
+        self.assertEqual(
+            sorted(name for event, name in events if event == "start"),
+            sorted(task.name for task in self.tasks),
+        )
+        for task in self.tasks:
+            for dependency in task.dependencies:
+                self.assertLess(
+                    events.index(("end", dependency.name)),
+                    events.index(("start", task.name)),
+                )
+
+    def test_run_real_post_process_task_graph(self):
+        path = os.path.join(settings.APPS_ROOT, "pipeline", "metadata")
+        with override_settings(PIPELINE_METADATA_DIR=path):
+            tasks = load_tasks()
+        post_process_tasks = list(tasks.by_type("post_process"))
+        events = []
+
+        def run(task):
+            events.append(("start", task.name))
+            # Give tasks which would otherwise run at the same time as tasks
+            # that use their output a chance to overlap with them
+            time.sleep(0.05)
+            events.append(("end", task.name))
+
+        run_task_graph(post_process_tasks, run, max_workers=len(post_process_tasks))
+
+        for dependency_name, task_name in [
+            ("handle_orphan_practices", "upload_to_bigquery"),
+            ("import_adqs", "upload_to_bigquery"),
+            ("create_bq_measure_views", "create_bq_public_measure_tables"),
+        ]:
+            self.assertLess(
+                events.index(("end", dependency_name)),
+                events.index(("start", task_name)),
+            )
+
+    def test_run_task_graph_with_failure(self):
+        started = []
+
+        def run(task):
+            started.append(task.name)
+            if task.name == "import_source_b":
+                raise ValueError(task.name)
+
+        with self.assertRaises(ValueError):
+            run_task_graph(self.tasks.by_type("import"), run)
+
+        # Tasks depending on the failed task are not started
+        self.assertEqual(started, ["import_source_a", "import_source_b"])
+
+    def test_get_critical_path(self):
+        start = datetime.datetime(2017, 8, 1, tzinfo=datetime.timezone.utc)
+        for task_name, minutes in [
+            ["fetch_source_b", 30],
+            ["convert_source_a", 1],
+            ["import_source_a", 1],
+            ["import_source_b", 5],
+            ["import_source_c1", 1],
+            ["import_source_c2", 1],
+            ["post_process", 10],
+        ]:
+            TaskLog.objects.create(
+                year=2017, month=7, task_name=task_name, status=TaskLog.SUCCESSFUL
+            )
+            TaskLog.objects.filter(task_name=task_name).update(
+                started_at=start, ended_at=start + datetime.timedelta(minutes=minutes)
+            )
+
+        self.assertEqual(
+            [
+                (task_name, duration.seconds // 60)
+                for task_name, duration in get_critical_path(self.tasks, 2017, 7)
+            ],
+            [
+                ("fetch_source_b", 30),
+                ("import_source_b", 5),
+                ("import_source_c1", 1),
+                ("post_process", 10),
+            ],
+        )
+
     def test_in_progress_when_not_in_progress(self):
         TaskLog.objects.create(year=2017, month=7, task_name="task1")
         TaskLog.objects.create(year=2017, month=7, task_name="task2")